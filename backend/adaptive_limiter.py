@@ -0,0 +1,120 @@
+# backend/adaptive_limiter.py
+"""
+Controllo adattivo della concorrenza (AIMD) verso i servizi esterni.
+
+Il limite di richieste in volo cresce di ~1 per "finestra" finché la latenza resta
+sotto il target e le risposte sono sane; viene dimezzato (al massimo una volta per
+cooldown) su 429/5xx, errori di rete/timeout o picchi di latenza.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import httpx
+
+from backend import metrics
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        name: str,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        latency_target_s: float,
+        decrease_factor: float = 0.5,
+        cooldown_s: float = 2.0,
+    ):
+        self.name = name
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.limit = float(min(max(int(initial), self.min_limit), self.max_limit))
+        self.latency_target_s = float(latency_target_s)
+        self.decrease_factor = float(decrease_factor)
+        self.cooldown_s = float(cooldown_s)
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._last_decrease = 0.0
+        self._export()
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, initial: int, min_limit: int, max_limit: int, latency_target_s: float):
+        """Crea un limiter leggendo i parametri da <PREFIX>_CONC_INITIAL/_MIN/_MAX e <PREFIX>_LATENCY_TARGET_S."""
+        return cls(
+            name,
+            initial=int(os.getenv(f"{prefix}_CONC_INITIAL", str(initial))),
+            min_limit=int(os.getenv(f"{prefix}_CONC_MIN", str(min_limit))),
+            max_limit=int(os.getenv(f"{prefix}_CONC_MAX", str(max_limit))),
+            latency_target_s=float(os.getenv(f"{prefix}_LATENCY_TARGET_S", str(latency_target_s))),
+        )
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self._export()
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Lo slot era già stato assegnato: restituiscilo.
+                self.in_flight -= 1
+                self._wake()
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self, latency_s: float, status: int | None, failed: bool = False) -> None:
+        self.in_flight = max(0, self.in_flight - 1)
+        overloaded = failed or status == 429 or (status is not None and status >= 500) or latency_s > self.latency_target_s
+        now = time.monotonic()
+        if overloaded:
+            if now - self._last_decrease >= self.cooldown_s:
+                old = self.limit
+                self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                self._last_decrease = now
+                metrics.incr(f"limiter.{self.name}.decrease")
+                logging.info(
+                    "[LIMITER] %s: limite %.1f → %.1f (status=%s, latency=%.2fs, failed=%s)",
+                    self.name, old, self.limit, status, latency_s, failed,
+                )
+        elif status is not None and status < 400:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / max(self.limit, 1.0))
+        self._wake()
+        self._export()
+
+    async def request(self, client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+        """Esegue client.request() dentro uno slot, registrando latenza ed esito."""
+        await self.acquire()
+        t0 = time.perf_counter()
+        status: int | None = None
+        failed = False
+        try:
+            resp = await client.request(method, url, **kwargs)
+            status = resp.status_code
+            return resp
+        except httpx.TransportError:
+            failed = True
+            raise
+        finally:
+            self.release(time.perf_counter() - t0, status, failed)
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self.in_flight += 1
+            fut.set_result(None)
+
+    def _export(self) -> None:
+        metrics.set_gauge(f"limiter.{self.name}.limit", round(self.limit, 2))
+        metrics.set_gauge(f"limiter.{self.name}.in_flight", self.in_flight)
@@ -0,0 +1,407 @@
+# backend/batch_enrich.py
+"""
+Arricchimento in modalità batch (OpenAI Batch API) per il lavoro non interattivo:
+backfill dell'ingestor, requeue all'avvio del worker, recompute_summaries(batch=True).
+
+Flusso:
+  1. il worker scarica il messaggio e, se il job ha "batch": true, mette (email_id, user_id)
+     nella lista Redis `batch:pending` invece di chiamare l'LLM;
+  2. submit_pending() sposta fino a BATCH_MAX_ITEMS elementi in `batch:taking`, risolve subito quelli già in
+     cache LLM e per gli altri costruisce un file JSONL di richieste combinate
+     (build_combined_request), lo carica su /files e crea il job su /batches;
+  3. poll_inflight() controlla i batch in volo (hash `batch:inflight`); a job concluso scarica
+     l'output, applica i risultati a Newsletter in un'unica transazione, riempie la cache LLM
+     e accoda al worker un job `stage: "image"` per le righe ancora senza immagine.
+     Gli elementi falliti o non validi tornano nella coda normale `email_queue`.
+  Un elemento sta sempre in `batch:pending`, `batch:taking` o `batch:inflight`: se l'invio si
+  interrompe (processo terminato, errore) il giro successivo rimette `batch:taking` in attesa.
+
+Avvio: python -m backend.batch_enrich          (ciclo continuo)
+       python -m backend.batch_enrich submit   (un solo invio)
+       python -m backend.batch_enrich poll     (un solo controllo)
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from typing import Any, cast
+
+import httpx
+import redis
+from dotenv import load_dotenv
+from redis import Redis
+
+load_dotenv("/opt/newsletter/.env")  # prima di processing_utils, che legge le chiavi all'import
+from backend import metrics, domain_profiles, feed_push
+from backend.database import db, Newsletter, initialize_db
+from backend.feed_cache import bump_feed_version
+from backend.fastjson import dumps_str
+from backend.processing_utils import (
+    build_combined_request, parse_combined_response, llm_cache_get, llm_cache_put,
+    MODEL_COMBINED, OPENAI_API_KEY, OPENAI_BASE_URL,
+)
+
+BATCH_PENDING_KEY = "batch:pending"
+BATCH_QUEUED_SET = "batch:queued"          # dedup degli elementi in attesa o in volo
+BATCH_PENDING_SINCE_KEY = "batch:pending:since"
+BATCH_TAKING_KEY = "batch:taking"          # elementi presi da submit_pending, non ancora in volo
+BATCH_INFLIGHT_KEY = "batch:inflight"      # batch_id -> {"created", "items": {custom_id: [email_id, user_id, cache_key]}}
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_MIN_ITEMS = int(os.getenv("BATCH_MIN_ITEMS", "50"))
+BATCH_MAX_WAIT_SEC = int(os.getenv("BATCH_MAX_WAIT_SEC", "900"))
+BATCH_POLL_SEC = int(os.getenv("BATCH_POLL_SEC", "60"))
+BATCH_COMPLETION_WINDOW = os.getenv("BATCH_COMPLETION_WINDOW", "24h")
+
+_TERMINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def logb(stage, **kv):
+    try:
+        logging.info(dumps_str({"type": "batch", "stage": stage, **kv}))
+    except Exception:
+        logging.info(f"[batch][{stage}] {kv}")
+
+
+def enqueue_for_batch(r: Redis, email_id: str, user_id: str, fresh: bool = False) -> bool:
+    """Accoda un'email per il prossimo batch; False se è già in attesa o in volo."""
+    if not r.sadd(BATCH_QUEUED_SET, f"{user_id}|{email_id}"):
+        return False
+    r.rpush(BATCH_PENDING_KEY, json.dumps({"email_id": email_id, "user_id": user_id, "fresh": fresh}))
+    r.set(BATCH_PENDING_SINCE_KEY, int(time.time()), nx=True)
+    return True
+
+
+def should_submit(r: Redis) -> bool:
+    """Invia quando ci sono abbastanza elementi o il più vecchio aspetta da troppo."""
+    n = int(cast(Any, r.llen(BATCH_PENDING_KEY)) or 0)
+    if n <= 0:
+        return False
+    if n >= BATCH_MIN_ITEMS:
+        return True
+    since = r.get(BATCH_PENDING_SINCE_KEY)
+    return bool(since) and (time.time() - float(cast(Any, since))) >= BATCH_MAX_WAIT_SEC
+
+
+def _take_pending(r: Redis, max_items: int) -> list[dict]:
+    # LMOVE in MULTI: un elemento preso resta in batch:taking finché non è in volo o rilasciato
+    pipe = r.pipeline()
+    for _ in range(max_items):
+        pipe.lmove(BATCH_PENDING_KEY, BATCH_TAKING_KEY, "LEFT", "RIGHT")
+    raw = [x for x in pipe.execute() if x is not None]
+    if not r.llen(BATCH_PENDING_KEY):
+        r.delete(BATCH_PENDING_SINCE_KEY)
+    items = []
+    for x in raw or []:
+        try:
+            items.append(json.loads(x))
+        except json.JSONDecodeError:
+            continue
+    return items
+
+
+def _restore_taken(r: Redis) -> int:
+    """
+    Rimette in testa a batch:pending, nell'ordine originale, gli elementi di un invio interrotto.
+    Va chiamata solo da chi invia (un solo processo, vedi il lock di run_forever).
+    """
+    n = 0
+    while r.lmove(BATCH_TAKING_KEY, BATCH_PENDING_KEY, "RIGHT", "LEFT") is not None:
+        n += 1
+    if n:
+        r.set(BATCH_PENDING_SINCE_KEY, int(time.time()), nx=True)
+        logb("restored", count=n)
+    return n
+
+
+def _release(r: Redis, pairs: list[tuple[str, str]], requeue: bool) -> None:
+    """Toglie gli elementi dal set di dedup; se requeue=True li rimanda al worker (percorso normale)."""
+    if not pairs:
+        return
+    pipe = r.pipeline()
+    for email_id, user_id in pairs:
+        pipe.srem(BATCH_QUEUED_SET, f"{user_id}|{email_id}")
+        if requeue:
+            pipe.rpush("email_queue", json.dumps({"email_id": email_id, "user_id": user_id}))
+    pipe.execute()
+
+
+def _content_for_row(n: Newsletter) -> str:
+    head = f"FROM: {n.sender_name or ''} <{n.sender_email or ''}>\nSUBJECT: {n.original_subject or ''}\n\n"
+    return head + (n.full_content_html or "")
+
+
+def _apply_results_sync(results: list[tuple[str, str, dict]]) -> list[tuple[str, str, str]]:
+    """
+    Applica i risultati combinati alle righe in un'unica transazione.
+    Restituisce (email_id, user_id, keyword) delle righe che hanno ancora bisogno dell'immagine.
+    """
+    need_image: list[tuple[str, str, str]] = []
+    if not results:
+        return need_image
+    with db.atomic():
+        for email_id, user_id, res in results:
+            n = Newsletter.get_or_none((Newsletter.email_id == email_id) & (Newsletter.user_id == user_id))
+            if not n or n.is_deleted:
+                continue
+            domain = domain_profiles.sender_host(n.sender_email)
+            type_tag = domain_profiles.override_for(user_id, domain) or res["type_tag"]
+            has_image = bool((n.image_url or "").strip())
+            fields: dict[str, Any] = {
+                "ai_title": res["title"],
+                "ai_summary_markdown": res["summary_markdown"],
+                "type_tag": type_tag,
+                "topic_tag": res["topic_tag"],
+                "enriched": True,
+                "is_complete": has_image,
+            }
+            if not n.tag and res.get("keyword"):
+                fields["tag"] = res["keyword"].strip()[:32]
+            (cast(Any, Newsletter)
+             .update(**fields)
+             .where((Newsletter.email_id == email_id) & (Newsletter.user_id == user_id))
+             .execute())
+            domain_profiles.record(user_id, domain, n.source_domain, type_tag, res["topic_tag"])
+            if not has_image:
+                need_image.append((email_id, user_id, res.get("keyword") or ""))
+    return need_image
+
+
+async def _apply_and_dispatch(r: Redis, results: list[tuple[str, str, dict]]) -> None:
+    need_image = await asyncio.to_thread(_apply_results_sync, results)
+    pipe = r.pipeline()
+    for email_id, user_id, kw in need_image:
+        pipe.rpush("email_queue", json.dumps({"email_id": email_id, "user_id": user_id, "stage": "image", "keyword": kw}))
+    pipe.execute()
+    _release(r, [(e, u) for e, u, _ in results], requeue=False)
+    bump_feed_version(r, *{u for _, u, _ in results})
+    # Le email già con immagine sono complete: card subito sullo stream dell'utente
+    waiting = {(e, u) for e, u, _ in need_image}
+    for email_id, user_id, _ in results:
+        if (email_id, user_id) not in waiting:
+            await asyncio.to_thread(feed_push.push_card, r, user_id, email_id)
+    metrics.incr("batch.applied", len(results))
+    logb("applied", count=len(results), image_jobs=len(need_image))
+
+
+async def submit_pending(r: Redis, client: httpx.AsyncClient, max_items: int = BATCH_MAX_ITEMS) -> str | None:
+    """Crea un batch con gli elementi in attesa. Restituisce l'id del batch (None se non serve)."""
+    items = _take_pending(r, max_items)
+    if not items:
+        r.delete(BATCH_TAKING_KEY)
+        return None
+
+    keys = [(it.get("email_id"), it.get("user_id")) for it in items if it.get("email_id") and it.get("user_id")]
+    rows = await asyncio.to_thread(
+        lambda: {
+            (n.email_id, n.user_id): n
+            for n in Newsletter.select().where(Newsletter.email_id.in_([e for e, _ in keys]))
+            if (n.email_id, n.user_id) in set(keys)
+        }
+    )
+    fresh = {(it.get("email_id"), it.get("user_id")) for it in items if it.get("fresh")}
+
+    lines: list[str] = []
+    mapping: dict[str, list[str]] = {}
+    from_cache: list[tuple[str, str, dict]] = []
+    missing: list[tuple[str, str]] = []
+    for email_id, user_id in dict.fromkeys(keys):
+        n = rows.get((email_id, user_id))
+        if n is None or not (n.full_content_html or n.original_subject):
+            missing.append((email_id, user_id))
+            continue
+        payload, cache_key, _ = build_combined_request(_content_for_row(n))
+        if (email_id, user_id) not in fresh:
+            cached = await llm_cache_get("combined", cache_key)
+            if isinstance(cached, dict):
+                from_cache.append((email_id, user_id, cached))
+                continue
+        custom_id = f"r{len(mapping)}"
+        mapping[custom_id] = [email_id, user_id, cache_key]
+        lines.append(json.dumps(
+            {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": payload},
+            ensure_ascii=False,
+        ))
+
+    # Righe senza contenuto: tornano al worker, che scaricherà il messaggio
+    _release(r, missing, requeue=True)
+    if from_cache:
+        await _apply_and_dispatch(r, from_cache)
+    if not lines:
+        r.delete(BATCH_TAKING_KEY)
+        return None
+
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+    try:
+        up = await client.post(
+            f"{OPENAI_BASE_URL}/files",
+            data={"purpose": "batch"},
+            files={"file": ("enrich.jsonl", ("\n".join(lines) + "\n").encode("utf-8"), "application/jsonl")},
+            headers=headers,
+            timeout=120.0,
+        )
+        up.raise_for_status()
+        created = await client.post(
+            f"{OPENAI_BASE_URL}/batches",
+            json={
+                "input_file_id": up.json()["id"],
+                "endpoint": "/v1/chat/completions",
+                "completion_window": BATCH_COMPLETION_WINDOW,
+                "metadata": {"kind": "combined_enrichment", "model": MODEL_COMBINED},
+            },
+            headers=headers,
+        )
+        created.raise_for_status()
+        batch_id = created.json()["id"]
+    except Exception as e:
+        # Invio fallito: rimetti tutto in coda per il prossimo giro
+        logb("submit_failed", count=len(lines), error=str(e))
+        _release(r, [(v[0], v[1]) for v in mapping.values()], requeue=False)
+        for email_id, user_id, _ in mapping.values():
+            enqueue_for_batch(r, email_id, user_id, fresh=(email_id, user_id) in fresh)
+        r.delete(BATCH_TAKING_KEY)
+        return None
+
+    pipe = r.pipeline()
+    pipe.hset(BATCH_INFLIGHT_KEY, batch_id, json.dumps({"created": int(time.time()), "items": mapping}))
+    pipe.delete(BATCH_TAKING_KEY)
+    pipe.execute()
+    metrics.incr("batch.submitted", len(lines))
+    logb("submitted", batch_id=batch_id, count=len(lines), from_cache=len(from_cache), missing=len(missing))
+    return batch_id
+
+
+async def _download_jsonl(client: httpx.AsyncClient, file_id: str | None) -> list[dict]:
+    if not file_id:
+        return []
+    resp = await client.get(
+        f"{OPENAI_BASE_URL}/files/{file_id}/content",
+        headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+        timeout=120.0,
+    )
+    resp.raise_for_status()
+    out = []
+    for line in resp.text.splitlines():
+        line = line.strip()
+        if line:
+            try:
+                out.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return out
+
+
+async def _finalize(r: Redis, client: httpx.AsyncClient, batch_id: str, info: dict, batch: dict) -> None:
+    mapping: dict[str, list[str]] = info.get("items") or {}
+    done: set[str] = set()
+    results: list[tuple[str, str, dict]] = []
+
+    rows = await _download_jsonl(client, batch.get("output_file_id"))
+    for item in rows:
+        custom_id = item.get("custom_id")
+        entry = mapping.get(custom_id or "")
+        resp = item.get("response") or {}
+        if not entry or item.get("error") or int(resp.get("status_code") or 0) != 200:
+            continue
+        email_id, user_id, cache_key = entry
+        n = await asyncio.to_thread(
+            Newsletter.get_or_none, (Newsletter.email_id == email_id) & (Newsletter.user_id == user_id)
+        )
+        _, _, clean_content = build_combined_request(_content_for_row(n)) if n else (None, None, "")
+        res = parse_combined_response(resp.get("body"), clean_content)
+        if res is None:
+            continue
+        await llm_cache_put("combined", cache_key, MODEL_COMBINED, res)
+        results.append((email_id, user_id, res))
+        done.add(cast(str, custom_id))
+
+    if results:
+        await _apply_and_dispatch(r, results)
+
+    # Tutto ciò che non è arrivato (errori, output non valido, batch scaduto) torna al percorso normale
+    failed = [(v[0], v[1]) for k, v in mapping.items() if k not in done]
+    _release(r, failed, requeue=True)
+    if failed:
+        metrics.incr("batch.requeued", len(failed))
+    r.hdel(BATCH_INFLIGHT_KEY, batch_id)
+    logb("finalized", batch_id=batch_id, status=batch.get("status"), applied=len(results), requeued=len(failed))
+
+
+async def poll_inflight(r: Redis, client: httpx.AsyncClient) -> int:
+    """Controlla i batch in volo e chiude quelli terminati. Restituisce quanti ne restano."""
+    inflight = cast(dict, r.hgetall(BATCH_INFLIGHT_KEY)) or {}
+    remaining = 0
+    for batch_id, raw in inflight.items():
+        try:
+            info = json.loads(raw)
+            resp = await client.get(
+                f"{OPENAI_BASE_URL}/batches/{batch_id}",
+                headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+            )
+            resp.raise_for_status()
+            batch = resp.json()
+        except Exception as e:
+            logb("poll_failed", batch_id=batch_id, error=str(e))
+            remaining += 1
+            continue
+        status = batch.get("status")
+        if status in _TERMINAL_STATES:
+            await _finalize(r, client, batch_id, info, batch)
+        else:
+            remaining += 1
+            logb("in_progress", batch_id=batch_id, status=status, counts=batch.get("request_counts"))
+    metrics.set_gauge("batch.inflight", remaining)
+    return remaining
+
+
+async def run_forever(r: Redis) -> None:
+    logging.info("Batch enricher avviato.")
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        while True:
+            try:
+                if not r.set("batch_enrich:lock", os.getpid(), nx=True, ex=BATCH_POLL_SEC * 3):
+                    if r.get("batch_enrich:lock") != str(os.getpid()):
+                        await asyncio.sleep(BATCH_POLL_SEC)
+                        continue
+                    r.expire("batch_enrich:lock", BATCH_POLL_SEC * 3)
+                await poll_inflight(r, client)
+                _restore_taken(r)
+                if should_submit(r):
+                    await submit_pending(r, client)
+                metrics.set_gauge("batch.pending", int(cast(Any, r.llen(BATCH_PENDING_KEY)) or 0))
+            except Exception as e:
+                logging.error(f"Errore nel ciclo batch: {e}", exc_info=True)
+            await asyncio.sleep(BATCH_POLL_SEC)
+
+
+if __name__ == "__main__":
+    from backend.logging_config import setup_logging
+
+    setup_logging("BATCH")
+    redis_client = cast(Redis, redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"), decode_responses=True))
+    metrics.bind_redis(redis_client, "batch")
+    if db.is_closed():
+        db.connect()
+    initialize_db()
+
+    async def _once(cmd: str) -> None:
+        async with httpx.AsyncClient(timeout=60.0) as client:
+            if cmd == "submit":
+                _restore_taken(redis_client)
+                print(await submit_pending(redis_client, client))
+            else:
+                print(await poll_inflight(redis_client, client))
+
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "run"
+    try:
+        if cmd in ("submit", "poll"):
+            asyncio.run(_once(cmd))
+        else:
+            asyncio.run(run_forever(redis_client))
+    except KeyboardInterrupt:
+        logging.info("Batch enricher fermato.")
+    finally:
+        if not db.is_closed():
+            db.close()
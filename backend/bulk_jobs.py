@@ -0,0 +1,220 @@
+# backend/bulk_jobs.py
+"""
+Job di manutenzione sulle email di un utente (update-images, backfill-images,
+recompute-summaries, rehost-external-images) eseguiti in background.
+
+L'endpoint seleziona le righe, chiama runner.submit() e risponde subito con il job_id;
+il job gira nel processo dell'API con al più BULK_JOB_CONCURRENCY email in parallelo
+(e al più BULK_MAX_RUNNING job alla volta, gli altri restano "queued").
+
+- Stato: `bulk:job:<job_id>` (SharedMap, TTL BULK_JOB_TTL) con
+  {job_id, kind, state, total, done, skipped, errors, user_id, created_at, updated_at};
+  GET /api/jobs/{job_id} lo legge da qualunque worker.
+- Scrittura: i risultati si accumulano e vengono scritti a blocchi (BULK_APPLY_EVERY righe
+  o BULK_APPLY_MAX_DELAY_S secondi) con un UPDATE ... CASE per blocco in un'unica
+  transazione (apply_updates), poi un solo bump_feed_version e il push delle card.
+- Avanzamento: dopo ogni blocco, sul topic job_id dell'SSE hub (GET /api/jobs/{job_id}/events)
+  un evento "item" per email {email_id, status: ok|skipped|failed, ...} e un "progress"
+  con lo stato del job; a fine job "progress" con state done/failed chiude lo stream.
+
+Un job interrotto da un riavvio resta "running" fino alla scadenza del TTL: il client lo
+rilancia (le email già aggiornate vengono scartate dai filtri only_empty/only_missing).
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable
+
+from peewee import Case
+
+from backend import metrics, feed_push
+from backend.database import db, Newsletter
+from backend.feed_cache import bump_feed_version
+from backend.shared_state import SharedMap
+from backend.sse_hub import publish as sse_publish
+
+BULK_JOB_CONCURRENCY = int(os.getenv("BULK_JOB_CONCURRENCY", "4"))
+BULK_MAX_RUNNING = int(os.getenv("BULK_MAX_RUNNING", "2"))
+BULK_JOB_TTL = int(os.getenv("BULK_JOB_TTL", str(24 * 3600)))
+BULK_APPLY_EVERY = int(os.getenv("BULK_APPLY_EVERY", "25"))
+BULK_APPLY_MAX_DELAY_S = float(os.getenv("BULK_APPLY_MAX_DELAY_S", "2"))
+
+_UPDATE_CHUNK = 50  # email per UPDATE: 2 variabili per campo e per email, sotto le 999 variabili di SQLite
+
+FINAL_STATES = ("done", "failed")
+
+JOBS = SharedMap("bulk_jobs", ttl=BULK_JOB_TTL, local_ttl=0, prefix="bulk:job:")
+
+# handler(riga) -> None (email saltata) oppure (campi da aggiornare, info per l'evento "item")
+Handler = Callable[[Any], Awaitable[tuple[dict[str, Any], dict[str, Any]] | None]]
+
+
+def get(job_id: str) -> dict[str, Any] | None:
+    if not job_id:
+        return None
+    return JOBS.get(job_id)
+
+
+def apply_updates(user_id: str, updates: dict[str, dict[str, Any]]) -> int:
+    """
+    Scrive {email_id: {campo: valore}} con un UPDATE per blocco di email:
+    SET campo = CASE email_id WHEN ... THEN ... ELSE campo END. Una transazione. Bloccante.
+    """
+    if not updates:
+        return 0
+    ids = list(updates)
+    n = 0
+    with db.atomic():
+        for i in range(0, len(ids), _UPDATE_CHUNK):
+            chunk = ids[i:i + _UPDATE_CHUNK]
+            fields: dict[str, list[tuple[str, Any]]] = {}
+            for email_id in chunk:
+                for name, value in updates[email_id].items():
+                    fields.setdefault(name, []).append((email_id, value))
+            if not fields:
+                continue
+            values = {}
+            for name, whens in fields.items():
+                col = getattr(Newsletter, name)
+                values[col] = Case(Newsletter.email_id, whens, col)
+            n += (Newsletter.update(values)
+                  .where((Newsletter.user_id == user_id) & (Newsletter.email_id.in_(chunk)))
+                  .execute())
+    return n
+
+
+class BulkRunner:
+    """Esegue i job in background nel processo dell'API (task asyncio)."""
+
+    def __init__(self) -> None:
+        self._tasks: set[asyncio.Task] = set()
+        self._running: asyncio.Semaphore | None = None
+        self._redis: Any = None
+
+    def bind(self, redis_client: Any) -> None:
+        self._redis = redis_client
+
+    def submit(self, kind: str, user_id: str, rows: list[Any], handler: Handler) -> dict[str, Any]:
+        """Registra il job e lo avvia in background. Restituisce lo stato iniziale."""
+        if self._running is None:
+            self._running = asyncio.Semaphore(max(1, BULK_MAX_RUNNING))
+        job_id = uuid.uuid4().hex
+        now = int(time.time())
+        st = {"job_id": job_id, "kind": kind, "state": "queued", "total": len(rows),
+              "done": 0, "skipped": 0, "errors": 0, "user_id": user_id,
+              "created_at": now, "updated_at": now}
+        JOBS[job_id] = st
+        task = asyncio.create_task(self._run(st, rows, handler), name=f"bulk-{kind}-{job_id[:8]}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        metrics.incr(f"bulk.jobs.{kind}")
+        logging.info(f"[BULK] job {job_id} {kind} per {user_id}: {len(rows)} email")
+        return st
+
+    def _save(self, st: dict[str, Any]) -> dict[str, Any]:
+        st["updated_at"] = int(time.time())
+        JOBS[st["job_id"]] = st
+        return st
+
+    def _publish(self, st: dict[str, Any], items: list[dict[str, Any]]) -> None:
+        """Eventi "item" del blocco e "progress" del job (bloccante, da to_thread)."""
+        job_id = st["job_id"]
+        try:
+            for it in items:
+                sse_publish(self._redis, job_id, "item", it)
+            sse_publish(self._redis, job_id, "progress", st)
+        except Exception as e:
+            logging.warning(f"[BULK] publish fallito per il job {job_id}: {e}")
+
+    def _commit(self, st: dict[str, Any], results: list[tuple[str, tuple | None, str | None]]) -> None:
+        """Scrive un blocco di risultati, aggiorna lo stato e pubblica gli eventi. Bloccante."""
+        user_id = st["user_id"]
+        updates = {eid: res[0] for eid, res, _err in results if res is not None and res[0]}
+        items: list[dict[str, Any]] = []
+        try:
+            apply_updates(user_id, updates)
+        except Exception as e:
+            logging.error(f"[BULK] scrittura del blocco fallita per il job {st['job_id']}: {e}", exc_info=True)
+            results = [(eid, None, err or f"db: {e}") if eid in updates else (eid, res, err)
+                       for eid, res, err in results]
+            updates = {}
+        for email_id, res, err in results:
+            if err is not None:
+                st["errors"] += 1
+                items.append({"email_id": email_id, "status": "failed", "error": err})
+            elif res is None:
+                st["skipped"] += 1
+                items.append({"email_id": email_id, "status": "skipped"})
+            else:
+                st["done"] += 1
+                items.append({"email_id": email_id, "status": "ok", **res[1]})
+        if updates:
+            bump_feed_version(self._redis, user_id)
+            for email_id in updates:
+                feed_push.push_card(self._redis, user_id, email_id)
+        self._publish(self._save(st), items)
+
+    async def _run(self, st: dict[str, Any], rows: list[Any], handler: Handler) -> None:
+        assert self._running is not None
+        t0 = time.perf_counter()
+        pending: list[tuple[str, tuple | None, str | None]] = []
+        flush_lock = asyncio.Lock()
+        last_flush = time.monotonic()
+
+        async def flush() -> None:
+            nonlocal pending, last_flush
+            async with flush_lock:
+                if not pending:
+                    return
+                batch, pending = pending, []
+                last_flush = time.monotonic()
+                await asyncio.to_thread(self._commit, st, batch)
+
+        sem = asyncio.Semaphore(max(1, BULK_JOB_CONCURRENCY))
+
+        async def one(row: Any) -> None:
+            async with sem:
+                try:
+                    res, err = await handler(row), None
+                except Exception as e:
+                    logging.warning(f"[BULK] {st['kind']} fallito per {row.email_id}: {e}")
+                    res, err = None, str(e) or type(e).__name__
+            pending.append((row.email_id, res, err))
+            if len(pending) >= BULK_APPLY_EVERY or time.monotonic() - last_flush >= BULK_APPLY_MAX_DELAY_S:
+                await flush()
+
+        async with self._running:
+            st["state"] = "running"
+            await asyncio.to_thread(self._publish, self._save(st), [])
+            try:
+                await asyncio.gather(*(one(r) for r in rows))
+                await flush()
+                st["state"] = "done"
+            except asyncio.CancelledError:
+                st["state"], st["reason"] = "failed", "shutdown"
+                self._save(st)
+                raise
+            except Exception as e:
+                logging.error(f"[BULK] job {st['job_id']} fallito: {e}", exc_info=True)
+                st["state"], st["reason"] = "failed", str(e)
+            await asyncio.to_thread(self._publish, self._save(st), [])
+        metrics.incr("bulk.items.ok", st["done"])
+        metrics.incr("bulk.items.failed", st["errors"])
+        logging.info(f"[BULK] job {st['job_id']} {st['kind']} {st['state']}: "
+                     f"ok={st['done']} saltate={st['skipped']} errori={st['errors']} su {st['total']} "
+                     f"in {int((time.perf_counter() - t0) * 1000)}ms")
+
+    async def stop(self) -> None:
+        for t in list(self._tasks):
+            t.cancel()
+        for t in list(self._tasks):
+            try:
+                await t
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks.clear()
+
+
+runner = BulkRunner()
@@ -0,0 +1,207 @@
+# backend/content_condense.py
+"""
+Condensazione del contenuto delle email prima dei prompt AI.
+
+Invece di troncare ai primi N caratteri (spesso pieni di preheader, "view in browser",
+menu e footer), il testo viene diviso in blocchi (paragrafi, voci di elenco, celle),
+i blocchi di boilerplate vengono scartati, gli altri ricevono un punteggio di
+informatività e i migliori vengono impacchettati, nell'ordine originale, entro un
+budget di token per chiamata.
+
+Il conteggio token usa tiktoken (requirements.txt; l'encoding o200k_base viene scaricato
+nell'immagine al build, vedi Dockerfile). Se l'encoding non si carica resta una stima locale
+prudente (~3 caratteri/token): su testo italiano, accentato o con URL un token copre spesso
+meno di 4 caratteri, e contare qualche token in più tiene i prompt dentro i budget AI_TOKENS_*.
+"""
+import functools
+import logging
+import math
+import re
+from collections import Counter
+
+from bs4 import BeautifulSoup
+
+_BLOCK_TAGS = [
+    "p", "li", "h1", "h2", "h3", "h4", "h5", "h6", "td", "th", "div", "section",
+    "article", "blockquote", "pre", "table", "tr", "ul", "ol", "dd", "dt",
+]
+_DROP_TAGS = ["script", "style", "head", "title", "meta", "nav", "form", "noscript", "svg"]
+_SEP = "\u0000"
+
+_BOILERPLATE_RE = re.compile(
+    r"unsubscribe|disiscriv|cancella(re)? (la tua )?iscrizione|annulla (l')?iscrizione"
+    r"|view (it |this (email |message )?)?(in|on) (your |a )?(web )?browser|visualizza (nel|sul|online)|leggi online|versione web"
+    r"|privacy policy|informativa (sulla )?privacy|termini e condizioni|terms of (service|use)"
+    r"|all rights reserved|tutti i diritti riservati|©|copyright"
+    r"|you (are receiving|received) this|ricevi questa (e-?mail|newsletter)|hai ricevuto questa"
+    r"|update (your )?preferences|manage (your )?(subscription|preferences)|gestisci (le )?(tue )?preferenze"
+    r"|forward (this )?to a friend|inoltra a un amico|sent from my (iphone|android)"
+    r"|questo messaggio è confidenziale|non rispondere a questa e-?mail|do not reply to this e-?mail"
+    r"|add us to your address book|aggiungi(ci)? (alla tua )?rubrica",
+    re.IGNORECASE,
+)
+_META_HEAD_RE = re.compile(r"\A(FROM:[^\n]*\nSUBJECT:[^\n]*\n)\n?")
+_WORD_RE = re.compile(r"[A-Za-zÀ-ÖØ-öø-ÿ0-9]{2,}")
+_STOP = {
+    "il", "lo", "la", "gli", "le", "un", "una", "di", "da", "in", "con", "su", "per", "tra", "fra",
+    "e", "o", "ma", "che", "non", "si", "del", "della", "dei", "delle", "al", "alla", "nel", "nella",
+    "è", "sono", "come", "anche", "più", "questo", "questa", "the", "a", "an", "of", "to", "and",
+    "or", "on", "for", "with", "is", "are", "this", "that", "you", "your", "we", "our", "it",
+}
+
+# Stima senza tiktoken: per difetto sui caratteri per token, così i budget restano rispettati
+_EST_CHARS_PER_TOKEN = 3
+
+# Blocchi lunghi (es. testo semplice senza righe vuote) vengono spezzati in gruppi di frasi
+_MAX_BLOCK_CHARS = 1200
+_BOILERPLATE_MAX_CHARS = 400
+
+
+@functools.lru_cache(maxsize=1)
+def _encoder():
+    try:
+        import tiktoken  # type: ignore
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning(f"[CONDENSE] tiktoken non disponibile ({e}): uso la stima di {_EST_CHARS_PER_TOKEN} caratteri/token")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Numero di token del testo (tiktoken se disponibile, altrimenti stima per eccesso)."""
+    if not text:
+        return 0
+    enc = _encoder()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / _EST_CHARS_PER_TOKEN)
+
+
+def _truncate_to_tokens(text: str, budget: int) -> str:
+    if budget <= 0:
+        return ""
+    enc = _encoder()
+    if enc is not None:
+        ids = enc.encode(text, disallowed_special=())
+        return text if len(ids) <= budget else enc.decode(ids[:budget])
+    return text[: budget * _EST_CHARS_PER_TOKEN]
+
+
+def _split_long(block: str) -> list[str]:
+    if len(block) <= _MAX_BLOCK_CHARS:
+        return [block]
+    sentences = re.split(r"(?<=[.!?])\s+", block)
+    out, cur = [], ""
+    for s in sentences:
+        if cur and len(cur) + len(s) > _MAX_BLOCK_CHARS // 3:
+            out.append(cur)
+            cur = s
+        else:
+            cur = f"{cur} {s}".strip()
+    if cur:
+        out.append(cur)
+    # frasi singole enormi (testo senza punteggiatura): taglio secco
+    return [p[i:i + _MAX_BLOCK_CHARS] for p in out for i in range(0, len(p), _MAX_BLOCK_CHARS)]
+
+
+@functools.lru_cache(maxsize=32)
+def extract_blocks(content: str) -> tuple[str, ...]:
+    """Divide HTML o testo in blocchi normalizzati (ordine originale, duplicati rimossi)."""
+    if re.search(r"<[a-zA-Z][^>]*>", content):
+        soup = BeautifulSoup(content, "html.parser")
+        for el in soup(_DROP_TAGS):
+            el.extract()
+        # preheader/elementi nascosti
+        for el in soup.select('[style*="display:none"], [style*="display: none"]'):
+            el.extract()
+        for br in soup.find_all("br"):
+            br.replace_with("\n")
+        for el in soup.find_all(_BLOCK_TAGS):
+            el.insert_before(_SEP)
+            el.insert_after(_SEP)
+        text = soup.get_text()
+    else:
+        text = content
+    raw = re.split(rf"{_SEP}|\n\s*\n", text)
+
+    seen: set[str] = set()
+    blocks: list[str] = []
+    for b in raw:
+        b = " ".join(b.split())
+        if not b:
+            continue
+        for part in _split_long(b):
+            key = part.lower()
+            if key in seen:
+                continue
+            seen.add(key)
+            blocks.append(part)
+    return tuple(blocks)
+
+
+def is_boilerplate(block: str) -> bool:
+    return len(block) <= _BOILERPLATE_MAX_CHARS and bool(_BOILERPLATE_RE.search(block))
+
+
+def _score(block: str, idx: int, hint_terms: set[str], doc_freq: Counter) -> float:
+    words = [w.lower() for w in _WORD_RE.findall(block)]
+    if len(words) < 4:
+        return 0.0  # link, bottoni, etichette
+    content = [w for w in words if w not in _STOP]
+    if not content:
+        return 0.0
+    length = min(len(words), 80) / 80
+    density = len(set(content)) / len(words)
+    # Parole ripetute in tutto il documento (menu, firme) valgono meno
+    rarity = sum(1.0 / doc_freq[w] for w in set(content)) / len(set(content))
+    position = 1.0 / (1.0 + 0.04 * idx)
+    overlap = (len(hint_terms & set(content)) / len(hint_terms)) if hint_terms else 0.0
+    return (0.45 * length + 0.35 * density + 0.2 * rarity) * position + 0.3 * overlap
+
+
+def condense_for_ai(content: str, budget_tokens: int, hint: str = "") -> str:
+    """
+    Restituisce il testo più informativo di `content` (HTML o testo) entro `budget_tokens`.
+    Un'eventuale intestazione "FROM: …\\nSUBJECT: …" iniziale viene sempre mantenuta e il
+    soggetto usato come suggerimento per il punteggio. I blocchi scelti restano in ordine.
+    """
+    content = content or ""
+    head = ""
+    m = _META_HEAD_RE.match(content)
+    if m:
+        head = m.group(1)
+        content = content[m.end():]
+        subj = re.search(r"SUBJECT:([^\n]*)", head)
+        hint = f"{hint} {subj.group(1) if subj else ''}"
+
+    budget = budget_tokens - count_tokens(head)
+    blocks = [b for b in extract_blocks(content) if not is_boilerplate(b)]
+    if not blocks or budget <= 0:
+        return head.strip()
+
+    doc_freq: Counter = Counter()
+    for b in blocks:
+        doc_freq.update({w.lower() for w in _WORD_RE.findall(b)})
+    hint_terms = {w.lower() for w in _WORD_RE.findall(hint)} - _STOP
+
+    scores = [_score(b, i, hint_terms, doc_freq) for i, b in enumerate(blocks)]
+    # Link, bottoni e menu (punteggio nullo) si tengono solo se non c'è altro
+    keep = [i for i, sc in enumerate(scores) if sc > 0] or list(range(len(blocks)))
+    costs = {i: count_tokens(blocks[i]) + 1 for i in keep}
+
+    parts: dict[int, str] = {}
+    if sum(costs.values()) <= budget:
+        parts = {i: blocks[i] for i in keep}
+    else:
+        used = 0
+        for i in sorted(keep, key=lambda i: scores[i], reverse=True):
+            if used + costs[i] <= budget:
+                parts[i] = blocks[i]
+                used += costs[i]
+            elif not parts:
+                # Il blocco migliore non entra intero: ne prendo l'inizio
+                parts[i] = _truncate_to_tokens(blocks[i], budget)
+                used = budget
+
+    body = "\n\n".join(parts[i] for i in sorted(parts))
+    return f"{head}\n{body}".strip() if head else body
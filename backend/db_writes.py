@@ -0,0 +1,143 @@
+# backend/db_writes.py
+"""
+Scritture a blocchi sulla tabella newsletter, per ridurre transazioni (e fsync) e la
+contesa del lock di scrittura di SQLite con l'API.
+
+- insert_stubs(): righe segnaposto delle email appena scoperte (ingestor, kickstart,
+  run_ingest_job) con INSERT ... ON CONFLICT DO NOTHING a blocchi in una transazione,
+  invece di un get_or_create (SELECT + INSERT) per email.
+- WriteBehind: buffer del worker. update() unisce i campi con quelli già in attesa per la
+  stessa email (un solo UPDATE per email) e restituisce un future che si risolve a commit
+  avvenuto (True) o fallito (False, errore nel log). Il buffer viene scritto in un'unica
+  transazione dopo WRITE_BEHIND_MAX_DELAY_MS dal primo aggiornamento o appena raggiunge
+  WRITE_BEHIND_MAX_ROWS email. Chi deve leggere il dato dal DB subito dopo (push della card,
+  batch) attende il future; gli altri proseguono.
+
+Se la transazione del blocco fallisce, le email vengono riscritte una per una, così un
+errore su una riga non fa perdere le altre.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Iterable
+
+from backend import metrics
+from backend.database import db, Newsletter
+
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "100"))
+WRITE_BEHIND_MAX_DELAY_MS = int(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", "250"))
+
+_INSERT_CHUNK = 100  # poche colonne per riga: ben sotto il limite di variabili di SQLite
+
+Key = tuple[str, str]  # (email_id, user_id)
+
+
+def insert_stubs(user_id: str, email_ids: Iterable[str], **defaults: Any) -> int:
+    """
+    Crea le righe mancanti (email_id, user_id, **defaults) con INSERT ... ON CONFLICT DO NOTHING;
+    le righe già presenti restano invariate. Una transazione. Restituisce quante email ha passato.
+    """
+    rows = [{"email_id": e, "user_id": user_id, **defaults} for e in dict.fromkeys(email_ids) if e]
+    if not rows:
+        return 0
+    with db.atomic():
+        for i in range(0, len(rows), _INSERT_CHUNK):
+            Newsletter.insert_many(rows[i:i + _INSERT_CHUNK]).on_conflict_ignore().execute()
+    return len(rows)
+
+
+def _update_one(key: Key, fields: dict[str, Any]) -> None:
+    email_id, user_id = key
+    (Newsletter.update(**fields)
+     .where((Newsletter.email_id == email_id) & (Newsletter.user_id == user_id))
+     .execute())
+
+
+class WriteBehind:
+    """Buffer degli UPDATE per email del worker, scritto a blocchi in una transazione."""
+
+    def __init__(self) -> None:
+        self._pending: dict[Key, dict[str, Any]] = {}
+        self._futures: dict[Key, asyncio.Future] = {}
+        self._lock: asyncio.Lock | None = None
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def update(self, email_id: str, user_id: str, **fields: Any) -> asyncio.Future:
+        """Accoda l'UPDATE dei campi dell'email. Il future si risolve con True a commit avvenuto."""
+        loop = asyncio.get_running_loop()
+        key = (email_id, user_id)
+        if key in self._pending:
+            self._pending[key].update(fields)
+            metrics.incr("db.write_behind.coalesced")
+        else:
+            self._pending[key] = dict(fields)
+            self._futures[key] = loop.create_future()
+        fut = self._futures[key]
+        if len(self._pending) >= WRITE_BEHIND_MAX_ROWS:
+            self._schedule()
+        elif self._timer is None:
+            self._timer = loop.call_later(WRITE_BEHIND_MAX_DELAY_MS / 1000, self._schedule)
+        return fut
+
+    def _schedule(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self) -> int:
+        """Scrive le email in attesa in un'unica transazione. Restituisce quante ne ha scritte."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Un blocco alla volta, nell'ordine: un aggiornamento non scavalca quello precedente
+        async with self._lock:
+            if not self._pending:
+                return 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, futures = self._pending, self._futures
+            self._pending, self._futures = {}, {}
+            t0 = time.perf_counter()
+            results = await asyncio.to_thread(self._apply, pending)
+            for key, fut in futures.items():
+                if not fut.done():
+                    fut.set_result(results.get(key, False))
+            metrics.incr("db.write_behind.flushes")
+            metrics.incr("db.write_behind.rows", len(pending))
+            logging.debug(f"[DB] write-behind: {len(pending)} email in {int((time.perf_counter() - t0) * 1000)}ms")
+            return len(pending)
+
+    @staticmethod
+    def _apply(pending: dict[Key, dict[str, Any]]) -> dict[Key, bool]:
+        try:
+            with db.atomic():
+                for key, fields in pending.items():
+                    _update_one(key, fields)
+            return {key: True for key in pending}
+        except Exception as e:
+            logging.warning(f"[DB] write-behind: transazione di {len(pending)} email fallita ({e}), riprovo una per una")
+        results: dict[Key, bool] = {}
+        for key, fields in pending.items():
+            try:
+                with db.atomic():
+                    _update_one(key, fields)
+                results[key] = True
+            except Exception as e:
+                logging.error(f"[DB] write-behind: aggiornamento di {key[0]} fallito: {e}")
+                metrics.incr("db.write_behind.failed")
+                results[key] = False
+        return results
+
+    async def close(self) -> None:
+        """Scrive quanto resta nel buffer (alla chiusura del worker)."""
+        for t in list(self._tasks):
+            try:
+                await t
+            except Exception:
+                pass
+        await self.flush()
@@ -0,0 +1,286 @@
+# backend/domain_profiles.py
+"""
+Memoizzazione della classificazione per mittente.
+
+Lo stesso dominio produce quasi sempre lo stesso type_tag (e spesso lo stesso topic_tag):
+per ogni (utente, host del mittente) e, a livello globale, per ogni source_domain radice
+teniamo in `domain_profile` i conteggi delle etichette già assegnate. Quando la
+distribuzione è abbastanza stabile il worker riusa l'etichetta e salta la chiamata LLM.
+
+Gli override utente (DomainTypeOverride) vengono letti dalla stessa cache in-process,
+un dizionario per utente invece di una query per email. Quando un override cambia,
+l'API incrementa la chiave Redis `domain_profiles:ver` e gli altri processi svuotano la cache.
+
+Avvio manuale: python -m backend.domain_profiles rebuild      (ricostruisce dalla storia)
+               python -m backend.domain_profiles show <dominio> [user_id]
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any
+
+from backend.database import db, DomainProfile, DomainTypeOverride, IS_POSTGRES, sql_true, sql_false
+
+GLOBAL_USER = "*"
+PROFILE_VERSION_KEY = "domain_profiles:ver"
+
+DOMAIN_PROFILE_ENABLED = os.getenv("DOMAIN_PROFILE_ENABLED", "1") == "1"
+DOMAIN_PROFILE_MIN_SAMPLES = int(os.getenv("DOMAIN_PROFILE_MIN_SAMPLES", "8"))
+DOMAIN_PROFILE_GLOBAL_MIN_SAMPLES = int(os.getenv("DOMAIN_PROFILE_GLOBAL_MIN_SAMPLES", "20"))
+DOMAIN_PROFILE_MIN_SHARE = float(os.getenv("DOMAIN_PROFILE_MIN_SHARE", "0.9"))
+DOMAIN_PROFILE_MAX_SAMPLES = int(os.getenv("DOMAIN_PROFILE_MAX_SAMPLES", "200"))  # oltre, i conteggi si dimezzano
+DOMAIN_PROFILE_TTL = int(os.getenv("DOMAIN_PROFILE_TTL", "300"))
+_VERSION_CHECK_SEC = 5.0
+
+_LOCK = threading.Lock()
+_overrides: dict[str, tuple[float, dict[str, str]]] = {}             # user_id -> (caricato_il, {host: type})
+_profiles: dict[tuple[str, str], tuple[float, dict | None]] = {}      # (user_id, domain) -> (caricato_il, profilo)
+_version: str | None = None
+_version_checked = 0.0
+
+
+def sender_host(sender_email: str | None) -> str:
+    """Host del mittente ('news@mail.substack.com' -> 'mail.substack.com'), come per gli override."""
+    s = (sender_email or "").strip().lower()
+    return s.split("@")[-1] if "@" in s else ""
+
+
+def _invalidate_all() -> None:
+    with _LOCK:
+        _overrides.clear()
+        _profiles.clear()
+
+
+def _check_version(r: Any) -> None:
+    """Svuota la cache se un altro processo ha cambiato gli override (controllo al massimo ogni 5s)."""
+    global _version, _version_checked
+    if r is None:
+        return
+    now = time.monotonic()
+    if now - _version_checked < _VERSION_CHECK_SEC:
+        return
+    _version_checked = now
+    try:
+        v = r.get(PROFILE_VERSION_KEY)
+    except Exception as e:
+        logging.debug(f"[domain_profiles] lettura versione fallita: {e}")
+        return
+    v = str(v) if v is not None else None
+    if v != _version:
+        if _version is not None:
+            _invalidate_all()
+        _version = v
+
+
+def bump_version(r: Any) -> None:
+    """Da chiamare dopo ogni modifica di DomainTypeOverride."""
+    _invalidate_all()
+    if r is None:
+        return
+    try:
+        r.incr(PROFILE_VERSION_KEY)
+    except Exception as e:
+        logging.warning(f"[domain_profiles] incremento versione fallito: {e}")
+
+
+def _user_overrides(user_id: str) -> dict[str, str]:
+    now = time.monotonic()
+    with _LOCK:
+        hit = _overrides.get(user_id)
+    if hit and now - hit[0] < DOMAIN_PROFILE_TTL:
+        return hit[1]
+    rows = {
+        o.domain.lower(): o.type_tag
+        for o in DomainTypeOverride.select().where(DomainTypeOverride.user_id == user_id)
+    }
+    with _LOCK:
+        _overrides[user_id] = (now, rows)
+    return rows
+
+
+def _row_to_profile(row: DomainProfile | None) -> dict | None:
+    if not row:
+        return None
+    try:
+        return {
+            "samples": int(row.samples or 0),
+            "type_counts": json.loads(row.type_counts or "{}"),
+            "topic_counts": json.loads(row.topic_counts or "{}"),
+        }
+    except ValueError:
+        return None
+
+
+def _profile(user_id: str, domain: str) -> dict | None:
+    now = time.monotonic()
+    key = (user_id, domain)
+    with _LOCK:
+        hit = _profiles.get(key)
+    if hit and now - hit[0] < DOMAIN_PROFILE_TTL:
+        return hit[1]
+    prof = _row_to_profile(DomainProfile.get_or_none((DomainProfile.user_id == user_id) & (DomainProfile.domain == domain)))
+    with _LOCK:
+        _profiles[key] = (now, prof)
+    return prof
+
+
+def _stable_label(counts: dict[str, int], min_samples: int) -> str | None:
+    total = sum(counts.values())
+    if total < min_samples:
+        return None
+    label, top = max(counts.items(), key=lambda kv: kv[1])
+    return label if top / total >= DOMAIN_PROFILE_MIN_SHARE else None
+
+
+def override_for(user_id: str, sender_domain: str, r: Any = None) -> str | None:
+    """type_tag imposto dall'utente per l'host del mittente, se esiste."""
+    if not user_id or not sender_domain:
+        return None
+    _check_version(r)
+    return _user_overrides(user_id).get(sender_domain.lower())
+
+
+def lookup(user_id: str, sender_domain: str, source_domain: str | None = None, r: Any = None) -> dict:
+    """
+    Etichette note per il mittente:
+      {"override": type|None, "type_tag": type|None, "topic_tag": topic|None, "source": "user"|"global"|None}
+    type_tag/topic_tag sono valorizzati solo se la distribuzione storica è stabile
+    (il type_tag tiene già conto dell'override). Bloccante: chiamare via asyncio.to_thread.
+    """
+    out: dict[str, Any] = {"override": None, "type_tag": None, "topic_tag": None, "source": None}
+    sender_domain = (sender_domain or "").lower()
+    source_domain = (source_domain or "").lower()
+    out["override"] = override_for(user_id, sender_domain, r)
+    if not DOMAIN_PROFILE_ENABLED:
+        out["type_tag"] = out["override"]
+        return out
+
+    candidates = []
+    if sender_domain:
+        candidates.append((user_id, sender_domain, DOMAIN_PROFILE_MIN_SAMPLES, "user"))
+    if source_domain:
+        candidates.append((GLOBAL_USER, source_domain, DOMAIN_PROFILE_GLOBAL_MIN_SAMPLES, "global"))
+    for uid, dom, min_samples, source in candidates:
+        prof = _profile(uid, dom)
+        if not prof:
+            continue
+        type_tag = out["override"] or _stable_label(prof["type_counts"], min_samples)
+        topic_tag = _stable_label(prof["topic_counts"], min_samples)
+        if type_tag and topic_tag:
+            out.update(type_tag=type_tag, topic_tag=topic_tag, source=source)
+            return out
+    out["type_tag"] = out["override"]
+    return out
+
+
+def _bump_counts(counts: dict[str, int], label: str | None) -> dict[str, int]:
+    if label:
+        counts[label] = counts.get(label, 0) + 1
+    if sum(counts.values()) > DOMAIN_PROFILE_MAX_SAMPLES:
+        # Dimezza i conteggi: la storia recente pesa di più e i cambi di linea emergono
+        counts = {k: v // 2 for k, v in counts.items() if v // 2 > 0}
+    return counts
+
+
+def _record_one(user_id: str, domain: str, type_tag: str | None, topic_tag: str | None, now: int) -> None:
+    row = DomainProfile.get_or_none((DomainProfile.user_id == user_id) & (DomainProfile.domain == domain))
+    prof = _row_to_profile(row) or {"samples": 0, "type_counts": {}, "topic_counts": {}}
+    type_counts = _bump_counts(prof["type_counts"], type_tag)
+    topic_counts = _bump_counts(prof["topic_counts"], topic_tag)
+    fields = {
+        DomainProfile.samples: sum(type_counts.values()),
+        DomainProfile.type_counts: json.dumps(type_counts),
+        DomainProfile.topic_counts: json.dumps(topic_counts),
+        DomainProfile.updated_at: now,
+    }
+    (DomainProfile
+     .insert(user_id=user_id, domain=domain, **{f.name: v for f, v in fields.items()})
+     .on_conflict(conflict_target=[DomainProfile.user_id, DomainProfile.domain], update=fields)
+     .execute())
+    with _LOCK:
+        _profiles[(user_id, domain)] = (time.monotonic(), {
+            "samples": fields[DomainProfile.samples], "type_counts": type_counts, "topic_counts": topic_counts,
+        })
+
+
+def record(user_id: str, sender_domain: str, source_domain: str | None, type_tag: str | None, topic_tag: str | None) -> None:
+    """Aggiunge le etichette assegnate da classificatore/LLM al profilo utente e a quello globale."""
+    if not DOMAIN_PROFILE_ENABLED or not (type_tag or topic_tag):
+        return
+    now = int(time.time())
+    with db.atomic():
+        if sender_domain:
+            _record_one(user_id, sender_domain.lower(), type_tag, topic_tag, now)
+        if source_domain:
+            _record_one(GLOBAL_USER, source_domain.lower(), type_tag, topic_tag, now)
+
+
+def rebuild() -> int:
+    """Ricalcola tutti i profili dalle righe già arricchite. Restituisce il numero di profili."""
+    if IS_POSTGRES:
+        # Niente '%' letterali: psycopg2 interpreta comunque i segnaposto della query
+        host, has_at = "lower(split_part(sender_email, '@', 2))", "strpos(sender_email, '@') > 0"
+    else:
+        host, has_at = "lower(substr(sender_email, instr(sender_email, '@') + 1))", "sender_email LIKE '%@%'"
+    base = f"FROM newsletter WHERE {sql_true('enriched')} AND {sql_false('is_deleted')} AND type_tag IS NOT NULL"
+    queries = [
+        f"SELECT user_id, {host}, type_tag, topic_tag, COUNT(*) {base} AND {has_at} GROUP BY 1, 2, 3, 4",
+        f"SELECT '{GLOBAL_USER}', lower(source_domain), type_tag, topic_tag, COUNT(*) {base} "
+        f"AND source_domain IS NOT NULL AND source_domain != '' GROUP BY 2, 3, 4",
+    ]
+    acc: dict[tuple[str, str], dict[str, dict[str, int]]] = {}
+    for sql in queries:
+        for uid, dom, type_tag, topic_tag, cnt in db.execute_sql(sql).fetchall():
+            if not dom:
+                continue
+            p = acc.setdefault((uid, dom), {"type": {}, "topic": {}})
+            p["type"][type_tag] = p["type"].get(type_tag, 0) + cnt
+            if topic_tag:
+                p["topic"][topic_tag] = p["topic"].get(topic_tag, 0) + cnt
+
+    now = int(time.time())
+    rows = [
+        {
+            "user_id": uid, "domain": dom, "samples": sum(p["type"].values()),
+            "type_counts": json.dumps(p["type"]), "topic_counts": json.dumps(p["topic"]), "updated_at": now,
+        }
+        for (uid, dom), p in acc.items()
+    ]
+    with db.atomic():
+        DomainProfile.delete().execute()
+        for i in range(0, len(rows), 200):
+            DomainProfile.insert_many(rows[i:i + 200]).execute()
+    _invalidate_all()
+    return len(rows)
+
+
+def ensure_built() -> None:
+    """Alla prima esecuzione (tabella vuota) costruisce i profili dalla storia esistente."""
+    if not DOMAIN_PROFILE_ENABLED:
+        return
+    try:
+        if not DomainProfile.select().limit(1).exists():
+            n = rebuild()
+            logging.info(f"[domain_profiles] profili costruiti dalla storia: {n}")
+    except Exception as e:
+        logging.warning(f"[domain_profiles] costruzione iniziale fallita: {e}")
+
+
+if __name__ == "__main__":
+    from backend.database import initialize_db
+
+    logging.basicConfig(level=logging.INFO)
+    initialize_db()
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+    if cmd == "rebuild":
+        print(f"Profili ricostruiti: {rebuild()}")
+    elif cmd == "show" and len(sys.argv) > 2:
+        dom = sys.argv[2].lower()
+        uid = sys.argv[3] if len(sys.argv) > 3 else GLOBAL_USER
+        print(json.dumps({"profile": _profile(uid, dom), "lookup": lookup(uid, dom, dom)}, indent=2, ensure_ascii=False))
+    else:
+        print("Uso: python -m backend.domain_profiles rebuild | show <dominio> [user_id]")
+        sys.exit(2)
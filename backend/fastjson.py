@@ -0,0 +1,169 @@
+# backend/fastjson.py
+"""
+Serializzazione JSON veloce per le risposte API e i log strutturati.
+
+Usa orjson (in requirements.txt; datetime serializzati nativamente in ISO-8601 UTC con 'Z',
+naive trattati come UTC). Se manca (es. script lanciati fuori dall'immagine) ripiega sul json
+della stdlib con separatori compatti e lo stesso formato per le date: l'output è identico,
+solo più lento.
+
+- dumps(obj) -> bytes, dumps_str(obj) -> str (per logging)
+- iso_utc(value): normalizza datetime/stringhe ISO in 'YYYY-MM-DDTHH:MM:SS[.ffffff]Z',
+  con un percorso rapido per le stringhe '... +00:00' che SQLite restituisce per i DateTimeField
+- FastJSONResponse: JSONResponse di Starlette che rende con dumps()
+
+Benchmark sulle pagine del feed (50 card): python -m backend.fastjson [--items 50] [--rounds 2000]
+"""
+import json
+import re
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from typing import Any, Callable
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover - dipende dall'ambiente
+    orjson = None
+
+_ORJSON_OPTS = (orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+# '2025-09-21 22:23:00+00:00' / '2025-09-21T22:23:00.123000+00:00' / '...Z'
+_UTC_STR_RE = re.compile(r"^\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(\.\d{1,6})?(\+00:00|Z)$")
+
+
+def _iso_dt(dt: datetime) -> str:
+    dt = dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def iso_utc(value: Any) -> str | None:
+    """Stringa ISO-8601 in UTC da datetime o stringa ISO-like (le stringhe non parsabili restano com'erano)."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return _iso_dt(value)
+    if isinstance(value, str):
+        s = value.strip()
+        if _UTC_STR_RE.match(s):
+            # Già in UTC: basta sistemare separatore e suffisso, senza passare da datetime
+            return s[:10] + "T" + (s[11:-6] if s.endswith("+00:00") else s[11:-1]) + "Z"
+        try:
+            return _iso_dt(datetime.fromisoformat(s[:-1] + "+00:00" if s.endswith("Z") else s))
+        except ValueError:
+            return value
+    return str(value)
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, datetime):
+        return _iso_dt(obj)
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return bytes(obj).decode("utf-8", "replace")
+    raise TypeError(f"Tipo non serializzabile in JSON: {type(obj).__name__}")
+
+
+def dumps(obj: Any, default: Callable[[Any], Any] | None = None) -> bytes:
+    """JSON compatto UTF-8. `default` gestisce i tipi sconosciuti dopo quelli noti (es. str per i log)."""
+    if default is None:
+        fallback = _default
+    else:
+        def fallback(o: Any) -> Any:
+            try:
+                return _default(o)
+            except TypeError:
+                return default(o)
+    if orjson is not None:
+        return orjson.dumps(obj, default=fallback, option=_ORJSON_OPTS)
+    return json.dumps(obj, default=fallback, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dumps_str(obj: Any, default: Callable[[Any], Any] | None = str) -> str:
+    """Come dumps() ma restituisce str; di default i tipi sconosciuti diventano str (pensato per i log)."""
+    return dumps(obj, default).decode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse che serializza con orjson (o il fallback compatto) e gestisce i datetime."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+# ---------------------------------------------------------------------------
+# Benchmark: percorso attuale (dict per riga + _iso_utc + deep link + JSONResponse stdlib)
+# contro tuple dal DB + shape_feed_rows + FastJSONResponse
+# ---------------------------------------------------------------------------
+
+def _bench(items: int, rounds: int) -> None:
+    import random
+    import time
+    from datetime import timedelta
+
+    from backend.feed_query import FEED_CARD_KEYS, shape_feed_rows
+
+    rng = random.Random(1)
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for i in range(items):
+        d = start + timedelta(seconds=rng.randrange(10**7), microseconds=rng.randrange(1000) * 1000)
+        rows.append((
+            f"18f{i:013x}", "user@example.com", f"Mittente {i}", f"news{i}@example.com",
+            f"Oggetto della newsletter numero {i} — novità", f"Titolo AI {i}",
+            ("Riassunto **markdown** con qualche riga di testo, accenti àèìòù e link. " * 6),
+            f"https://cdn.example.com/img/{i}.jpg", str(d), rng.random() < 0.1, "#335577",
+            None, "newsletter", "tecnologia", "example.com", f"th{i}", f"<{i}@mail.example.com>",
+        ))
+
+    def legacy_iso(value):
+        # copia del vecchio main._iso_utc: fromisoformat/astimezone per ogni card
+        s = value.strip()
+        dt = datetime.fromisoformat(s)
+        return dt.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+
+    def legacy() -> bytes:
+        page = [dict(zip(FEED_CARD_KEYS, r)) for r in rows]
+        for item in page:
+            item["is_complete"] = True
+            item["received_date"] = legacy_iso(item["received_date"])
+            item["gmail_message_id"] = item.get("email_id")
+            item["gmail_thread_id"] = item.get("thread_id")
+            item["rfc822_message_id"] = item.get("rfc822_message_id")
+            item["gmail_account_index"] = item.get("gmail_account_index", 0)
+        return JSONResponse({"feed": page, "next_cursor": None, "has_more": False}).body
+
+    def fast() -> bytes:
+        return FastJSONResponse({"feed": shape_feed_rows(rows), "next_cursor": None, "has_more": False}).body
+
+    a, b = json.loads(legacy()), json.loads(fast())
+    assert a == b, "i due percorsi producono JSON diversi"
+
+    for name, fn in (("attuale (stdlib)", legacy), ("veloce", fast)):
+        fn()
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            body = fn()
+        us = (time.perf_counter() - t0) / rounds * 1e6
+        print(f"{name:18s} {us:9.1f} µs/pagina  {len(body):7d} byte")
+    print(f"backend JSON: {'orjson ' + orjson.__version__ if orjson else 'stdlib json (orjson non installato)'}")
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import tempfile
+
+    ap = argparse.ArgumentParser(description="Micro-benchmark della serializzazione di una pagina del feed")
+    ap.add_argument("--items", type=int, default=50)
+    ap.add_argument("--rounds", type=int, default=2000)
+    args = ap.parse_args()
+    # feed_query importa database, che crea DATA_DIR: nel benchmark basta una cartella temporanea
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="fastjson_bench_"))
+    _bench(args.items, args.rounds)
@@ -0,0 +1,89 @@
+# backend/feed_cache.py
+"""
+Versione del feed per utente e cache della prima pagina.
+
+`feed:ver:<user_id>` è un contatore Redis incrementato da chiunque cambi ciò che il feed
+mostra (worker a fine arricchimento, stage immagine, batch, endpoint preferito/tag/tipo/
+recompute...). L'ETag di una risposta di /api/feed deriva da (versione, filtri, cursore,
+domini nascosti, stato ingest): se il client rimanda lo stesso ETag in If-None-Match
+l'API risponde 304 con una sola GET su Redis, senza toccare SQLite.
+
+La prima pagina (senza cursore) viene anche tenuta in Redis già serializzata, con chiave
+che include la versione: un bump la rende irraggiungibile e scade da sola dopo il TTL.
+"""
+import hashlib
+import json
+import logging
+import os
+from typing import Any
+
+FEED_VERSION_PREFIX = "feed:ver:"
+FEED_PAGE_PREFIX = "feed:page:"
+FEED_CACHE_TTL = int(os.getenv("FEED_CACHE_TTL", "600"))
+FEED_CACHE_ENABLED = os.getenv("FEED_CACHE_ENABLED", "1") == "1"
+
+
+def bump_feed_version(r: Any, *user_ids: str) -> None:
+    """Invalida feed ed ETag degli utenti indicati. Non solleva: al peggio il client ricarica."""
+    if r is None:
+        return
+    ids = {u for u in user_ids if u}
+    if not ids:
+        return
+    try:
+        pipe = r.pipeline()
+        for uid in ids:
+            pipe.incr(FEED_VERSION_PREFIX + uid)
+        pipe.execute()
+    except Exception as e:
+        logging.warning(f"[feed_cache] bump versione fallito per {len(ids)} utenti: {e}")
+
+
+def get_feed_version(r: Any, user_id: str) -> str | None:
+    """Versione corrente (stringa) o None se Redis non è disponibile/cache disattivata."""
+    if r is None or not FEED_CACHE_ENABLED:
+        return None
+    try:
+        v = r.get(FEED_VERSION_PREFIX + user_id)
+    except Exception as e:
+        logging.warning(f"[feed_cache] lettura versione fallita: {e}")
+        return None
+    return str(v) if v is not None else "0"
+
+
+def feed_etag(user_id: str, version: str, params: dict[str, Any]) -> str:
+    """ETag forte per (utente, versione, parametri della richiesta)."""
+    raw = json.dumps({"u": user_id, "v": version, "p": params}, sort_keys=True, default=str)
+    return '"' + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Tollera i proxy che aggiungono W/ o gzip suffissi all'ETag
+    candidates = {t.strip().removeprefix("W/").replace("-gzip", "") for t in if_none_match.split(",")}
+    return etag in candidates
+
+
+def get_cached_page(r: Any, user_id: str, etag: str) -> bytes | None:
+    if r is None:
+        return None
+    try:
+        body = r.get(f"{FEED_PAGE_PREFIX}{user_id}:{etag.strip(chr(34))}")
+    except Exception as e:
+        logging.warning(f"[feed_cache] lettura pagina fallita: {e}")
+        return None
+    if body is None:
+        return None
+    return body.encode("utf-8") if isinstance(body, str) else body
+
+
+def put_cached_page(r: Any, user_id: str, etag: str, body: bytes) -> None:
+    if r is None:
+        return
+    try:
+        r.set(f"{FEED_PAGE_PREFIX}{user_id}:{etag.strip(chr(34))}", body, ex=FEED_CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"[feed_cache] scrittura pagina fallita: {e}")
@@ -0,0 +1,174 @@
+# backend/feed_changes.py
+"""
+Sincronizzazione incrementale del feed per i client (GET /api/feed/changes).
+
+Il client tiene un "change token" (il seq di `feed_change`, restituito anche da /api/feed
+con la prima pagina) e chiede cosa è cambiato da lì: card inserite/aggiornate (già nel
+formato del feed) ed email_id rimossi, compattati per email (conta l'ultima operazione).
+Dopo una riconnessione o durante l'ingest basta una richiesta invece di un
+/api/feed/item/{id} per email.
+
+Il log viene potato per età (FEED_CHANGES_RETENTION_S): un token più vecchio della parte
+conservata, o successivo al seq corrente (database ricreato), risponde reset=true e il
+client ricarica il feed dalla prima pagina.
+
+Il token non supera mai un seq che una transazione ancora aperta potrebbe committare dopo:
+su SQLite le scritture sono in fila, quindi è l'ultimo seq assegnato; su PostgreSQL i valori
+di BIGSERIAL vengono presi all'INSERT ma diventano visibili al commit, non in ordine (vedi
+_pg_safe_token).
+"""
+import logging
+import os
+import time
+from typing import Any
+
+from backend.database import db, FeedChange, FeedItem, IS_POSTGRES
+from backend.feed_query import FEED_CARD_FIELDS, shape_feed_rows
+
+FEED_CHANGES_RETENTION_S = int(os.getenv("FEED_CHANGES_RETENTION_S", str(7 * 24 * 3600)))
+FEED_CHANGES_PRUNE_EVERY_S = int(os.getenv("FEED_CHANGES_PRUNE_EVERY_S", "3600"))
+
+_last_prune = 0.0
+
+
+def _last_seq() -> int:
+    """Ultimo seq assegnato, anche da transazioni non ancora committate (0 se mai scritto)."""
+    if IS_POSTGRES:
+        # last_value è NULL finché la sequenza non viene usata
+        row = db.execute_sql(
+            "SELECT last_value FROM pg_sequences WHERE schemaname = current_schema() "
+            "AND sequencename = 'feed_change_seq_seq'"
+        ).fetchone()
+    else:
+        row = db.execute_sql("SELECT seq FROM sqlite_sequence WHERE name = 'feed_change'").fetchone()
+    return int(row[0]) if row and row[0] is not None else 0
+
+
+_pg_last_safe = 0
+
+
+def _pg_safe_token(last: int) -> int:
+    """
+    Seq più alto sotto cui nessuna transazione ancora aperta può committare righe (PostgreSQL).
+
+    Le query sono in quest'ordine, ognuna con la sua snapshot (READ COMMITTED, autocommit):
+    1) last = ultimo seq assegnato (_last_seq);
+    2) inizio della più vecchia transazione di scrittura aperta sul database (pg_stat_activity,
+       backend_xid non nullo: chi ha già scritto); se non ce ne sono, ogni seq <= last è di una
+       transazione conclusa e last è sicuro;
+    3) altrimenti il seq più alto preso (drawn_at) prima di quell'inizio, meno un secondo di
+       margine: ogni seq inferiore è stato preso ancora prima, da una transazione che in 2) non
+       era aperta, quindi è già visibile (o annullato).
+    Se nessuna riga è così vecchia (log appena creato o potato) resta all'ultimo valore sicuro
+    calcolato da questo processo: un seq sicuro lo resta per sempre.
+    Tutti i processi devono usare lo stesso ruolo (o pg_read_all_stats) per vedere xact_start.
+    """
+    global _pg_last_safe
+    oldest = db.execute_sql(
+        "SELECT min(xact_start) FROM pg_stat_activity "
+        "WHERE datname = current_database() AND backend_xid IS NOT NULL AND pid <> pg_backend_pid()"
+    ).fetchone()[0]
+    if oldest is None:
+        safe = last
+    else:
+        row = db.execute_sql(
+            "SELECT seq FROM feed_change WHERE drawn_at < %s - interval '1 second' AND seq <= %s "
+            "ORDER BY seq DESC LIMIT 1",
+            (oldest, last),
+        ).fetchone()
+        safe = int(row[0]) if row else 0
+    # Oltre `last` solo se il database è stato ricreato: il valore in memoria non vale più
+    _pg_last_safe = max(_pg_last_safe if _pg_last_safe <= last else 0, safe)
+    return _pg_last_safe
+
+
+def _log_bounds() -> tuple[int, int]:
+    """(ultimo seq assegnato, seq fino a cui il log è completo e visibile)."""
+    last = _last_seq()
+    return last, (_pg_safe_token(last) if IS_POSTGRES else last)
+
+
+def current_token() -> int:
+    """Change token da dare ai client: il log è completo fino a questo seq (0 se mai scritto)."""
+    return _log_bounds()[1]
+
+
+def prune(max_age_s: int = FEED_CHANGES_RETENTION_S) -> int:
+    """Elimina le modifiche più vecchie di max_age_s; restituisce quante righe ha tolto."""
+    cutoff = int(time.time()) - max_age_s
+    return FeedChange.delete().where(FeedChange.changed_at < cutoff).execute()
+
+
+def maybe_prune() -> None:
+    """prune() al più una volta ogni FEED_CHANGES_PRUNE_EVERY_S per processo. Non solleva."""
+    global _last_prune
+    now = time.monotonic()
+    if now - _last_prune < FEED_CHANGES_PRUNE_EVERY_S:
+        return
+    _last_prune = now
+    try:
+        n = prune()
+        if n:
+            logging.info(f"[feed_changes] potate {n} modifiche oltre {FEED_CHANGES_RETENTION_S}s")
+    except Exception as e:
+        logging.warning(f"[feed_changes] potatura fallita: {e}")
+
+
+def changes_since(
+    user_id: str,
+    since: int,
+    limit: int = 500,
+    hidden_domains: list[str] | None = None,
+) -> dict[str, Any]:
+    """
+    Modifiche al feed dell'utente con seq > since, al più `limit` righe di log per chiamata.
+    Restituisce {"change_token", "upserted": [card], "removed": [email_id], "has_more", "reset"}.
+    Bloccante.
+    """
+    last, current = _log_bounds()
+    floor = db.execute_sql("SELECT min(seq) FROM feed_change").fetchone()[0]
+    floor = floor if floor is not None else last + 1
+    if since > last or since < floor - 1:
+        return {"change_token": current, "upserted": [], "removed": [], "has_more": False, "reset": True}
+
+    # Solo fino a `current`: oltre potrebbero ancora comparire seq più bassi (commit fuori ordine)
+    rows = (FeedChange
+            .select(FeedChange.seq, FeedChange.email_id, FeedChange.thread_key, FeedChange.op)
+            .where((FeedChange.user_id == user_id) & (FeedChange.seq > since) & (FeedChange.seq <= current))
+            .order_by(FeedChange.seq)
+            .limit(limit + 1)
+            .tuples())
+    rows = list(rows)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    token = rows[-1][0] if has_more else max(since, current, rows[-1][0] if rows else 0)
+
+    # Ultima operazione per email: un aggiornamento è DELETE+INSERT sulla stessa card
+    last_op: dict[str, tuple[str, str]] = {}
+    for _seq, email_id, thread_key, op in rows:
+        last_op[email_id] = (op, thread_key)
+    upsert_ids = {e for e, (op, _k) in last_op.items() if op == "u"}
+    removed = {e for e, (op, _k) in last_op.items() if op == "d"}
+
+    cards: list[dict[str, Any]] = []
+    if upsert_ids:
+        thread_keys = list({last_op[e][1] for e in upsert_ids})
+        # Stato attuale delle card (indice unico user_id, thread_key); quelle non più presenti
+        # sono state rimosse dopo l'ultima riga letta e risultano rimosse anche qui
+        found = (FeedItem
+                 .select(*FEED_CARD_FIELDS)
+                 .where((FeedItem.user_id == user_id) & FeedItem.thread_key.in_(thread_keys) &
+                        FeedItem.email_id.in_(list(upsert_ids)))
+                 .tuples())
+        hidden = set(hidden_domains or [])
+        cards = [c for c in shape_feed_rows(list(found)) if not c["source_domain"] or c["source_domain"] not in hidden]
+        removed |= upsert_ids - {c["email_id"] for c in cards}
+
+    cards.sort(key=lambda c: (c["received_date"] or "", c["email_id"]), reverse=True)
+    return {
+        "change_token": token,
+        "upserted": cards,
+        "removed": sorted(removed),
+        "has_more": has_more,
+        "reset": False,
+    }
@@ -0,0 +1,67 @@
+# backend/feed_push.py
+"""
+Push delle card del feed allo stream per utente (GET /api/feed/events).
+
+Quando il worker (o il batch) completa un'email, push_card() legge da feed_item la card
+del suo thread e la pubblica sul topic "user:<user_id>" dell'SSE hub: il client la rende
+senza richiedere /api/feed. Se il thread non ha più una card visibile, l'evento è una
+rimozione. Ogni evento porta il change_token corrente (vedi feed_changes) per il
+riallineamento dopo una riconnessione.
+
+Eventi:
+  card    {"op": "upsert", "card": {...}, "removed": [email_id...], "change_token": N}
+          {"op": "remove", "removed": [email_id], "change_token": N}
+  ingest  stato del job di ingest dell'utente (come l'evento "progress" del job)
+"""
+import logging
+from typing import Any
+
+from backend import feed_changes, sse_hub
+from backend.database import FeedItem, Newsletter
+from backend.feed_query import FEED_CARD_FIELDS, shape_feed_rows
+
+
+def user_topic(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+def card_event(user_id: str, email_id: str, thread_id: str | None = None) -> dict[str, Any]:
+    """
+    Evento "card" per l'email: la card attuale del suo thread, o la rimozione.
+    Senza thread_id lo legge da newsletter. Bloccante.
+    """
+    if thread_id is None:
+        n = (Newsletter.select(Newsletter.thread_id)
+             .where((Newsletter.email_id == email_id) & (Newsletter.user_id == user_id))
+             .first())
+        thread_id = n.thread_id if n else None
+    row = (FeedItem
+           .select(*FEED_CARD_FIELDS)
+           .where((FeedItem.user_id == user_id) & (FeedItem.thread_key == (thread_id or email_id)))
+           .tuples()
+           .first())
+    token = feed_changes.current_token()
+    if row is None:
+        return {"op": "remove", "removed": [email_id], "change_token": token}
+    card = shape_feed_rows([row])[0]
+    # Un'email più vecchia del thread non ha card propria: il client toglie la sua, se c'era
+    removed = [email_id] if card["email_id"] != email_id else []
+    return {"op": "upsert", "card": card, "removed": removed, "change_token": token}
+
+
+def push_card(r: Any, user_id: str, email_id: str, thread_id: str | None = None) -> None:
+    """Pubblica la card dell'email sullo stream dell'utente. Bloccante, non solleva."""
+    try:
+        sse_hub.publish(r, user_topic(user_id), "card", card_event(user_id, email_id, thread_id))
+    except Exception as e:
+        logging.warning(f"[feed_push] push card fallito per {email_id}: {e}")
+
+
+def push_ingest(r: Any, user_id: str, state: dict) -> None:
+    """Inoltra lo stato di un job di ingest allo stream dell'utente. Non solleva."""
+    if not user_id:
+        return
+    try:
+        sse_hub.publish(r, user_topic(user_id), "ingest", state)
+    except Exception as e:
+        logging.warning(f"[feed_push] push ingest fallito per {user_id}: {e}")
@@ -0,0 +1,75 @@
+# backend/feed_query.py
+"""
+Query del feed su `feed_item`, condivisa da get_feed e dalla suite dei piani (backend.query_plans).
+
+La pagina è sempre una SEARCH sulla chiave primaria (user_id, received_date, email_id) o su
+un indice (user_id, <facet>, received_date, email_id): l'ordinamento viene dall'indice
+(niente temp B-tree) e il cursore è un confronto tra row-value, che SQLite usa come limite
+dell'intervallo. Il filtro dei domini nascosti è un residuo valutato durante la scansione
+ordinata, quindi non cambia l'indice scelto.
+"""
+from datetime import datetime
+from typing import Any
+
+from peewee import Tuple
+
+from backend.database import FeedItem
+from backend.fastjson import iso_utc
+
+FEED_FILTER_COLUMNS = ("type_tag", "topic_tag", "source_domain", "tag", "is_favorite")
+
+FEED_CARD_FIELDS = (
+    FeedItem.email_id, FeedItem.user_id,
+    FeedItem.sender_name, FeedItem.sender_email,
+    FeedItem.original_subject, FeedItem.ai_title, FeedItem.ai_summary_markdown,
+    FeedItem.image_url, FeedItem.received_date,
+    FeedItem.is_favorite, FeedItem.accent_hex,
+    FeedItem.tag, FeedItem.type_tag, FeedItem.topic_tag,
+    FeedItem.source_domain, FeedItem.thread_id, FeedItem.rfc822_message_id,
+)
+FEED_CARD_KEYS = tuple(f.name for f in FEED_CARD_FIELDS)
+_RECEIVED_IDX = FEED_CARD_KEYS.index("received_date")
+_EMAIL_IDX = FEED_CARD_KEYS.index("email_id")
+_THREAD_IDX = FEED_CARD_KEYS.index("thread_id")
+
+
+def build_feed_query(
+    user_id: str,
+    limit: int,
+    filters: dict[str, Any] | None = None,
+    hidden_domains: list[str] | None = None,
+    before: tuple[datetime, str] | None = None,
+):
+    """Select peewee per una pagina del feed (limit = page_size + 1 per sapere se c'è altro)."""
+    q = (FeedItem
+         .select(*FEED_CARD_FIELDS)
+         .where(FeedItem.user_id == user_id))
+    for col, val in (filters or {}).items():
+        if col not in FEED_FILTER_COLUMNS:
+            raise ValueError(f"filtro non supportato: {col}")
+        q = q.where(getattr(FeedItem, col) == val)
+    if hidden_domains:
+        # Le card senza dominio restano visibili (NULL NOT IN (...) darebbe NULL, cioè falso)
+        q = q.where(FeedItem.source_domain.is_null() | FeedItem.source_domain.not_in(list(hidden_domains)))
+    if before:
+        q = q.where(Tuple(FeedItem.received_date, FeedItem.email_id) < Tuple(before[0], before[1]))
+    return q.order_by(FeedItem.received_date.desc(), FeedItem.email_id.desc()).limit(limit)
+
+
+def shape_feed_rows(rows: list[tuple]) -> list[dict[str, Any]]:
+    """
+    Card pronte per la risposta da tuple di build_feed_query(...).tuples(): una sola passata,
+    data in ISO UTC e campi del deep link Gmail (gmail_message_id = email_id, thread id,
+    indice account 0). In feed_item ci sono solo email complete.
+    """
+    out = []
+    for r in rows:
+        item = dict(zip(FEED_CARD_KEYS, r))
+        item["received_date"] = iso_utc(r[_RECEIVED_IDX])
+        item["is_favorite"] = bool(item["is_favorite"])
+        item["is_complete"] = True
+        item["gmail_message_id"] = r[_EMAIL_IDX]
+        item["gmail_thread_id"] = r[_THREAD_IDX]
+        item["gmail_account_index"] = 0
+        out.append(item)
+    return out
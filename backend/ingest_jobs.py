@@ -0,0 +1,135 @@
+# backend/ingest_jobs.py
+"""
+Stato dei job di ingest in Redis, condiviso da tutte le repliche dell'API e dal worker.
+
+- `ingest:job:<job_id>`     hash {state, total, done, errors, user_id, reason, created_at, updated_at}
+                            con TTL (INGEST_JOB_TTL), rinnovato a ogni aggiornamento;
+- `ingest:active:<user_id>` job_id del job in corso dell'utente (SET NX: un solo job attivo
+                            per utente anche con più worker uvicorn), cancellato a fine job;
+- `ingest:seen:<job_id>`    email già contate, così un'email rielaborata non conta due volte.
+
+L'avanzamento lo registra il worker stesso (record_result, uno script Lua: HINCRBY e chiusura
+del job a total raggiunto in un'unica operazione atomica).
+"""
+import os
+import time
+import uuid
+from typing import Any
+
+INGEST_JOB_TTL = int(os.getenv("INGEST_JOB_TTL", str(24 * 3600)))
+INGEST_ACTIVE_TTL = int(os.getenv("INGEST_ACTIVE_TTL", str(2 * 3600)))  # un job bloccato non blocca per sempre
+
+JOB_PREFIX = "ingest:job:"
+ACTIVE_PREFIX = "ingest:active:"
+SEEN_PREFIX = "ingest:seen:"
+ACTIVE_STATES = ("queued", "running")
+_INT_FIELDS = ("total", "done", "errors", "created_at", "updated_at")
+
+_RECORD_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return {} end
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+    redis.call('HSET', KEYS[1], 'updated_at', ARGV[4])
+end
+local h = redis.call('HMGET', KEYS[1], 'state', 'total', 'done', 'errors')
+local total = tonumber(h[2] or '0') or 0
+local finished = (tonumber(h[3] or '0') or 0) + (tonumber(h[4] or '0') or 0)
+if (h[1] == 'running' or h[1] == 'queued') and total > 0 and finished >= total then
+    redis.call('HSET', KEYS[1], 'state', 'done')
+    if redis.call('GET', KEYS[3]) == ARGV[5] then redis.call('DEL', KEYS[3]) end
+    redis.call('DEL', KEYS[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return redis.call('HGETALL', KEYS[1])
+"""
+
+
+def _decode(h: dict[str, str]) -> dict[str, Any]:
+    out: dict[str, Any] = dict(h)
+    for f in _INT_FIELDS:
+        if f in out:
+            try:
+                out[f] = int(out[f])
+            except (TypeError, ValueError):
+                out[f] = 0
+    return out
+
+
+def create(r: Any, user_id: str) -> tuple[str, bool]:
+    """
+    Crea un job "queued" per l'utente, se non ne ha già uno attivo.
+    Restituisce (job_id, creato): con creato=False job_id è quello già in corso.
+    """
+    job_id = uuid.uuid4().hex
+    active_key = ACTIVE_PREFIX + user_id
+    for _ in range(2):
+        if r.set(active_key, job_id, nx=True, ex=INGEST_ACTIVE_TTL):
+            now = int(time.time())
+            pipe = r.pipeline()
+            pipe.hset(JOB_PREFIX + job_id, mapping={
+                "state": "queued", "total": 0, "done": 0, "errors": 0,
+                "user_id": user_id, "created_at": now, "updated_at": now,
+            })
+            pipe.expire(JOB_PREFIX + job_id, INGEST_JOB_TTL)
+            pipe.execute()
+            return job_id, True
+        existing = r.get(active_key)
+        st = get(r, existing) if existing else None
+        if st and st.get("state") in ACTIVE_STATES:
+            return existing, False
+        # Indice orfano (job scaduto o già chiuso): lo libero e riprovo
+        r.delete(active_key)
+    return job_id, False
+
+
+def get(r: Any, job_id: str) -> dict[str, Any] | None:
+    if not job_id:
+        return None
+    h = r.hgetall(JOB_PREFIX + job_id)
+    return _decode(h) if h else None
+
+
+def update(r: Any, job_id: str, **fields: Any) -> dict[str, Any] | None:
+    """Aggiorna i campi del job; a state done/failed libera l'indice dell'utente. Restituisce lo stato."""
+    key = JOB_PREFIX + job_id
+    if not r.exists(key):
+        return None
+    fields["updated_at"] = int(time.time())
+    pipe = r.pipeline()
+    pipe.hset(key, mapping={k: ("" if v is None else v) for k, v in fields.items()})
+    pipe.expire(key, INGEST_JOB_TTL)
+    pipe.hgetall(key)
+    st = _decode(pipe.execute()[-1])
+    if st.get("state") not in ACTIVE_STATES and st.get("user_id"):
+        release(r, st["user_id"], job_id)
+    return st
+
+
+def release(r: Any, user_id: str, job_id: str) -> None:
+    """Toglie il job dall'indice dei job attivi dell'utente (solo se è ancora quello)."""
+    active_key = ACTIVE_PREFIX + user_id
+    if r.get(active_key) == job_id:
+        r.delete(active_key)
+
+
+def active_job(r: Any, user_id: str) -> str | None:
+    """job_id del job in corso dell'utente (una GET), o None."""
+    if r is None or not user_id:
+        return None
+    return r.get(ACTIVE_PREFIX + user_id)
+
+
+def record_result(r: Any, job_id: str, user_id: str, email_id: str, failed: bool = False) -> dict[str, Any] | None:
+    """
+    Conta un'email elaborata (done o errors) dal worker, una sola volta per email; a
+    done + errors >= total chiude il job. Atomico. Restituisce lo stato o None se il job non esiste.
+    """
+    res = r.eval(
+        _RECORD_LUA, 3,
+        JOB_PREFIX + job_id, SEEN_PREFIX + job_id, ACTIVE_PREFIX + user_id,
+        email_id, "errors" if failed else "done", INGEST_JOB_TTL, int(time.time()), job_id,
+    )
+    if not res:
+        return None
+    return _decode(dict(zip(res[::2], res[1::2])))
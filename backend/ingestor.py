@@ -19,6 +19,7 @@ from googleapiclient.errors import HttpError
 
 from backend.logging_config import setup_logging
 from backend.database import db, Newsletter, initialize_db
+from backend.db_writes import insert_stubs
 
 load_dotenv("/opt/newsletter/.env")
 setup_logging("INGESTOR")
@@ -34,6 +35,8 @@ POLL_SECONDS = int(os.getenv("INGESTOR_POLL_SECONDS", "60"))
 BACKFILL_PAGES = int(os.getenv("INGESTOR_BACKFILL_PAGES", "4"))
 BACKFILL_TARGET = int(os.getenv("INGESTOR_BACKFILL_TARGET", "200"))
 GMAIL_BATCH = int(os.getenv("INGESTOR_GMAIL_BATCH", "100"))
+# Backfill con almeno N nuove email → arricchimento AI via Batch API (0 = disattivato)
+BATCH_BACKFILL_MIN = int(os.getenv("BATCH_BACKFILL_MIN", "0"))
 SEARCH_Q_BASE = os.getenv("INGESTOR_GMAIL_QUERY", "newer_than:365d")
 LABEL_Q = os.getenv("INGESTOR_GMAIL_LABELS", "")
 
@@ -73,12 +76,15 @@ def _refresh_lock():
     """Aggiorna la scadenza del lock."""
     redis_client.expire("ingestor:lock", 120)
 
-def _enqueue_email(email_id: str, user_id: str) -> bool:
+def _enqueue_email(email_id: str, user_id: str, batch: bool = False) -> bool:
     dd_key = f"dq:{user_id}:{email_id}"
     if not redis_client.set(dd_key, "1", nx=True, ex=DEDUP_TTL):
         logging.debug(f"[ENQ] skip dedup user={_scrub(user_id)} email={email_id}")
         return False
-    payload = json.dumps({"email_id": email_id, "user_id": user_id})
+    job: Dict[str, Any] = {"email_id": email_id, "user_id": user_id}
+    if batch:
+        job["batch"] = True
+    payload = json.dumps(job)
     _rpush_safe("email_queue", payload)
     # opzionale: metrico con scadenza
     redis_client.sadd(f"ingestor:queued:{user_id}", email_id)
@@ -268,19 +274,25 @@ def main_loop():
                 continue
 
             jobs_created = 0
+            use_batch = bool(BATCH_BACKFILL_MIN) and len(new_ids) >= BATCH_BACKFILL_MIN
+            # Stato delle email già presenti con una SELECT, le nuove con un INSERT a blocchi
+            existing = {
+                nl.email_id: nl for nl in
+                Newsletter.select(Newsletter.email_id, Newsletter.enriched, Newsletter.is_complete, Newsletter.image_url)
+                .where((Newsletter.user_id == user_id) & (Newsletter.email_id.in_(new_ids)))
+            }
+            insert_stubs(user_id, [e for e in new_ids if e not in existing],
+                         received_date=datetime.now(timezone.utc), enriched=False, is_complete=False)
             for email_id in new_ids:
-                nl, created = Newsletter.get_or_create(
-                    email_id=email_id, user_id=user_id,
-                    defaults={"received_date": datetime.now(timezone.utc),
-                              "enriched": False, "is_complete": False}
-                )
-                needs_work = created or (not nl.enriched) or (not nl.is_complete) or not (nl.image_url or "").strip()
+                nl = existing.get(email_id)
+                needs_work = nl is None or (not nl.enriched) or (not nl.is_complete) or not (nl.image_url or "").strip()
                 if needs_work:
-                    if _enqueue_email(email_id, user_id):
+                    if _enqueue_email(email_id, user_id, batch=use_batch):
                         jobs_created += 1
             
             if jobs_created > 0:
-                logging.info(f"Aggiunti {jobs_created} lavori alla coda per l'utente {_scrub(user_id)}.")
+                logging.info(f"Aggiunti {jobs_created} lavori alla coda per l'utente {_scrub(user_id)}"
+                             f"{' (modalità batch)' if use_batch else ''}.")
 
         if _run:
             logging.debug(f"--- Ciclo completato. Pausa di {POLL_SECONDS} secondi. ---")
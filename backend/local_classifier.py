@@ -0,0 +1,349 @@
+# backend/local_classifier.py
+"""
+Classificatore locale (CPU, senza dipendenze) per type_tag/topic_tag.
+
+Feature hashing (parole del contenuto condensato, parole dell'oggetto, dominio e
+indirizzo del mittente) + regressione logistica multinomiale allenata con SGD sulle
+etichette già presenti in Newsletter; le righe di DomainTypeOverride sostituiscono
+il type_tag delle email di quel dominio e pesano di più.
+
+classify_type_and_topic() lo interroga per primo: se entrambe le probabilità superano
+le soglie LOCAL_CLS_TYPE_MIN_CONF / LOCAL_CLS_TOPIC_MIN_CONF la chiamata LLM viene saltata.
+
+Uso:
+    python -m backend.local_classifier train [--limit 5000]
+    python -m backend.local_classifier eval  [--limit 5000] [--llm 50]
+"""
+import json
+import logging
+import math
+import os
+import random
+import re
+import time
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from backend.content_condense import condense_for_ai
+from backend.database import DATA_DIR
+
+LOCAL_CLS_ENABLED = os.getenv("LOCAL_CLS_ENABLED", "1") == "1"
+LOCAL_CLS_PATH = Path(os.getenv("LOCAL_CLS_PATH", str(DATA_DIR / "local_classifier.json")))
+LOCAL_CLS_TYPE_MIN_CONF = float(os.getenv("LOCAL_CLS_TYPE_MIN_CONF", "0.85"))
+LOCAL_CLS_TOPIC_MIN_CONF = float(os.getenv("LOCAL_CLS_TOPIC_MIN_CONF", "0.70"))
+LOCAL_CLS_TOKENS = int(os.getenv("AI_TOKENS_CLASSIFY", "1500"))
+LOCAL_CLS_MIN_ROWS = 200          # sotto questa soglia il modello non viene salvato
+LOCAL_CLS_RELOAD_EVERY = 60.0     # secondi tra un controllo e l'altro del file modello
+
+N_FEATURES = 1 << 18
+MODEL_VERSION = 1
+
+_WORD_RE = re.compile(r"[a-zà-öø-ÿ0-9]{3,}")
+_HEAD_RE = re.compile(r"\AFROM:([^\n]*)\nSUBJECT:([^\n]*)")
+_ADDR_RE = re.compile(r"[\w.+-]+@([\w-]+\.[\w.-]+)")
+
+
+# --- FEATURE ---
+
+def _h(token: str) -> int:
+    return zlib.crc32(token.encode("utf-8")) % N_FEATURES
+
+def featurize(text: str) -> dict[int, float]:
+    """Vettore sparso (indice → peso) L2-normalizzato, con tf sublineare."""
+    counts: dict[int, float] = {}
+
+    def add(tok: str, w: float = 1.0) -> None:
+        i = _h(tok)
+        counts[i] = counts.get(i, 0.0) + w
+
+    text = text or ""
+    m = _HEAD_RE.match(text)
+    if m:
+        sender, subject = m.group(1).lower(), m.group(2).lower()
+        addr = _ADDR_RE.search(sender)
+        if addr:
+            host = addr.group(1)
+            add(f"e:{addr.group(0)}", 2.0)
+            add(f"d:{host}", 2.0)
+            add(f"rd:{'.'.join(host.split('.')[-2:])}", 2.0)
+        for w in _WORD_RE.findall(subject):
+            add(f"s:{w}")
+        text = text[m.end():]
+    words = _WORD_RE.findall(text.lower())
+    for w in words:
+        add(f"w:{w}")
+    for a, b in zip(words, words[1:]):
+        add(f"b:{a}_{b}", 0.5)
+
+    vec = {i: 1.0 + math.log(c) for i, c in counts.items()}
+    norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
+    return {i: v / norm for i, v in vec.items()}
+
+
+# --- MODELLO ---
+
+class SoftmaxHead:
+    """Regressione logistica multinomiale su vettori sparsi."""
+
+    def __init__(self, classes: list[str]):
+        self.classes = list(classes)
+        self.w: dict[str, dict[int, float]] = {c: {} for c in self.classes}
+        self.b: dict[str, float] = {c: 0.0 for c in self.classes}
+
+    def proba(self, x: dict[int, float]) -> dict[str, float]:
+        scores = {}
+        for c in self.classes:
+            wc = self.w[c]
+            scores[c] = self.b[c] + sum(wc.get(i, 0.0) * v for i, v in x.items())
+        top = max(scores.values())
+        exps = {c: math.exp(s - top) for c, s in scores.items()}
+        tot = sum(exps.values())
+        return {c: e / tot for c, e in exps.items()}
+
+    def predict(self, x: dict[int, float]) -> tuple[str, float]:
+        p = self.proba(x)
+        c = max(p, key=lambda k: p[k])
+        return c, p[c]
+
+    def fit(self, X: list[dict[int, float]], y: list[str], sw: list[float], epochs: int = 8, lr: float = 0.5) -> None:
+        rng = random.Random(13)
+        order = list(range(len(X)))
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            step = lr / (1.0 + 0.5 * epoch)
+            for n in order:
+                x, target, weight = X[n], y[n], sw[n]
+                p = self.proba(x)
+                for c in self.classes:
+                    g = (p[c] - (1.0 if c == target else 0.0)) * weight
+                    if abs(g) < 1e-6:
+                        continue
+                    wc = self.w[c]
+                    for i, v in x.items():
+                        wc[i] = wc.get(i, 0.0) - step * g * v
+                    self.b[c] -= step * g
+
+    def to_json(self) -> dict:
+        return {
+            "classes": self.classes,
+            "bias": {c: round(v, 5) for c, v in self.b.items()},
+            "weights": {c: [[i, round(v, 5)] for i, v in wc.items() if abs(v) >= 1e-4] for c, wc in self.w.items()},
+        }
+
+    @classmethod
+    def from_json(cls, d: dict) -> "SoftmaxHead":
+        head = cls(d["classes"])
+        head.b = {c: float(v) for c, v in d["bias"].items()}
+        head.w = {c: {int(i): float(v) for i, v in pairs} for c, pairs in d["weights"].items()}
+        return head
+
+
+class LocalClassifier:
+    def __init__(self, type_head: SoftmaxHead, topic_head: SoftmaxHead, meta: dict | None = None):
+        self.type_head = type_head
+        self.topic_head = topic_head
+        self.meta = meta or {}
+
+    def predict(self, text: str) -> dict:
+        x = featurize(text)
+        ttype, p_type = self.type_head.predict(x)
+        topic, p_topic = self.topic_head.predict(x)
+        return {"type_tag": ttype, "type_conf": p_type, "topic_tag": topic, "topic_conf": p_topic}
+
+    def save(self, path: Path = LOCAL_CLS_PATH) -> None:
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": MODEL_VERSION, "meta": self.meta,
+                       "type": self.type_head.to_json(), "topic": self.topic_head.to_json()}, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path = LOCAL_CLS_PATH) -> "LocalClassifier | None":
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                d = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if d.get("version") != MODEL_VERSION:
+            return None
+        return cls(SoftmaxHead.from_json(d["type"]), SoftmaxHead.from_json(d["topic"]), d.get("meta"))
+
+
+# --- USO DAL WORKER ---
+
+_MODEL: LocalClassifier | None = None
+_MODEL_MTIME = 0.0
+_LAST_CHECK = 0.0
+
+def _current_model() -> LocalClassifier | None:
+    """Modello corrente, ricaricato se il file è stato riscritto da `train`."""
+    global _MODEL, _MODEL_MTIME, _LAST_CHECK
+    now = time.monotonic()
+    if _LAST_CHECK and now - _LAST_CHECK < LOCAL_CLS_RELOAD_EVERY:
+        return _MODEL
+    _LAST_CHECK = now
+    try:
+        mtime = LOCAL_CLS_PATH.stat().st_mtime
+    except OSError:
+        _MODEL = None
+        return None
+    if mtime != _MODEL_MTIME:
+        _MODEL = LocalClassifier.load(LOCAL_CLS_PATH)
+        _MODEL_MTIME = mtime
+        if _MODEL is not None:
+            logging.info(f"[LOCAL_CLS] modello caricato ({_MODEL.meta.get('trained_at')}, righe={_MODEL.meta.get('rows')})")
+    return _MODEL
+
+def classify_local(condensed_text: str) -> dict | None:
+    """
+    Tag dal modello locale se abbastanza sicuro, altrimenti None (→ LLM).
+    `condensed_text` è lo stesso testo condensato che andrebbe all'LLM.
+    """
+    if not LOCAL_CLS_ENABLED:
+        return None
+    model = _current_model()
+    if model is None:
+        return None
+    pred = model.predict(condensed_text)
+    if pred["type_conf"] >= LOCAL_CLS_TYPE_MIN_CONF and pred["topic_conf"] >= LOCAL_CLS_TOPIC_MIN_CONF:
+        return {"type_tag": pred["type_tag"], "topic_tag": pred["topic_tag"]}
+    return None
+
+
+# --- TRAINING / VALUTAZIONE ---
+
+def _is_holdout(email_id: str) -> bool:
+    return zlib.crc32((email_id or "").encode("utf-8")) % 10 == 0
+
+def _row_text(n: Any) -> str:
+    head = f"FROM: {n.sender_name or ''} <{n.sender_email or ''}>\nSUBJECT: {n.original_subject or ''}\n\n"
+    return condense_for_ai(head + (n.full_content_html or ""), LOCAL_CLS_TOKENS)
+
+def load_dataset(limit: int) -> tuple[list[tuple[Any, str, str, float]], list[tuple[Any, str, str, float]]]:
+    """(train, holdout): tuple (riga, type_tag, topic_tag, peso) con le override applicate."""
+    from backend.database import Newsletter, DomainTypeOverride
+    from backend.processing_utils import ALLOWED_TYPE_TAGS, TOPIC_VOCAB
+
+    overrides = {(o.user_id, o.domain): o.type_tag for o in DomainTypeOverride.select()}
+    rows = (Newsletter
+            .select()
+            .where((Newsletter.is_deleted == False) & (Newsletter.type_tag.is_null(False)) & (Newsletter.enriched == True))
+            .order_by(Newsletter.received_date.desc())
+            .limit(limit))
+    train, holdout = [], []
+    for n in rows:
+        domain = (n.sender_email or "").split("@")[-1].lower()
+        ttype = overrides.get((n.user_id, domain), n.type_tag)
+        weight = 3.0 if (n.user_id, domain) in overrides else 1.0
+        topic = n.topic_tag if n.topic_tag in TOPIC_VOCAB else "generico"
+        if ttype not in ALLOWED_TYPE_TAGS:
+            continue
+        (holdout if _is_holdout(n.email_id) else train).append((n, ttype, topic, weight))
+    return train, holdout
+
+def train(limit: int = 5000) -> LocalClassifier | None:
+    from backend.processing_utils import ALLOWED_TYPE_TAGS, TOPIC_VOCAB
+
+    t0 = time.perf_counter()
+    data, holdout = load_dataset(limit)
+    if len(data) < LOCAL_CLS_MIN_ROWS:
+        print(f"Troppo poche righe etichettate ({len(data)} < {LOCAL_CLS_MIN_ROWS}): modello non salvato.")
+        return None
+    X = [featurize(_row_text(n)) for n, _, _, _ in data]
+    type_head = SoftmaxHead(ALLOWED_TYPE_TAGS)
+    type_head.fit(X, [t for _, t, _, _ in data], [w for _, _, _, w in data])
+    topic_head = SoftmaxHead(TOPIC_VOCAB)
+    topic_head.fit(X, [t for _, _, t, _ in data], [1.0] * len(data))
+    model = LocalClassifier(type_head, topic_head, {
+        "trained_at": datetime.now(timezone.utc).isoformat(),
+        "rows": len(data),
+        "holdout_rows": len(holdout),
+        "train_sec": round(time.perf_counter() - t0, 1),
+    })
+    model.save()
+    print(f"Modello salvato in {LOCAL_CLS_PATH}: {len(data)} righe, {model.meta['train_sec']}s")
+    return model
+
+def _pct(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+def evaluate(limit: int = 5000, llm_sample: int = 0) -> dict:
+    """Accuratezza e latenza del modello locale sul holdout; con llm_sample>0 anche del percorso LLM."""
+    model = LocalClassifier.load()
+    if model is None:
+        raise SystemExit(f"Nessun modello in {LOCAL_CLS_PATH}: eseguire prima `train`.")
+    _, holdout = load_dataset(limit)
+    report: dict[str, Any] = {"holdout_rows": len(holdout)}
+    lat, ok_type, ok_topic, conf_n, conf_ok = [], 0, 0, 0, 0
+    texts = []
+    for n, ttype, topic, _ in holdout:
+        text = _row_text(n)
+        texts.append(text)
+        t0 = time.perf_counter()
+        pred = model.predict(text)
+        lat.append((time.perf_counter() - t0) * 1000)
+        ok_type += pred["type_tag"] == ttype
+        ok_topic += pred["topic_tag"] == topic
+        if pred["type_conf"] >= LOCAL_CLS_TYPE_MIN_CONF and pred["topic_conf"] >= LOCAL_CLS_TOPIC_MIN_CONF:
+            conf_n += 1
+            conf_ok += pred["type_tag"] == ttype and pred["topic_tag"] == topic
+    n_h = max(1, len(holdout))
+    report["local"] = {
+        "type_acc": round(ok_type / n_h, 3),
+        "topic_acc": round(ok_topic / n_h, 3),
+        "coverage_at_threshold": round(conf_n / n_h, 3),
+        "acc_at_threshold": round(conf_ok / conf_n, 3) if conf_n else None,
+        "latency_ms_p50": round(_pct(lat, 0.5), 2),
+        "latency_ms_p95": round(_pct(lat, 0.95), 2),
+    }
+
+    if llm_sample > 0:
+        import asyncio
+        from backend.processing_utils import classify_type_and_topic, SHARED_HTTP_CLIENT
+
+        async def _run_llm() -> dict:
+            lat_llm, ok_t, ok_p = [], 0, 0
+            sample = list(zip(holdout, texts))[:llm_sample]
+            for (n, ttype, topic, _), text in sample:
+                t0 = time.perf_counter()
+                res = await classify_type_and_topic(text, SHARED_HTTP_CLIENT, use_cache=False, allow_local=False)
+                lat_llm.append((time.perf_counter() - t0) * 1000)
+                ok_t += res.get("type_tag") == ttype
+                ok_p += res.get("topic_tag") == topic
+            k = max(1, len(sample))
+            return {"rows": len(sample), "type_acc": round(ok_t / k, 3), "topic_acc": round(ok_p / k, 3),
+                    "latency_ms_p50": round(_pct(lat_llm, 0.5), 1), "latency_ms_p95": round(_pct(lat_llm, 0.95), 1)}
+
+        report["llm"] = asyncio.run(_run_llm())
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    from dotenv import load_dotenv
+
+    load_dotenv("/opt/newsletter/.env")
+    from backend.database import db, initialize_db
+
+    ap = argparse.ArgumentParser(description="Classificatore locale type/topic")
+    ap.add_argument("cmd", choices=["train", "eval"])
+    ap.add_argument("--limit", type=int, default=5000, help="righe etichettate più recenti da usare")
+    ap.add_argument("--llm", type=int, default=0, help="(eval) righe del holdout da classificare anche via LLM")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if db.is_closed():
+        db.connect()
+    initialize_db()
+    try:
+        if args.cmd == "train":
+            train(args.limit)
+        else:
+            print(json.dumps(evaluate(args.limit, args.llm), indent=2))
+    finally:
+        if not db.is_closed():
+            db.close()
@@ -19,8 +19,8 @@ from bs4 import BeautifulSoup
 import logging
 from fastapi.middleware.gzip import GZipMiddleware
 from google.auth.transport.requests import Request as GoogleAuthRequest
-from backend.database import db, initialize_db, Newsletter, DomainTypeOverride
-from collections import defaultdict
+from backend.database import db, initialize_db, Newsletter, DomainTypeOverride, FeedFacetCount, FACET_COLUMNS
+from backend import metrics, domain_profiles
 import uuid
 from starlette.middleware.base import BaseHTTPMiddleware
 from fastapi import Header, BackgroundTasks, Request, HTTPException, Response, APIRouter, Query, FastAPI
@@ -28,16 +28,16 @@ import socket
 import ipaddress
 import hashlib
 from urllib.parse import quote, urlparse, unquote, urljoin
-from collections import OrderedDict, Counter, deque
+from collections import Counter, deque
 import random
 import bleach
-from peewee import fn, DoesNotExist as PeeweeDoesNotExist
+from peewee import DoesNotExist as PeeweeDoesNotExist, OperationalError as PeeweeOperationalError
 from datetime import datetime, timezone
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.responses import StreamingResponse, RedirectResponse, JSONResponse
 import typing as t
 from pydantic import BaseModel, Field
-from typing import Any, Dict, Tuple, DefaultDict, cast
+from typing import Any, Dict, Tuple, cast
 from pathlib import Path
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
@@ -57,6 +57,20 @@ import boto3
 from botocore.config import Config as BotoConfig
 from googleapiclient.errors import HttpError
 import shutil
+from backend.batch_enrich import enqueue_for_batch
+from backend.db_writes import insert_stubs
+from backend.search import search_feed, SearchQueryError
+from backend.feed_query import build_feed_query, shape_feed_rows
+from backend.fastjson import FastJSONResponse, dumps_str, iso_utc
+from backend import feed_changes, ingest_jobs, feed_push
+from backend.sse_hub import hub as sse_hub, publish as sse_publish, format_event
+from backend.sse_connections import PING as SSE_PING, ConnectionLimitError, manager as sse_connections
+from backend import shared_state, photo_pool, bulk_jobs
+from backend.photo_prefetch import PhotoPrefetcher, PhotoTooLarge, CARD_SIZE as PHOTO_CARD_SIZE
+from backend.shared_state import SharedMap, SharedBlobCache
+from backend.feed_cache import (
+    bump_feed_version, get_feed_version, feed_etag, etag_matches, get_cached_page, put_cached_page,
+)
 from backend.processing_utils import (
     _walk_parts, 
     _decode_body, 
@@ -179,10 +193,18 @@ async def lifespan(app: FastAPI):
     if db.is_closed():
         logging.info("Evento STARTUP: Connessione al database...")
         db.connect()
-    initialize_db()
+    # Con più worker uvicorn le migrazioni girano una alla volta
+    with shared_state.process_lock(str(DATA_DIR / ".initialize_db.lock")):
+        initialize_db()
+    sse_hub.start(REDIS_URL if redis_client else None)
+    photo_prefetcher.start(redis_client)
+    bulk_jobs.runner.bind(redis_client)
     logging.info("Evento STARTUP: Avvio completato.")
     yield
     logging.info("Evento SHUTDOWN: Inizio spegnimento applicazione...")
+    await bulk_jobs.runner.stop()
+    await sse_hub.stop()
+    await photo_prefetcher.stop()
     try:
         await PROXY_HTTP_CLIENT.aclose()
     except Exception:
@@ -193,7 +215,7 @@ async def lifespan(app: FastAPI):
         db.close()
     logging.info("Evento SHUTDOWN: Spegnimento completato.")
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 router_settings = APIRouter(prefix="/api/settings", tags=["settings"])
 router_auth = APIRouter(prefix="/auth", tags=["authentication"])
 router_api = APIRouter(prefix="/api", tags=["api"])
@@ -210,28 +232,17 @@ def _get_pending_auth_nonce_key(sid: str, nonce: str) -> str:
 
 def _load_pending_auth(request: Request) -> dict:
     sid = request.session.get("sid")
-    if sid and redis_client:
-        try:
-            raw = redis_client.get(_get_pending_auth_key(sid))
-            if isinstance(raw, str):
-                d = json.loads(raw)
-            elif isinstance(raw, (bytes, bytearray)):
-                d = json.loads(raw.decode("utf-8"))
-            else:
-                d = {}
-                logging.info(f"[AUTH] load_pending_auth sid={sid} keys={list(d.keys())}")
-                return d
-        except Exception as e:
-            logging.warning(f"[AUTH] redis get failed: {e}")
+    if sid:
+        d = PENDING_AUTH.get(sid)
+        if isinstance(d, dict):
+            logging.info(f"[AUTH] load_pending_auth sid={sid} keys={list(d.keys())}")
+            return d
     d = request.session.get("pending_auth") or {}
     logging.info(f"[AUTH] load_pending_auth(session) sid={sid} keys={list(d.keys())}")
     return d
 
 def _clear_pending_auth(request: Request) -> None:
     sid = request.session.get("sid")
-    if sid and redis_client:
-        try: redis_client.delete(_get_pending_auth_key(sid))
-        except Exception as e: logging.warning(f"[AUTH] redis del failed: {e}")
     request.session.pop("pending_auth", None)
     if sid:
         PENDING_AUTH.pop(sid, None)
@@ -266,13 +277,7 @@ def _derive_source_domain(item: dict) -> str:
 
 def log_feed(rid, stage, **kv):
     try:
-        logging.info(json.dumps({
-            "type": "feed",
-            "rid": rid,
-            "stage": stage,
-            **{k: (str(v) if not isinstance(v, (str, int, float, bool, type(None))) else v)
-               for k, v in kv.items()}
-        }))
+        logging.info(dumps_str({"type": "feed", "rid": rid, "stage": stage, **kv}))
     except Exception:
         # Mai fallire sul logging
         logging.info(f"[feed][{stage}] {kv}")
@@ -405,28 +410,28 @@ if not _client_secrets_candidate.exists():
         )
 CLIENT_SECRETS_FILE = str(_client_secrets_candidate)
 
-SETTINGS_STORE: Dict[str, Dict[str, Any]] = {}
-CREDENTIALS_STORE: Dict[str, dict] = {}
+# Stato condiviso tra i worker uvicorn (Redis + cache locale, vedi shared_state)
+SETTINGS_STORE = SharedMap("settings")        # user_id -> impostazioni
+CREDENTIALS_STORE = SharedMap("credentials")  # user_id -> credenziali OAuth
 R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID")
 R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
 R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
 R2_BUCKET = os.getenv("R2_BUCKET", "newsletter-images-dev")
 R2_PUBLIC_BASE_URL = (os.getenv("R2_PUBLIC_BASE_URL") or "").rstrip("/")
 
-INGEST_JOBS: dict[str, dict] = {}
-PENDING_AUTH: dict = {}  # job_id -> {"state": "...", "total": 0, "done": 0, "errors": 0}
+PENDING_AUTH = SharedMap("pending_auth", ttl=AUTH_PENDING_TTL, local_ttl=0, prefix="pending_auth:")  # sid -> {nonce: {pkce, state, ts, ...}}
 FRONTEND_DIR = Path(__file__).resolve().parent.parent / "frontend"
 INDEX = FRONTEND_DIR / "index.html"
-SSE_LISTENERS = defaultdict(list)
 print(f"[BOOT] Serving frontend from: {FRONTEND_DIR}")
 print(f"[BOOT] index.html exists? {INDEX.exists()}")
 IMG_PROXY_MAX_ITEMS = int(os.getenv("IMG_PROXY_MAX_ITEMS", "1024"))
 IMG_PROXY_TTL       = int(os.getenv("IMG_PROXY_TTL", str(24*3600)))  # 24h
 IMG_PROXY_MAX_BYTES = int(os.getenv("IMG_PROXY_MAX_BYTES", str(5*1024*1024)))  # 5MB
 PHOTOS_CACHE_MAX_ITEMS = int(os.getenv("PHOTOS_CACHE_MAX_ITEMS", "200"))
-photos_cache: "OrderedDict[str, dict]" = OrderedDict()
 PHOTOS_CACHE_TTL       = int(os.getenv("PHOTOS_CACHE_TTL", str(30*60)))  # 30m
-SESSION_EMAIL: dict[str, str] = {}
+photos_cache = SharedBlobCache("photos_img", PHOTOS_CACHE_MAX_ITEMS, PHOTOS_CACHE_TTL)
+SESSION_MAX_AGE = 60 * 60 * 24 * 7
+SESSION_EMAIL = SharedMap("session_email", ttl=SESSION_MAX_AGE)  # sid -> user_id
 
 def _seed_from_keyword(keyword: str | None) -> str:
     base = (keyword or "newsletter").strip().lower()
@@ -456,14 +461,21 @@ try:
 except redis_exceptions.ConnectionError as e:
     logging.error(f"API: Impossibile connettersi a Redis: {e}. Il kickstart potrebbe non funzionare.")
     redis_client = None # Imposta a None se la connessione fallisce
+shared_state.bind_redis(redis_client, redis.from_url(REDIS_URL) if redis_client else None)
+if shared_state.worker_count() > 1:
+    if redis_client is None:
+        logging.error(f"API: WEB_CONCURRENCY={shared_state.worker_count()} senza Redis: sessioni, login e foto non sono condivisi tra i worker.")
+    # Uno snapshot di metriche per worker, altrimenti si sovrascrivono a vicenda
+    metrics.bind_redis(redis_client, f"api-{os.getpid()}")
+else:
+    metrics.bind_redis(redis_client, "api")
 
 _TRANSPARENT_PNG = base64.b64decode(
     "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR4nGNgYAAAAAMAASsJTYQAAAAASUVORK5CYII="
 )
 # AUTH_STATE_STORE: dict[str, list[tuple[str, float]]] = defaultdict(list)  # sid -> [(state, ts), ...]
 # AUTH_STATE_TTL = 10 * 60  # 10 minuti
-PHOTOS_POOLS: DefaultDict[str, list[dict[str, Any]]] = defaultdict(list)   # user_id -> [mediaItems]
-PHOTOS_BEARERS: dict[str, str] = {}      
+PHOTOS_BEARERS = SharedMap("photos_bearer", ttl=60 * 60)     # user_id -> "Bearer ..." (token di accesso, ~1h)
 _BANNED_KW = {
     "news", "newsletter", "update", "story", "blog", "article", "notizie", "aggiornamenti",
     "email", "mail", "contenuto", "contenuti", "informazioni", "information", "comunicazione",
@@ -633,7 +645,7 @@ async def set_type_and_override(email_id: str, payload: dict, request: Request):
 
     # 1. Salva il tipo sulla singola mail
     n.type_tag = t
-    n.save()
+    n.save(only=[Newsletter.type_tag])
 
     # 2. Salva/Aggiorna la regola per il dominio (specifica per l'utente)
     if domain:
@@ -641,6 +653,7 @@ async def set_type_and_override(email_id: str, payload: dict, request: Request):
             conflict_target=[DomainTypeOverride.user_id, DomainTypeOverride.domain],
             update={DomainTypeOverride.type_tag: t}
         ).execute()
+        domain_profiles.bump_version(redis_client)
         
         # 3. Aggiorna in batch tutte le altre email dello stesso utente e dominio
         (Newsletter.update(type_tag=t)
@@ -648,6 +661,7 @@ async def set_type_and_override(email_id: str, payload: dict, request: Request):
                 ((Newsletter.sender_email.endswith("@" + domain)) | (Newsletter.source_domain == domain)))
          .execute())
 
+    bump_feed_version(redis_client, uid)
     return {"ok": True, "email_id": email_id, "domain": domain, "type_tag": t}
 
 @router_api.get("/gmail/thread-url/{msg_id}")
@@ -717,53 +731,28 @@ def gmail_message_view(msg_id: str, request: Request):
     final_html = _sanitize_view_html(final_html)
     return HTMLResponse(content=final_html, headers=headers)
 
-def clean_text_for_ai(html_content: str) -> str:
-    """Pulisce l'HTML, rimuove disclaimer/firme e lo tronca."""
-    if not html_content:
-        return ""
-    
-    # Rimuovi disclaimer e firme comuni con regex (case-insensitive)
-    patterns = [
-        r'unsubscribe from this list',
-        r'view in browser',
-        r'questo messaggio è confidenziale',
-        r'non rispondere a questa email',
-        r'sent from my iphone',
-    ]
-    text = html_content
-    for pattern in patterns:
-        text = re.sub(pattern, '', text, flags=re.IGNORECASE)
-
-    # Pulizia HTML di base
-    soup = BeautifulSoup(text, 'html.parser')
-    for element in soup(["script", "style", "head", "title", "meta", "header", "footer", "nav", "form"]):
-        element.extract()
-    
-    return ' '.join(soup.get_text(separator=' ', strip=True).split())
-
 def load_credentials_store():
-    global CREDENTIALS_STORE
+    """Carica le credenziali dal file nello store condiviso (quelle già in Redis non vengono sovrascritte)."""
     if os.path.exists(CREDENTIALS_PATH):
         try:
             with open(CREDENTIALS_PATH, "r", encoding="utf-8") as f:
-                CREDENTIALS_STORE = json.load(f)
-                logging.info(f"[CREDENTIALS] Caricate {len(CREDENTIALS_STORE)} credenziali da file.")
+                data = json.load(f)
+            added = CREDENTIALS_STORE.seed(data)
+            logging.info(f"[CREDENTIALS] Caricate {len(data)} credenziali da file ({added} nuove nello store).")
         except Exception as e:
             logging.warning(f"[CREDENTIALS] Impossibile caricare le credenziali: {e}")
-            CREDENTIALS_STORE = {}
     else:
         logging.info(f"[CREDENTIALS] Nessun file trovato in {CREDENTIALS_PATH}, avvio archivio vuoto.")
-        CREDENTIALS_STORE = {}
 
 def save_credentials_store() -> None:
     try:
         os.makedirs(Path(CREDENTIALS_PATH).parent, exist_ok=True)
-        # Definisci il percorso del file temporaneo
-        tmp_path = str(Path(CREDENTIALS_PATH + ".tmp"))
+        # Definisci il percorso del file temporaneo (uno per processo: più worker possono salvare insieme)
+        tmp_path = str(Path(f"{CREDENTIALS_PATH}.{os.getpid()}.tmp"))
 
-        # 1. Scrivi i dati nel file temporaneo
+        # 1. Scrivi i dati nel file temporaneo (worker e ingestor leggono le credenziali da qui)
         with open(tmp_path, "w", encoding="utf-8") as f:
-            json.dump(CREDENTIALS_STORE, f, ensure_ascii=False, indent=2)
+            json.dump(CREDENTIALS_STORE.snapshot(), f, ensure_ascii=False, indent=2)
 
         # 2. Rinomina atomicamente il file temporaneo a quello definitivo
         # Questa operazione è molto più veloce e sicura di una scrittura diretta.
@@ -783,33 +772,21 @@ def save_credentials_store() -> None:
         # Il file originale non sarà stato toccato.
         logging.error(f"[CREDENTIALS] Salvataggio credenziali fallito: {e}")
 
-def _get_pending_auth_key(sid: str) -> str:
-    """Restituisce la chiave Redis per un dato session ID."""
-    return f"pending_auth:{sid}"
-
 def _pending_auth(request: Request) -> dict:
-    """Ritorna la mappa pending per il sid corrente (in-memory, non in cookie)."""
+    """Ritorna una copia della mappa pending per il sid corrente; le modifiche vanno salvate con _save_pending_auth."""
     sid = request.session.get("sid")
     if not sid:
         sid = str(uuid.uuid4())
         request.session["sid"] = sid
-    store = PENDING_AUTH.get(sid)
-    if store is None:
-        restored = _load_pending_auth(request)
-        store = dict(restored) if restored else {}
-        PENDING_AUTH[sid] = store
-    return store
+    restored = _load_pending_auth(request)
+    return dict(restored) if restored else {}
 
 def _save_pending_auth(request: Request, data: dict):
     sid = request.session.get("sid")
     if not sid: return
-    ok = False
-    if redis_client:
-        try:
-            redis_client.set(_get_pending_auth_key(sid), json.dumps(data), ex=AUTH_PENDING_TTL)
-            ok = True
-        except Exception as e:
-            logging.error(f"[AUTH] redis set failed: {e}")
+    # PENDING_AUTH è condivisa (Redis, senza cache locale): il callback può arrivare a un altro worker
+    PENDING_AUTH[sid] = data
+    ok = shared_state.is_shared()
 
     # Versione "slim" da mettere nel cookie di sessione (evita overflow >4KB)
     session_data: dict[str, dict] = {}
@@ -827,7 +804,6 @@ def _save_pending_auth(request: Request, data: dict):
         session_data[nonce] = {k: v for k, v in slim.items() if v is not None}
 
     request.session["pending_auth"] = session_data
-    PENDING_AUTH[sid] = data
     logging.info(
         "[AUTH] save_pending_auth sid=%s via=%s keys=%s (session_keys=%s)",
         sid,
@@ -859,19 +835,11 @@ def _cleanup_pending_auth(request: Request):
         cleaned[nonce] = data
 
     if not cleaned:
-        PENDING_AUTH.pop(sid, None)
-        request.session.pop("pending_auth", None)
-        if redis_client:
-            try:
-                redis_client.delete(_get_pending_auth_key(sid))
-            except Exception:
-                pass
+        _clear_pending_auth(request)
         return
 
     if cleaned != (current or {}):
         _save_pending_auth(request, cleaned)
-    else:
-        PENDING_AUTH[sid] = dict(cleaned)
 
 def _gmail_service_for(request: Request):
     # Usa sempre l'user_id salvato in sessione (non più il sid)
@@ -1018,30 +986,11 @@ def _current_user_id(request: Request) -> str:
         raise HTTPException(status_code=401, detail="Utente non autenticato.")
     return uid
 
-def _user_pool(uid: str) -> list[dict]:
-    return PHOTOS_POOLS.setdefault(uid, [])
-
 def _user_bearer(uid: str) -> str | None:
     return PHOTOS_BEARERS.get(uid)
 
-def _pkey(photo_id: str, w: int, h: int, mode: str) -> str:
-    return f"{photo_id}:{w}:{h}:{mode}"
-
-def _photos_cache_get(k: str):
-    ent = photos_cache.get(k)
-    if not ent:
-        return None
-    if (time.time() - ent["ts"]) > PHOTOS_CACHE_TTL:
-        photos_cache.pop(k, None)
-        return None
-    photos_cache.move_to_end(k, last=True)
-    return ent
-
-def _photos_cache_put(k: str, ent: dict):
-    photos_cache[k] = ent
-    photos_cache.move_to_end(k, last=True)
-    while len(photos_cache) > PHOTOS_CACHE_MAX_ITEMS:
-        photos_cache.popitem(last=False)
+# Download delle foto del pool con cache, prefetch e rinnovo dei baseUrl (vedi photo_prefetch)
+photo_prefetcher = PhotoPrefetcher(photos_cache, _user_bearer)
 
 # R2_PUBLIC_BASE_URL è già definita nel file: lo riutilizziamo per la whitelist
 def _host_or_none(u: str) -> str | None:
@@ -1059,28 +1008,16 @@ IMG_ALLOWED_HOSTS = {h for h in [
     "lh3.googleusercontent.com",
 ] if h}
 
-image_cache: OrderedDict[str, Dict[str, Any]] = OrderedDict()  # url -> {"ts": float, "bytes": bytes, "ct": str, "etag": str|None}
+# url -> {"ts": float, "bytes": bytes, "ct": str, "etag": str|None}; LRU locale + livello condiviso in Redis
+image_cache = SharedBlobCache("img_proxy", IMG_PROXY_MAX_ITEMS, IMG_PROXY_TTL)
 
 def _cache_get(url: str) -> dict | None:
-    """Recupera un'immagine dalla cache se è valida."""
-    ent = image_cache.get(url)
-    if not ent:
-        return None
-    # Rimuovi se scaduta (TTL è in IMG_PROXY_TTL)
-    if (time.time() - ent["ts"]) > IMG_PROXY_TTL:
-        image_cache.pop(url, None)
-        return None
-    # Sposta in cima per la logica LRU (Least Recently Used)
-    image_cache.move_to_end(url, last=True)
-    return ent
+    """Recupera un'immagine dalla cache se è valida (TTL IMG_PROXY_TTL)."""
+    return image_cache.get(url)
 
 def _cache_put(url: str, ent: dict):
-    """Aggiunge un'immagine alla cache e rimuove gli elementi più vecchi se necessario."""
-    image_cache[url] = ent
-    image_cache.move_to_end(url, last=True)
-    # Mantieni la cache entro i limiti di dimensione
-    while len(image_cache) > IMG_PROXY_MAX_ITEMS:
-        image_cache.popitem(last=False)
+    """Aggiunge un'immagine alla cache (locale e, se piccola abbastanza, condivisa)."""
+    image_cache.put(url, ent)
 
 def _is_private_host(host: str) -> bool:
     if not host: return True
@@ -1134,23 +1071,24 @@ RECENT_PXB_IDS = deque(maxlen=200)
 
 
 def load_settings_store():
-    global SETTINGS_STORE
+    """Carica le impostazioni dal file nello store condiviso (quelle già in Redis non vengono sovrascritte)."""
     if os.path.exists(SETTINGS_PATH):
         try:
             with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
-                SETTINGS_STORE = json.load(f)
+                SETTINGS_STORE.seed(json.load(f))
         except Exception:
-            SETTINGS_STORE = {}
+            pass
     else:
         logging.info("[SETTINGS] Nessuna configurazione persistente trovata, uso defaults.")
-        SETTINGS_STORE = {}
 
 
 def save_settings_store():
     try:
         os.makedirs(Path(SETTINGS_PATH).parent, exist_ok=True)
-        with open(SETTINGS_PATH, "w", encoding="utf-8") as f:
-            json.dump(SETTINGS_STORE, f, ensure_ascii=False, indent=2)
+        tmp_path = f"{SETTINGS_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(SETTINGS_STORE.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, SETTINGS_PATH)
     except Exception:
         pass
 
@@ -1242,7 +1180,7 @@ async def add_request_id(request: Request, call_next):
         resp = await call_next(request)
         dur_ms = int((time.perf_counter() - start) * 1000)
         resp.headers["X-Request-Id"] = str(rid)
-        logging.info(json.dumps({
+        logging.info(dumps_str({
             "type": "http_request",
             "rid": str(rid),
             "method": request.method,
@@ -1258,26 +1196,8 @@ async def add_request_id(request: Request, call_next):
 
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 
-def _iso_utc(value):
-    """Rende una stringa ISO-8601 in UTC da datetime o stringa ISO-like."""
-    if value is None:
-        return None
-    if isinstance(value, datetime):
-        dt = value if value.tzinfo else value.replace(tzinfo=timezone.utc)
-        return dt.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
-    if isinstance(value, str):
-        try:
-            s = value.strip()
-            # supporta formati "2025-09-21T22:23:00Z" o con offset
-            if s.endswith("Z"):
-                s = s.replace("Z", "+00:00")
-            dt = datetime.fromisoformat(s)
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-            return dt.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
-        except Exception:
-            return value  # se non parsabile, restituisci com’è
-    return str(value)
+# Rende una stringa ISO-8601 in UTC da datetime o stringa ISO-like (vedi fastjson.iso_utc)
+_iso_utc = iso_utc
 
 
 @app.get("/api/feed/item/{email_id}")
@@ -1314,7 +1234,7 @@ async def get_feed_item(email_id: str, request: Request):
         "rfc822_message_id": n.rfc822_message_id,
     }
     item = _add_gmail_deep_link_fields(item)
-    return JSONResponse(item)
+    return FastJSONResponse(item)
 
     
 @app.get("/api/img")
@@ -1459,6 +1379,7 @@ async def _proxy_rehost_fallback(email_id: str, original_url: str, request: Requ
         n.image_url = new_url
         n.is_complete = bool(n.ai_title and n.ai_summary_markdown and new_url)
         n.save()
+        bump_feed_version(redis_client, n.user_id)
     except Exception as e:
         logging.warning("[PROXY] Salvataggio newsletter fallito per %s: %s", email_id, e)
 
@@ -1578,7 +1499,7 @@ app.add_middleware(
     session_cookie="nl_sess",
     same_site="none",
     https_only=SESSION_HTTPS_ONLY,
-    max_age=60*60*24*7,
+    max_age=SESSION_MAX_AGE,
     domain=SESSION_DOMAIN if IS_PROD else None,
 )
 
@@ -1703,11 +1624,19 @@ def get_settings(request: Request):
 
 @app.get("/api/ingest/status/{job_id}")
 async def ingest_status(job_id: str):
-    st = INGEST_JOBS.get(job_id)
+    st = ingest_jobs.get(redis_client, job_id) if redis_client else None
     if not st:
         raise HTTPException(404, "Job non trovato")
     return st
 
+@app.get("/api/jobs/{job_id}")
+async def bulk_job_status(job_id: str, request: Request):
+    uid = _current_user_id(request)
+    st = bulk_jobs.get(job_id)
+    if not st or st.get("user_id") != uid:
+        raise HTTPException(404, "Job non trovato")
+    return st
+
 @router_settings.post("")
 def update_settings(payload: UserSettingsIn, request: Request):
     user_id = get_user_id_from_session(request)
@@ -1740,66 +1669,34 @@ app.include_router(router_api)
 @app.get("/api/photos/pool/debug")
 async def debug_photos_pool(request: Request):
     uid = _current_user_id(request)
-    pool = _user_pool(uid)
-    sample = pool[:5]
-    return JSONResponse({"user_id": uid, "pool_size": len(pool), "sample": sample})
+    sample = photo_pool.head(uid, 5)
+    return JSONResponse({"user_id": uid, "pool_size": photo_pool.count(uid), "sample": sample})
 
 @app.get("/api/photos/proxy/{photo_id}")
 async def proxy_photo(photo_id: str, request: Request, w: int = 1600, h: int = 900, mode: str = "no"):
     uid = _current_user_id(request)
-    pool = _user_pool(uid)
-    bearer = _user_bearer(uid)
 
-    item = next((x for x in pool if (x.get("id") == photo_id)), None)
+    item = photo_pool.get(uid, photo_id)
     if not item:
         raise HTTPException(status_code=404, detail="Foto non trovata in pool")
 
-    base = (item.get("baseUrl") or "").strip()
-    auth = (item.get("authUrl") or "").strip()
-    suffix = f"=w{w}-h{h}-{mode}"
-
-    key = f"{uid}:{photo_id}:{w}:{h}:{mode}"  # cache separata per utente
-    hit = _photos_cache_get(key)
-    if hit:
-        return StreamingResponse(
-            io.BytesIO(hit["bytes"]),
-            media_type=hit["ct"],
-            headers={
-                "Cache-Control": "public, max-age=31536000, immutable",
-                "X-Cache": "HIT",
-                "Access-Control-Allow-Origin": "*",
-            },
-        )
-        
-    urls_and_modes: list[tuple[str, dict]] = []
-    if base: 
-        urls_and_modes.append((base + suffix, {}))
-    if base and bearer: 
-        urls_and_modes.append((base + suffix, {"Authorization": bearer}))
-    if base and bearer: 
-        urls_and_modes.append((base, {"Authorization": bearer}))
-    if base and bearer:
-        sep = "&" if "?" in base else "?"
-        urls_and_modes.append((base + f"{sep}alt=media", {"Authorization": bearer}))
-    if auth and bearer:
-        urls_and_modes.append((auth, {"Authorization": bearer}))
-
-    tried = []
-    async with httpx.AsyncClient(timeout=20.0) as c:
-        for url, headers in urls_and_modes:
-            r = await c.get(url, headers=headers, follow_redirects=True)
-            tried.append((url, r.status_code))
-            if r.headers.get("Content-Length") and int(r.headers["Content-Length"]) > IMG_PROXY_MAX_BYTES:
-                raise HTTPException(413, "Immagine troppo grande")
-
-            if r.status_code == 200:
-                ct = r.headers.get("Content-Type", "image/jpeg")
-                body = r.content
-                _photos_cache_put(key, {"ts": time.time(), "bytes": body, "ct": ct})
-                return StreamingResponse(io.BytesIO(body), media_type=ct,
-                                         headers={"Cache-Control": "public, max-age=31536000, immutable", "X-Cache": "MISS"})
-    logging.warning("[BACKEND] proxy fallito. Tentativi: %s", tried)
-    raise HTTPException(status_code=502, detail="Impossibile recuperare l'immagine dal provider")
+    # Cache (anche se riempita dal prefetch), download già in corso o nuovo download
+    t0 = time.time()
+    try:
+        ent = await photo_prefetcher.get(uid, item, w, h, mode)
+    except PhotoTooLarge:
+        raise HTTPException(413, "Immagine troppo grande")
+    if not ent:
+        raise HTTPException(status_code=502, detail="Impossibile recuperare l'immagine dal provider")
+    return StreamingResponse(
+        io.BytesIO(ent["bytes"]),
+        media_type=ent["ct"],
+        headers={
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "X-Cache": "HIT" if ent["ts"] < t0 else "MISS",
+            "Access-Control-Allow-Origin": "*",
+        },
+    )
 
 @app.get("/api/photos/albums")
 async def list_albums(authorization: str = Header(None), page_size: int = 50):
@@ -1890,7 +1787,6 @@ async def import_latest(body: ImportLatestBody, request: Request, authorization:
     uid = _current_user_id(request)
     PHOTOS_BEARERS[uid] = authorization
 
-    pool = _user_pool(uid)
     url = "https://photoslibrary.googleapis.com/v1/mediaItems"
     params = {"pageSize": min(max(body.limit, 1), 100)}
     async with httpx.AsyncClient(timeout=20.0) as c:
@@ -1898,11 +1794,7 @@ async def import_latest(body: ImportLatestBody, request: Request, authorization:
     if r.status_code != 200:
         raise HTTPException(status_code=r.status_code, detail=r.text)
 
-    if (body.mode or "append") == "replace":
-        PHOTOS_POOLS[uid] = []
-        pool = _user_pool(uid)
-
-    added = 0
+    items = []
     for mi in (r.json().get("mediaItems") or []):
         base_url = _pick_base_url(mi)
         if not base_url: 
@@ -1911,21 +1803,20 @@ async def import_latest(body: ImportLatestBody, request: Request, authorization:
         auth_url = (mf.get("downloadUrl") or mf.get("download_url") or
                     (mf.get("image") or {}).get("downloadUrl") or
                     (mf.get("photo") or {}).get("downloadUrl"))
-        pool.append({
+        items.append({
             "id": mi.get("id"),
             "baseUrl": base_url,
             "authUrl": auth_url,
             "mimeType": mi.get("mimeType"),
             "filename": mi.get("filename"),
         })
-        added += 1
-    return {"ok": True, "cached": added, "pool_size": len(pool)}
+    added = photo_pool.add(uid, items, replace=(body.mode or "append") == "replace")
+    return {"ok": True, "cached": added, "pool_size": photo_pool.count(uid)}
 
 @app.delete("/api/photos/pool/clear")
 async def clear_photos_pool(request: Request):
     uid = _current_user_id(request)
-    n = len(PHOTOS_POOLS.get(uid, []))
-    PHOTOS_POOLS[uid] = []
+    n = photo_pool.clear(uid)
     return {"ok": True, "removed": n}
 
 class CacheFromSessionBody(BaseModel):
@@ -2091,29 +1982,24 @@ def _pick_base_url(mi: dict) -> str:
 @app.post("/api/photos/cache")
 async def cache_photos(payload: CachePhotosRequest, request: Request):
     uid = _current_user_id(request)
-    pool = _user_pool(uid)
 
     client_ip = request.client.host if request and request.client else "?"
     logging.info(f"/api/photos/cache: uid={uid} from {client_ip}, items={len(payload.items)}, mode={payload.mode}")
 
-    if payload.mode == "replace":
-        PHOTOS_POOLS[uid] = []
-        pool = _user_pool(uid)
-
-    before, added = len(pool), 0
+    items = []
     for it in payload.items:
         if not it.baseUrl:
             logging.warning("/api/photos/cache: item senza baseUrl → skip")
             continue
-        pool.append({
+        items.append({
             "id": it.id,
             "baseUrl": it.baseUrl,
             "mimeType": it.mimeType,
             "filename": it.filename
         })
-        added += 1
 
-    after = len(pool)
+    added = photo_pool.add(uid, items, replace=payload.mode == "replace")
+    after = photo_pool.count(uid)
     return JSONResponse({"ok": True, "added": added, "pool_size": after})
 
 @app.post("/api/photos/picker/session/cache")
@@ -2122,7 +2008,6 @@ async def cache_from_session(body: CacheFromSessionBody, request: Request, autho
         raise HTTPException(status_code=401, detail="Manca Authorization: Bearer <token>")
     uid = _current_user_id(request)
     PHOTOS_BEARERS[uid] = authorization
-    pool = _user_pool(uid)
 
     attempts, media_items = 0, []
     while attempts < 20 and not media_items:
@@ -2139,11 +2024,7 @@ async def cache_from_session(body: CacheFromSessionBody, request: Request, autho
     if not media_items:
         return JSONResponse({"ok": False, "cached": 0, "reason": "no_media_yet"}, status_code=202)
 
-    if (body.mode or "append") == "replace":
-        PHOTOS_POOLS[uid] = []
-        pool = _user_pool(uid)
-
-    added = 0
+    items = []
     for mi in media_items:
         base_url = _pick_base_url(mi)
         if not base_url:
@@ -2154,24 +2035,23 @@ async def cache_from_session(body: CacheFromSessionBody, request: Request, autho
             (mf.get("image") or {}).get("downloadUrl") or
             (mf.get("photo") or {}).get("downloadUrl")
         )
-        pool.append({
+        items.append({
             "id": mi.get("id") or (mi.get("mediaItem") or {}).get("id"),
             "baseUrl": base_url,
             "authUrl": auth_url,
             "mimeType": mi.get("mimeType") or mi.get("mime_type") or (mi.get("mediaItem") or {}).get("mimeType"),
             "filename": mi.get("filename") or (mi.get("mediaItem") or {}).get("filename"),
         })
-        added += 1
 
-    return {"ok": True, "cached": added, "pool_size": len(pool)}
+    added = photo_pool.add(uid, items, replace=(body.mode or "append") == "replace")
+    return {"ok": True, "cached": added, "pool_size": photo_pool.count(uid)}
 
 # --- FUNZIONI HELPER ---
 async def get_google_photos(user_id: str, count=25):
-    pool = _user_pool(user_id)
-    if not pool:
+    photos = photo_pool.sample(user_id, count)
+    if not photos:
         raise HTTPException(status_code=409, detail="Foto non selezionate. Apri il Picker.")
-    take = min(count, len(pool))
-    return random.sample(pool, take) if len(pool) >= take else pool[:take]
+    return photos
 def extract_html_from_payload(payload: dict) -> str:
     if not payload:
         return ""
@@ -2206,87 +2086,6 @@ def clean_html(html_content):
         element.extract()
     return ' '.join(soup.get_text(separator=' ', strip=True).split())
 
-async def get_ai_summary(content: str, client: httpx.AsyncClient, type_tag: str | None = None):
-    raw = content or ""
-    clean_content = clean_html(raw)[:4000]
-
-    # Istruzioni aggiornate per includere la parola "JSON"
-    instructions = """
-Developer: # Ruolo e Obiettivo
-- Sintetizzare il contenuto delle newsletter, generando un riassunto adatto a un feed in stile Instagram, mettendo in evidenza l'obiettivo principale della mail per l'utente.
-
-# Istruzioni
-- Analizza e riassumi il contenuto principale della newsletter.
-- Scrivi una descrizione conforme ai requisiti di output sotto riportati, assicurandoti di chiarire l'obiettivo della mail all'utente.
-- Escludi informazioni disponibili solo tramite abbonamento.
-
-# Contesto
-- Il riassunto sarà usato come anteprima su feed visuali tipo Instagram.
-- Il prompt non deve includere né fare riferimento a contenuti protetti da paywall o sottoscrizione.
-
-# REQUISITI DI OUTPUT (OBBLIGATORI)
-- Rispondi SOLO con un oggetto JSON valido. Il formato deve essere un JSON object.
-- Chiavi richieste: "title" (stringa) e "summary_markdown" (stringa).
-- "title": massimo 10 parole, in italiano.
-- "summary_markdown": massimo 400 caratteri totali, diviso in 2–3 paragrafi. Ogni paragrafo separato da UNA riga vuota e con una **parola chiave** in grassetto.
-- Vietato includere testo extra fuori dal JSON.
-"""
-    user_input = f"Testo da analizzare:\n---\n{clean_content}\n---"
-
-    try:
-        if not openai.api_key:
-            raise ValueError("La chiave API di OpenAI non è stata impostata nel file .env")
-
-        # Payload aggiornato al formato moderno e con più token
-        payload = {
-            "model": "gpt-5-nano",
-            "input": [
-                {"role": "system", "content": [{"type": "input_text", "text": instructions}]},
-                {"role": "user", "content": [{"type": "input_text", "text": user_input}]}
-            ],
-            "text": {
-                "format": {"type": "json_object"},
-                "verbosity": "low"
-            },
-            "reasoning": {"effort": "minimal"},
-            "max_output_tokens": 600
-        }
-
-        resp = await client.post(
-            "https://api.openai.com/v1/responses",
-            json=payload,
-            headers={
-                "Authorization": f"Bearer {openai.api_key}",
-                "Content-Type": "application/json",
-            },
-            timeout=15.0,
-        )
-        
-        try:
-            resp.raise_for_status()
-        except httpx.HTTPStatusError as e:
-            logging.error("[AI Summary] OpenAI error body: %s", e.response.text)
-            raise
-
-        data = resp.json()
-        text = _extract_output_text(data)
-        if not text:
-            raise ValueError(f"Risposta senza testo utile: {data}")
-
-        clean_json_str = _extract_json_from_string(text)
-        obj = json.loads(clean_json_str) if clean_json_str else {}
-
-        if not isinstance(obj, dict) or "title" not in obj or "summary_markdown" not in obj:
-            raise ValueError("JSON non valido o chiavi richieste mancanti.")
-
-        obj["title"] = obj["title"][:200]
-        obj["summary_markdown"] = obj["summary_markdown"][:1200]
-        return obj
-
-    except Exception as e:
-        logging.error(f"Errore critico in get_ai_summary: {e}", exc_info=True)
-        return {"title": "Errore Elaborazione AI", "summary_markdown": "Si è verificato un problema durante l'analisi."}
-    
 async def _pixabay_search(client: httpx.AsyncClient, query: str) -> list[dict]:
     if not PIXABAY_KEY:
         return []
@@ -2822,38 +2621,34 @@ async def kickstart_initial_ingestion(user_id: str, job_id: str | None = None):
         
         if not messages:
             logging.info(f"Kickstart: Nessuna email trovata per {user_id}.")
-            if job_id and job_id in INGEST_JOBS:
-                INGEST_JOBS[job_id]["state"] = "done"
+            if job_id:
+                _set_job(job_id, state="done")
             return
 
         existing_ids = {n.email_id for n in Newsletter.select(Newsletter.email_id).where(Newsletter.user_id == user_id)}
         new_messages = [msg for msg in messages if msg['id'] not in existing_ids]
 
-        if job_id and job_id in INGEST_JOBS:
-            INGEST_JOBS[job_id]["total"] = len(new_messages)
+        if job_id:
+            _set_job(job_id, total=len(new_messages))
         
         if not new_messages:
             logging.info(f"Kickstart: Nessuna *nuova* email trovata per {user_id}.")
-            if job_id and job_id in INGEST_JOBS:
-                INGEST_JOBS[job_id]["state"] = "done"
+            if job_id:
+                _set_job(job_id, state="done")
             return
 
-        for msg in new_messages:
-            Newsletter.get_or_create(
-                email_id=msg['id'],
-                user_id=user_id,
-                defaults={"received_date": datetime.now(timezone.utc)}
-            )
-            job_payload = {"email_id": msg['id'], "user_id": user_id, "job_id": job_id}
-            if redis_client:
-                redis_client.rpush('email_queue', json.dumps(job_payload))
+        new_ids = [msg['id'] for msg in new_messages]
+        insert_stubs(user_id, new_ids, received_date=datetime.now(timezone.utc))
+        if redis_client:
+            redis_client.rpush('email_queue', *[
+                json.dumps({"email_id": mid, "user_id": user_id, "job_id": job_id}) for mid in new_ids])
         
         logging.info(f"Kickstart: Aggiunti {len(new_messages)} lavori alla coda per l'utente {user_id}. Il worker prenderà il controllo.")
 
     except Exception as e:
         logging.error(f"Kickstart fallito per l'utente {user_id}: {e}", exc_info=True)
-        if job_id and job_id in INGEST_JOBS:
-            INGEST_JOBS[job_id]["state"] = "failed"
+        if job_id:
+            _set_job(job_id, state="failed")
         
 @app.get("/debug/oauth-config")
 def debug_oauth_config(request: Request):
@@ -2891,15 +2686,12 @@ def _parse_cursor(cur: str | None) -> Tuple[datetime | None, str | None]:
         return None, None
 
 def get_ingestion_state(user_id: str) -> dict:
-    """Restituisce lo stato di ingestione per un utente specifico."""
-    active_job = next(
-        (
-            jid
-            for jid, st in INGEST_JOBS.items()
-            if st.get("user_id") == user_id and st.get("state") in ("queued", "running")
-        ),
-        None,
-    )
+    """Restituisce lo stato di ingestione per un utente specifico (una GET sull'indice dei job attivi)."""
+    try:
+        active_job = ingest_jobs.active_job(redis_client, user_id)
+    except Exception as e:
+        logging.warning(f"[JOB] lettura job attivo fallita per {user_id}: {e}")
+        active_job = None
     return {"running": bool(active_job), "job_id": active_job}
 
 @app.get("/api/feed")
@@ -2908,97 +2700,177 @@ async def get_feed(
     bg: BackgroundTasks,
     page_size: int = Query(20, ge=1, le=50),
     before: str | None = Query(None, description="cursor: 'ISOZ|<email_id>'"),
+    type_tag: str | None = Query(None, max_length=24),
+    topic_tag: str | None = Query(None, max_length=32),
+    source_domain: str | None = Query(None, max_length=255),
+    tag: str | None = Query(None, max_length=32),
+    is_favorite: bool | None = Query(None),
 ):
     rid = getattr(request.state, "request_id", "-")
     user_id = get_user_id_from_session(request)
     if not user_id or user_id == "anonymous":
         raise HTTPException(status_code=401, detail="Non autenticato")
 
-    log_feed(rid, "in", user_id=user_id, before=before, limit=page_size)
+    filters = {k: v for k, v in {
+        "type_tag": type_tag, "topic_tag": topic_tag, "source_domain": source_domain,
+        "tag": tag, "is_favorite": is_favorite,
+    }.items() if v not in (None, "")}
+    log_feed(rid, "in", user_id=user_id, before=before, limit=page_size, **filters)
     t0_total = time.perf_counter()
 
     settings = SETTINGS_STORE.get(user_id, {"hidden_domains": []})
     hidden = set(settings.get("hidden_domains", []))
+    state = get_ingestion_state(user_id)
 
-    base_q = (Newsletter
-        .select(
-            Newsletter.email_id, Newsletter.user_id,
-            Newsletter.sender_name, Newsletter.sender_email,
-            Newsletter.original_subject, Newsletter.ai_title, Newsletter.ai_summary_markdown,
-            Newsletter.image_url, Newsletter.received_date,
-            Newsletter.is_favorite, Newsletter.accent_hex,
-            Newsletter.tag, Newsletter.type_tag, Newsletter.topic_tag,
-            Newsletter.source_domain, Newsletter.thread_id, Newsletter.rfc822_message_id,
-            Newsletter.is_complete    
-        )
-        .where(
-            (Newsletter.user_id == user_id) &
-            (Newsletter.is_complete == True) &
-            (Newsletter.is_deleted == False) &
-            (Newsletter.received_date.is_null(False))
-        )
-        .order_by(Newsletter.received_date.desc(), Newsletter.email_id.desc())
-    )
-
-    if hidden:
-        base_q = base_q.where(~(Newsletter.source_domain.in_(list(hidden))))
-
+    # ETag dalla versione del feed (una GET su Redis): se il client ha già questa pagina, 304
+    version = get_feed_version(redis_client, user_id)
+    etag = None
+    cache_headers = {"Cache-Control": "private, no-cache"}
+    if version is not None:
+        etag = feed_etag(user_id, version, {
+            "filters": filters, "before": before, "page_size": page_size,
+            "hidden": sorted(hidden), "ingest": state,
+        })
+        cache_headers["ETag"] = etag
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            metrics.incr("feed_cache.not_modified")
+            log_feed(rid, "out", not_modified=True, dur_ms=int((time.perf_counter() - t0_total) * 1000))
+            return Response(status_code=304, headers=cache_headers)
+        if not before:
+            cached = get_cached_page(redis_client, user_id, etag)
+            if cached is not None:
+                metrics.incr("feed_cache.hit")
+                log_feed(rid, "out", cached=True, dur_ms=int((time.perf_counter() - t0_total) * 1000))
+                return Response(content=cached, media_type="application/json", headers=cache_headers)
+        metrics.incr("feed_cache.miss")
+
+    # Proiezione materializzata: una card per thread, già deduplicata in scrittura,
+    # quindi la pagina è una scansione d'intervallo sulla chiave di feed_item (vedi feed_query)
+    cursor_key = None
     if before:
         last_dt, last_email = _parse_cursor(before)
         if last_dt and last_email:
-            base_q = base_q.where(
-                (Newsletter.received_date < last_dt) |
-                ((Newsletter.received_date == last_dt) & (Newsletter.email_id < last_email))
-            )
+            cursor_key = (last_dt, last_email)
+    base_q = build_feed_query(user_id, page_size + 1, filters, list(hidden), cursor_key)
 
     t0_db = time.perf_counter()
-    rows = list(base_q.limit(page_size + 1).dicts())
+    # Letto prima della pagina: le modifiche nel mezzo tornano (idempotenti) da /api/feed/changes
+    change_token = feed_changes.current_token()
+    rows = list(base_q.tuples())
     t_db_ms = (time.perf_counter() - t0_db) * 1000
 
     has_more = len(rows) > page_size
-    # 1. Definisci page_raw con i dati della pagina corrente (prima della deduplica)
-    page_raw = rows[:page_size]
-    
-    # 2. Esegui la deduplica partendo da page_raw
-    seen_threads = set()
-    page = [] # Questa sarà la lista finale e pulita
-    for item in page_raw:
-        tid = item.get("thread_id")
-        if tid and tid in seen_threads:
-            continue
-        
-        if tid:
-            seen_threads.add(tid)
-        page.append(item)
-    
-    # 3. Calcola il cursore basandoti sull'ultimo elemento di page_raw
+    # Tuple -> card già complete di data ISO e deep link, in una passata (vedi shape_feed_rows)
+    final_page = shape_feed_rows(rows[:page_size])
+
     next_cursor = None
     if has_more:
-        # Usiamo l'ultimo elemento *prima* della deduplica per garantire una paginazione corretta
-        last_item_for_cursor = page_raw[-1]
-        next_cursor = f"{_iso_utc(last_item_for_cursor['received_date'])}|{last_item_for_cursor['email_id']}"
+        last_item_for_cursor = final_page[-1]
+        next_cursor = f"{last_item_for_cursor['received_date']}|{last_item_for_cursor['email_id']}"
 
-    # 4. Prepara la pagina finale per la risposta JSON
-    final_page = []
-    for item in page: # Itera sulla lista 'page' già deduplicata
-        item["received_date"] = _iso_utc(item.get("received_date"))
-        item = _add_gmail_deep_link_fields(item)
-        final_page.append(item)
-
-    state = get_ingestion_state(user_id)
-    
     dur_total_ms = (time.perf_counter() - t0_total) * 1000
-    log_feed(rid, "out", has_more=has_more, page_len=len(page), dur_ms=int(dur_total_ms), db_ms=int(t_db_ms))
+    log_feed(rid, "out", has_more=has_more, page_len=len(final_page), dur_ms=int(dur_total_ms), db_ms=int(t_db_ms))
 
-    resp = JSONResponse({
+    resp = FastJSONResponse({
         "feed": final_page,
         "next_cursor": next_cursor,
         "has_more": has_more,
         "ingest": state,
-    })
+        "change_token": change_token,
+    }, headers=cache_headers)
+    resp.headers["Server-Timing"] = f"db;dur={t_db_ms:.0f}"
+    if etag and not before:
+        put_cached_page(redis_client, user_id, etag, bytes(resp.body))
+    return resp
+
+@app.get("/api/feed/search")
+async def search_feed_endpoint(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    page_size: int = Query(20, ge=1, le=50),
+    cursor: str | None = Query(None, description="cursor: '<score>|<rowid>' da next_cursor"),
+):
+    """Ricerca full-text (FTS5, ranking BM25) su titolo, riassunto, oggetto, mittente e corpo."""
+    rid = getattr(request.state, "request_id", "-")
+    user_id = get_user_id_from_session(request)
+    if not user_id or user_id == "anonymous":
+        raise HTTPException(status_code=401, detail="Non autenticato")
+
+    settings = SETTINGS_STORE.get(user_id, {"hidden_domains": []})
+    hidden = list(settings.get("hidden_domains", []))
+
+    t0_db = time.perf_counter()
+    try:
+        res = await asyncio.to_thread(search_feed, user_id, q, page_size, cursor, hidden)
+    except SearchQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PeeweeOperationalError as e:
+        logging.error(f"[search] errore FTS: {e}")
+        raise HTTPException(status_code=503, detail="Ricerca non disponibile")
+    t_db_ms = (time.perf_counter() - t0_db) * 1000
+
+    items = []
+    for item in res["items"]:
+        item["received_date"] = _iso_utc(item.get("received_date"))
+        items.append(_add_gmail_deep_link_fields(item))
+    log_feed(rid, "search", q_len=len(q), results=len(items), has_more=res["has_more"], db_ms=int(t_db_ms))
+
+    resp = FastJSONResponse({"feed": items, "next_cursor": res["next_cursor"], "has_more": res["has_more"]})
+    resp.headers["Server-Timing"] = f"db;dur={t_db_ms:.0f}"
+    return resp
+
+@app.get("/api/feed/changes")
+async def get_feed_changes(
+    request: Request,
+    since: int = Query(..., ge=0, description="change_token da /api/feed o da una chiamata precedente"),
+    limit: int = Query(500, ge=1, le=2000),
+):
+    """Card inserite/aggiornate ed email_id rimossi dal feed dopo `since` (vedi feed_changes)."""
+    rid = getattr(request.state, "request_id", "-")
+    user_id = get_user_id_from_session(request)
+    if not user_id or user_id == "anonymous":
+        raise HTTPException(status_code=401, detail="Non autenticato")
+
+    hidden = list(SETTINGS_STORE.get(user_id, {"hidden_domains": []}).get("hidden_domains", []))
+    t0_db = time.perf_counter()
+    res = await asyncio.to_thread(feed_changes.changes_since, user_id, since, limit, hidden)
+    t_db_ms = (time.perf_counter() - t0_db) * 1000
+    await asyncio.to_thread(feed_changes.maybe_prune)
+    log_feed(rid, "changes", since=since, upserted=len(res["upserted"]), removed=len(res["removed"]),
+             reset=res["reset"], has_more=res["has_more"], db_ms=int(t_db_ms))
+
+    resp = FastJSONResponse(res, headers={"Cache-Control": "no-store"})
     resp.headers["Server-Timing"] = f"db;dur={t_db_ms:.0f}"
     return resp
 
+FACET_LIST_LIMIT = int(os.getenv("FACET_LIST_LIMIT", "50"))
+
+@app.get("/api/feed/facets")
+def get_feed_facets(request: Request):
+    """Conteggi per type_tag, topic_tag, source_domain e tag delle card del feed (da feed_facet_count)."""
+    user_id = get_user_id_from_session(request)
+    if not user_id or user_id == "anonymous":
+        raise HTTPException(status_code=401, detail="Non autenticato")
+
+    hidden = set(SETTINGS_STORE.get(user_id, {}).get("hidden_domains", []))
+    rows = (FeedFacetCount
+            .select(FeedFacetCount.facet, FeedFacetCount.value, FeedFacetCount.n)
+            .where((FeedFacetCount.user_id == user_id) & (FeedFacetCount.n > 0))
+            .order_by(FeedFacetCount.n.desc(), FeedFacetCount.value)
+            .tuples())
+
+    out: dict[str, Any] = {"total": 0, "favorites": 0, **{c: [] for c in FACET_COLUMNS}}
+    for facet, value, count in rows:
+        if facet == "_total":
+            out["total"] = count
+        elif facet == "is_favorite":
+            out["favorites"] = count
+        elif facet in out and len(out[facet]) < FACET_LIST_LIMIT:
+            if facet == "source_domain" and value in hidden:
+                continue
+            out[facet].append({"value": value, "count": count})
+    return out
+
 @app.get("/api/_diag/feed-stats")
 def feed_stats(request: Request):
     rid = getattr(request.state, "request_id", "-")
@@ -3010,15 +2882,25 @@ def feed_stats(request: Request):
     q_complete = q_all.where(Newsletter.is_complete == True)
     q_null_date = q_complete.where(Newsletter.received_date.is_null(True))
     
+    facet_q = FeedFacetCount.select().where((FeedFacetCount.user_id == user_id) & (FeedFacetCount.n > 0))
+    total_visible = facet_q.where(FeedFacetCount.facet == "_total").first()
     counts = {
         "total": q_all.count(),
         "complete": q_complete.count(),
         "complete_null_date": q_null_date.count(),
-        "distinct_domains": (q_complete.select(fn.COUNT(fn.DISTINCT(Newsletter.source_domain))).scalar()),
+        # Dai contatori dei facet: niente scansione delle righe
+        "visible": total_visible.n if total_visible else 0,
+        "distinct_domains": facet_q.where(FeedFacetCount.facet == "source_domain").count(),
     }
     log_feed(rid, "diag", **counts)
     return counts
 
+@app.get("/api/_diag/metrics")
+def diag_metrics(request: Request):
+    """Metriche del processo corrente e snapshot pubblicati dagli altri processi (worker, ingestor)."""
+    _ = _current_user_id(request)
+    return {"local": metrics.snapshot(), "processes": metrics.read_all(redis_client), "sse": sse_connections.stats()}
+
 @app.post("/api/ingest/trigger")
 async def trigger_ingest(request: Request):
     """
@@ -3045,69 +2927,171 @@ class IngestPullBody(BaseModel):
     pages: int = Field(default=5, ge=1, le=20)
     target: int = Field(default=50, ge=1, le=500)
 
+def _publish_job_state(job_id: str, st: dict | None) -> None:
+    """Pubblica lo stato del job come evento SSE "progress" (a tutte le repliche). Non solleva."""
+    if st is None:
+        return
+    try:
+        sse_publish(redis_client, job_id, "progress", st)
+    except Exception as e:
+        logging.warning(f"[SSE] publish progress fallito per {job_id}: {e}")
+
+def _set_job(job_id: str | None, **fields) -> None:
+    """Aggiorna lo stato (in Redis) di un job di ingest e lo notifica ai client SSE."""
+    if not job_id or not redis_client:
+        return
+    try:
+        st = ingest_jobs.update(redis_client, job_id, **fields)
+    except Exception as e:
+        logging.warning(f"[JOB {job_id}] aggiornamento stato fallito: {e}")
+        return
+    _publish_job_state(job_id, st)
+    if st:
+        feed_push.push_ingest(redis_client, st.get("user_id", ""), st)
+
 @app.post("/api/sse/notify/{job_id}/{email_id}")
 async def sse_notify(job_id: str, email_id: str):
     """
     Notifica i client SSE in ascolto su un job_id specifico che un'email è stata aggiornata.
+    Passa da Redis, quindi raggiunge le connessioni di tutte le repliche.
     """
     logging.info(f"[SSE NOTIFY] Ricevuta notifica per job_id={job_id}, email_id={email_id}")
-    # Invia l'evento solo alle code associate a questo specifico job_id
-    if job_id in SSE_LISTENERS:
-        listeners = SSE_LISTENERS[job_id]
-        logging.info(f"[SSE NOTIFY] Inoltro a {len(listeners)} listener per il job {job_id}.")
-        for queue in listeners:
-            await queue.put({"type": "update", "email_id": email_id})
-    else:
-        logging.warning(f"[SSE NOTIFY] Nessun listener trovato per il job_id {job_id}.")
-        
-    return {"ok": True, "notified": len(SSE_LISTENERS.get(job_id, []))}
+    try:
+        sse_publish(redis_client, job_id, "update", {"state": "update", "email_id": email_id})
+    except Exception as e:
+        logging.warning(f"[SSE NOTIFY] publish fallito per {job_id}: {e}")
+        raise HTTPException(status_code=503, detail="Notifica non disponibile")
+    return {"ok": True, "notified": sse_hub.listeners(job_id)}
+
+def _open_sse(topic: str, user_key: str):
+    """Apre una connessione SSE locale; oltre il limite del processo risponde 429."""
+    try:
+        return sse_hub.subscribe(topic, user_key)
+    except ConnectionLimitError as e:
+        logging.warning(f"[SSE] connessione rifiutata per {user_key} su {topic}: {e}")
+        raise HTTPException(status_code=429, detail="Troppe connessioni aperte, riprova tra poco",
+                            headers={"Retry-After": "5"})
 
 @app.get("/api/ingest/events/{job_id}")
-async def ingest_events(job_id: str, request: Request):
+async def ingest_events(
+    job_id: str,
+    request: Request,
+    last_event_id: str | None = Query(None, description="alternativa all'header Last-Event-ID"),
+):
     client_ip = request.client.host if request.client else "?"
-    logging.info(f"[SSE] connect job_id={job_id} from={client_ip}")
+    resume_from = request.headers.get("last-event-id") or last_event_id
+    logging.info(f"[SSE] connect job_id={job_id} from={client_ip} resume={resume_from}")
 
-    queue = asyncio.Queue()
-    SSE_LISTENERS.setdefault(job_id, []).append(queue)
+    # Iscrizione prima del replay: nessun evento cade tra i due (al più arriva due volte)
+    user_id = get_user_id_from_session(request)
+    conn = _open_sse(job_id, user_id if user_id and user_id != "anonymous" else f"ip:{client_ip}")
 
     async def event_generator():
-        ping_every = 15.0 # Aumentato a 15 secondi
-        last_ping = time.time()
+        # Starlette annulla il generatore alla disconnessione: nessun polling di is_disconnected
+        sent: set[str] = set()
         try:
+            if resume_from:
+                for event_id, event, data in await sse_hub.replay(job_id, resume_from):
+                    sent.add(event_id)
+                    yield format_event(event_id, event, data)
+
+            st = (ingest_jobs.get(redis_client, job_id) if redis_client else None) or bulk_jobs.get(job_id)
+            if st is not None:
+                yield format_event(None, "progress", st)
+                if st.get("state") in ("done", "failed"):
+                    yield f"data: {json.dumps(st)}\n\n"
+                    return
+
             while True:
-                if await request.is_disconnected():
-                    logging.info(f"[SSE] disconnect job_id={job_id}")
-                    break
+                item = await conn.get()
+                if item is SSE_PING:
+                    yield "event: ping\ndata: {}\n\n"
+                    continue
+                if item is None:
+                    logging.info(f"[SSE] connessione chiusa dal server job_id={job_id}: il client riprenderà da Last-Event-ID")
+                    return
+                event_id, event, data = item
+                if event_id and event_id in sent:
+                    continue
+                yield format_event(event_id, event, data)
+                if event == "progress" and data.get("state") in ("done", "failed"):
+                    logging.info(f"[SSE] end job_id={job_id} state={data.get('state')} done={data.get('done')}/{data.get('total')}")
+                    yield f"data: {json.dumps(data)}\n\n"
+                    return
+        finally:
+            sse_hub.unsubscribe(conn)
+            logging.info(f"[SSE] disconnect job_id={job_id}")
 
-                try:
-                    note = await asyncio.wait_for(queue.get(), timeout=1.0) # Timeout più breve
-                    if note.get("type") == "update":
-                        email_id = note.get("email_id")
-                        yield f"event: update\ndata: {json.dumps({'state':'update','email_id':email_id})}\n\n"
-                        logging.info(f"[SSE] update job_id={job_id} email_id={email_id}")
-                except asyncio.TimeoutError:
-                    pass
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache, no-transform", "Connection": "keep-alive", "X-Accel-Buffering": "no"},
+    )
 
-                st = INGEST_JOBS.get(job_id)
-                if not st:
-                    yield "data: {\"state\":\"unknown\"}\n\n"
-                    break
-                
-                now = time.time()
-                if now - last_ping >= ping_every:
-                    last_ping = now
-                    # --- INIZIO PATCH: Invia evento ping ---
+@app.get("/api/jobs/{job_id}/events")
+async def bulk_job_events(
+    job_id: str,
+    request: Request,
+    last_event_id: str | None = Query(None, description="alternativa all'header Last-Event-ID"),
+):
+    """Stream SSE di un job in background (eventi "item" e "progress"), solo per chi l'ha avviato."""
+    uid = _current_user_id(request)
+    st = bulk_jobs.get(job_id)
+    if not st or st.get("user_id") != uid:
+        raise HTTPException(404, "Job non trovato")
+    return await ingest_events(job_id, request, last_event_id)
+
+
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", "3000"))
+
+@app.get("/api/feed/events")
+async def feed_events(
+    request: Request,
+    last_event_id: str | None = Query(None, description="alternativa all'header Last-Event-ID"),
+):
+    """
+    Stream SSE per utente: card del feed inserite/aggiornate/rimosse mentre il worker le
+    completa (evento "card", con la card pronta da rendere) e stato dei job di ingest
+    (evento "ingest"). Resta aperto finché il client non si disconnette.
+    """
+    user_id = get_user_id_from_session(request)
+    if not user_id or user_id == "anonymous":
+        raise HTTPException(status_code=401, detail="Non autenticato")
+    resume_from = request.headers.get("last-event-id") or last_event_id
+    topic = feed_push.user_topic(user_id)
+    conn = _open_sse(topic, user_id)
+    metrics.incr("feed_events.connect")
+
+    def visible(event: str, data: dict) -> dict:
+        # Domini nascosti letti a ogni evento: la modifica delle impostazioni vale subito
+        card = data.get("card") if event == "card" else None
+        hidden = SETTINGS_STORE.get(user_id, {}).get("hidden_domains", [])
+        if card and card.get("source_domain") and card["source_domain"] in hidden:
+            return {"op": "remove", "removed": [card["email_id"], *data.get("removed", [])],
+                    "change_token": data.get("change_token")}
+        return data
+
+    async def event_generator():
+        sent: set[str] = set()
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            if resume_from:
+                for event_id, event, data in await sse_hub.replay(topic, resume_from):
+                    sent.add(event_id)
+                    yield format_event(event_id, event, visible(event, data))
+            while True:
+                item = await conn.get()
+                if item is SSE_PING:
                     yield "event: ping\ndata: {}\n\n"
-                    # --- FINE PATCH ---
-                    
-                    yield f"event: progress\ndata: {json.dumps(st)}\n\n"
-                    if st.get("state") in ("done","failed"):
-                        logging.info(f"[SSE] end job_id={job_id} state={st.get('state')} done={st.get('done')}/{st.get('total')}")
-                        yield f"data: {json.dumps(st)}\n\n"
-                        break
+                    continue
+                if item is None:
+                    return
+                event_id, event, data = item
+                if event_id and event_id in sent:
+                    continue
+                yield format_event(event_id, event, visible(event, data))
         finally:
-            lst = SSE_LISTENERS.get(job_id, [])
-            if queue in lst: lst.remove(queue)
+            sse_hub.unsubscribe(conn)
 
     return StreamingResponse(
         event_generator(),
@@ -3115,17 +3099,16 @@ async def ingest_events(job_id: str, request: Request):
         headers={"Cache-Control": "no-cache, no-transform", "Connection": "keep-alive", "X-Accel-Buffering": "no"},
     )
 
-
 async def run_ingest_job(job_id: str, user_id: str, batch: int, image_source: str | None, pages: int, target: int):
     """
     Ingestione on-demand per un singolo utente con paginazione.
     """
-    global INGEST_JOBS, CREDENTIALS_STORE, redis_client
+    global CREDENTIALS_STORE, redis_client
 
     try:
-        INGEST_JOBS[job_id]["state"] = "running"
+        _set_job(job_id, state="running")
         if not user_id:
-            job_user = INGEST_JOBS[job_id].get("user_id")
+            job_user = (ingest_jobs.get(redis_client, job_id) or {}).get("user_id") if redis_client else None
             if not isinstance(job_user, str) or not job_user:
                 raise RuntimeError("user_id mancante nel job di ingest")
             user_id = job_user
@@ -3180,20 +3163,17 @@ async def run_ingest_job(job_id: str, user_id: str, batch: int, image_source: st
         to_process_ids = accum_ids
         # --- Fine logica di paginazione ---
 
-        INGEST_JOBS[job_id]["total"] = len(to_process_ids)
+        _set_job(job_id, total=len(to_process_ids), state="done" if not to_process_ids else "running")
 
         if not to_process_ids:
             logging.info("[JOB %s] Nessuna nuova email da processare per %s → chiudo.", job_id, user_id)
-            INGEST_JOBS[job_id]["state"] = "done"
             return
 
-        for email_id in to_process_ids:
-            Newsletter.get_or_create(
-                email_id=email_id, user_id=user_id,
-                defaults={"received_date": datetime.now(timezone.utc), "is_complete": False, "enriched": False}
-            )
-            job_payload = {"email_id": email_id, "user_id": user_id, "job_id": job_id}
-            redis_client.rpush("email_queue", json.dumps(job_payload))
+        # Righe segnaposto con un INSERT ... ON CONFLICT DO NOTHING a blocchi, poi un solo RPUSH
+        await asyncio.to_thread(insert_stubs, user_id, to_process_ids,
+                                received_date=datetime.now(timezone.utc), is_complete=False, enriched=False)
+        redis_client.rpush("email_queue", *[
+            json.dumps({"email_id": email_id, "user_id": user_id, "job_id": job_id}) for email_id in to_process_ids])
 
         logging.info(
             "[JOB %s] Accodati %d messaggi per user_id=%s (pages=%d, target=%d).",
@@ -3203,41 +3183,25 @@ async def run_ingest_job(job_id: str, user_id: str, batch: int, image_source: st
     except Exception as e:
         logging.exception("[JOB %s] Errore critico: %s", job_id, e)
         try:
-            INGEST_JOBS[job_id]["state"] = "failed"
-            INGEST_JOBS[job_id]["reason"] = str(e) or "exception"
+            _set_job(job_id, state="failed", reason=str(e) or "exception")
         except Exception:
             pass
 
-@app.post("/api/ingest/progress/{job_id}")
-async def update_ingest_progress(job_id: str):
-    """Endpoint chiamato dal worker per segnalare che un item è stato completato."""
-    if job_id in INGEST_JOBS:
-        job = INGEST_JOBS[job_id]
-        job["done"] = job.get("done", 0) + 1
-        
-        # Se tutti gli item sono stati processati, il job è veramente "finito".
-        if job["done"] >= job.get("total", 0):
-            job["state"] = "done"
-            logging.info(f"[JOB {job_id}] Tutti gli {job['done']}/{job['total']} item sono stati processati. Job completato.")
-        else:
-            logging.info(f"[JOB {job_id}] Progresso: {job['done']}/{job['total']}")
-    return {"ok": True}
-
-
 @app.post("/api/ingest/pull")
 async def ingest_pull(body: IngestPullBody, request: Request, bg: BackgroundTasks):
     user_id = get_user_id_from_session(request)
     if not user_id or user_id == "anonymous":
         raise HTTPException(status_code=401, detail="Utente non autenticato.")
 
-    active_job = next((jid for jid, st in INGEST_JOBS.items()
-                       if st.get("state") in ("queued","running") and st.get("user_id")==user_id), None)
-    if active_job:
-        logging.warning(f"[PULL] already_running user={user_id} job_id={active_job}")
-        return JSONResponse({"job_id": active_job, "status":"already_running"}, status_code=202)
+    if not redis_client:
+        raise HTTPException(status_code=503, detail="Redis non disponibile")
 
-    job_id = uuid.uuid4().hex
-    INGEST_JOBS[job_id] = {"state":"queued","total":0,"done":0,"errors":0,"user_id":user_id}
+    # SET NX sull'indice dell'utente: un solo job attivo anche con più repliche
+    job_id, created = ingest_jobs.create(redis_client, user_id)
+    if not created:
+        logging.warning(f"[PULL] already_running user={user_id} job_id={job_id}")
+        return JSONResponse({"job_id": job_id, "status":"already_running"}, status_code=202)
+    _publish_job_state(job_id, ingest_jobs.get(redis_client, job_id))
     logging.info(f"[PULL] start user={user_id} job_id={job_id} batch={body.batch} img_src={body.image_source} pages={body.pages} target={body.target}")
     bg.add_task(run_ingest_job, job_id, user_id, body.batch, body.image_source, body.pages, body.target)
     return {"job_id": job_id, "status": "started"}
@@ -3289,14 +3253,10 @@ async def import_album(body: ImportAlbumBody, request: Request, authorization: s
 
     uid = _current_user_id(request)
     PHOTOS_BEARERS[uid] = authorization
-    pool = _user_pool(uid)
 
     url = "https://photoslibrary.googleapis.com/v1/mediaItems:search"
     payload = {"albumId": body.albumId, "pageSize": 100}
-    added = 0
-    if (body.mode or "append") == "replace":
-        PHOTOS_POOLS[uid] = []
-        pool = _user_pool(uid)
+    items = []
 
     async with httpx.AsyncClient(timeout=20.0) as c:
         page_token = None
@@ -3314,120 +3274,120 @@ async def import_album(body: ImportAlbumBody, request: Request, authorization: s
                     continue
                 mf = mi.get("mediaFile") or {}
                 auth_url = mf.get("downloadUrl") or (mf.get("image") or {}).get("downloadUrl")
-                pool.append({
+                items.append({
                     "id": mi.get("id"),
                     "baseUrl": base_url,
                     "authUrl": auth_url,
                     "mimeType": mi.get("mimeType"),
                     "filename": mi.get("filename"),
                 })
-                added += 1
             page_token = out.get("nextPageToken")
             if not page_token:
                 break
 
-    return {"ok": True, "cached": added, "pool_size": len(pool)}
+    added = photo_pool.add(uid, items, replace=(body.mode or "append") == "replace")
+    return {"ok": True, "cached": added, "pool_size": photo_pool.count(uid)}
+
+async def _upload_image_to_r2(data: bytes, content_type: str, keyword: str) -> str | None:
+    """Carica l'immagine su R2 (se configurato). URL pubblico, o None se R2 manca o l'upload fallisce."""
+    if not _get_r2():
+        return None
+    ct = content_type.split(";", 1)[0].lower()
+    ext = "jpg"
+    if ct.endswith("png"): ext = "png"
+    elif ct.endswith("webp"): ext = "webp"
+    try:
+        return await asyncio.to_thread(upload_bytes_to_r2, data, make_r2_key_from_kw(keyword, ext=ext), ct)
+    except Exception as e:
+        logging.warning(f"[R2] upload fallito, resta l'URL sorgente: {e}")
+        return None
+
+def _user_rows(uid: str, email_ids: list[str], *fields) -> list:
+    """Le newsletter dell'utente con gli email_id indicati, nell'ordine della lista."""
+    by_id = {}
+    for i in range(0, len(email_ids), 500):
+        chunk = email_ids[i:i + 500]
+        for n in (Newsletter.select(*fields)
+                  .where((Newsletter.user_id == uid) & (Newsletter.email_id.in_(chunk)))):
+            by_id[n.email_id] = n
+    return [by_id[e] for e in dict.fromkeys(email_ids) if e in by_id]
+
+def _job_accepted(st: dict, **extra) -> JSONResponse:
+    return JSONResponse(status_code=202, content={
+        "ok": True, "job_id": st["job_id"], "total": st["total"],
+        "events": f"/api/jobs/{st['job_id']}/events", **extra,
+    })
 
 @app.post("/api/feed/update-images")
 async def update_images(body: UpdateImagesRequest, request: Request):
     """
-    Aggiorna le immagini delle email.
+    Aggiorna le immagini delle email in un job in background (vedi bulk_jobs): risponde
+    subito 202 con il job_id; esito per email su /api/jobs/{job_id}/events.
     - "google_photos": prende a giro dalla pool PER-UTENTE e usa il proxy /api/photos/proxy/{id}
     - altrimenti: Pixabay→R2 per ciascuna email
     """
     uid = _current_user_id(request) # Identifica l'utente che fa la richiesta
-    logging.info(f"update_images: richiesta da uid={uid} con image_source={body.image_source}, email_ids={len(body.email_ids)}")
-    
-    try:
-        updated_items = []
-        failed_items = [] # <-- Aggiunto
-        source = body.image_source or "pixabay"
+    source = body.image_source or "pixabay"
+    logging.info(f"update_images: richiesta da uid={uid} con image_source={source}, email_ids={len(body.email_ids)}")
+
+    rows = _user_rows(uid, body.email_ids,
+                      Newsletter.email_id, Newsletter.image_url, Newsletter.full_content_html,
+                      Newsletter.ai_title, Newsletter.ai_summary_markdown, Newsletter.original_subject,
+                      Newsletter.source_domain)
+    if body.only_empty:
+        rows = [n for n in rows if not n.image_url]
+
+    assigned: dict[str, dict] = {}
+    if source == "google_photos":
+        # Foto assegnate a giro da una posizione casuale: OFFSET/LIMIT sulla pool in SQLite
+        pool_size = photo_pool.count(uid)
+        if not pool_size:
+            raise HTTPException(status_code=409, detail="La tua pool di Google Photos è vuota. Seleziona prima le foto.")
+        photos = photo_pool.round_robin(uid, random.randrange(pool_size), len(rows))
+        assigned = {n.email_id: photos[i % len(photos)] for i, n in enumerate(rows)} if photos else {}
+        # Scarica in parallelo le foto assegnate: il job e poi il feed le trovano in cache
+        photo_prefetcher.schedule(uid, photos)
+    base = str(request.base_url).rstrip('/')
+    client = SHARED_HTTP_CLIENT
+
+    async def handle(n):
+        image_query = None
+        if source == "google_photos":
+            item = assigned.get(n.email_id)
+            if not item:
+                raise RuntimeError("no_image_found")
+            # Dalla cache delle foto (o dal download già avviato dal prefetch), non dal proxy via HTTP
+            ent = await photo_prefetcher.get(uid, item, *PHOTO_CARD_SIZE)
+            if not ent:
+                raise RuntimeError("photo_fetch_failed")
+            pw, ph, pmode = PHOTO_CARD_SIZE
+            new_image_url = f"{base}/api/photos/proxy/{item['id']}?w={pw}&h={ph}&mode={pmode}"
+            body_bytes, content_type = ent["bytes"], ent["ct"]
+        else:  # Pixabay
+            image_query = await get_ai_keyword(n.full_content_html or "", client)
+            if not image_query:
+                image_query = n.ai_title or n.original_subject or n.source_domain or "newsletter"
+            new_image_url = await get_pixabay_image_by_query(client, image_query)
+            new_image_url = normalize_image_url(new_image_url) or new_image_url
+            if not new_image_url:
+                raise RuntimeError("no_image_found")
+            r = await client.get(new_image_url, timeout=15.0, follow_redirects=True)
+            r.raise_for_status()
+            body_bytes, content_type = r.content, r.headers.get("content-type", "image/jpeg")
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            pool = _user_pool(uid)
-            if source == "google_photos" and not pool:
-                raise HTTPException(status_code=409, detail="La tua pool di Google Photos è vuota. Seleziona prima le foto.")
+        accent_hex = await asyncio.to_thread(extract_dominant_hex, body_bytes)
+        # ⬇️ RE-HOST SU R2 se configurato (evita 429 di Pixabay)
+        r2_url = await _upload_image_to_r2(body_bytes, content_type, image_query or n.ai_title or n.original_subject or "newsletter")
+        if r2_url:
+            new_image_url = r2_url
 
-            start_index = random.randint(0, len(pool) - 1) if pool else 0
+        is_complete = bool(n.ai_title and n.ai_summary_markdown and new_image_url and accent_hex)
+        return ({"image_url": new_image_url, "accent_hex": accent_hex, "is_complete": is_complete},
+                {"image_url": new_image_url, "image_query": image_query, "accent_hex": accent_hex})
 
-            for i, email_id in enumerate(body.email_ids):
-                try:
-                    n = Newsletter.get((Newsletter.email_id == email_id) & (Newsletter.user_id == uid))
-                    if body.only_empty and n.image_url:
-                        continue
-
-                    new_image_url = ""
-                    image_query = None
-                    accent_hex = None
-
-                    if source == "google_photos":
-                        item = pool[(start_index + i) % len(pool)]
-                        photo_id = (item.get("id") or "").strip()
-                        if photo_id:
-                            base = str(request.base_url).rstrip('/')
-                            new_image_url = f"{base}/api/photos/proxy/{photo_id}?w=1600&h=900&mode=no"
-                    else:  # Pixabay
-                        image_query = await get_ai_keyword(n.full_content_html or "", client)
-                        if not image_query:
-                            image_query = n.ai_title or n.original_subject or n.source_domain or "newsletter"
-                        new_image_url = await get_pixabay_image_by_query(client, image_query)
-
-                    new_image_url = normalize_image_url(new_image_url) or new_image_url
-
-                    if not new_image_url:
-                        failed_items.append({"email_id": email_id, "error": "no_image_found"})
-                        continue
-
-                    # Scarica l'immagine e estrai il colore
-                    r = await client.get(new_image_url, timeout=15.0, follow_redirects=True)
-                    r.raise_for_status()
-                    body_bytes = r.content
-                    accent_hex = extract_dominant_hex(body_bytes)
-
-                    # ⬇️ RE-HOST SU R2 se configurato (evita 429 di Pixabay)
-                    try:
-                        r2_client = _get_r2()
-                        if r2_client:
-                            ct = r.headers.get("content-type", "image/jpeg").split(";", 1)[0].lower()
-                            ext = "jpg"
-                            if ct.endswith("png"): ext = "png"
-                            elif ct.endswith("webp"): ext = "webp"
-                            # usa query/ai_title/subject per la chiave
-                            kw_for_key = (image_query or n.ai_title or n.original_subject or "newsletter")
-                            key = make_r2_key_from_kw(kw_for_key, ext=ext)
-                            r2_url = upload_bytes_to_r2(body_bytes, key, content_type=ct)
-                            new_image_url = r2_url
-                    except Exception as e:
-                        logging.warning(f"[UPDATE-IMAGES] R2 upload failed, keep source URL: {e}")
-
-                    is_complete = bool(n.ai_title and n.ai_summary_markdown and new_image_url and accent_hex)
-
-                    (Newsletter.update(image_url=new_image_url, accent_hex=accent_hex, is_complete=is_complete)
-                     .where((Newsletter.email_id == email_id) & (Newsletter.user_id == uid))
-                     ).execute()
-                    
-                    updated_items.append({
-                        "email_id": email_id,
-                        "image_url": new_image_url,
-                        "image_query": image_query,
-                        "accent_hex": accent_hex
-                    })
-
-                except Exception as e:
-                    logging.warning(f"[UPDATE-IMAGES] Fallimento per email {email_id}: {e}")
-                    failed_items.append({"email_id": email_id, "error": str(e)})
-                    continue # Continua con la prossima email
+    st = bulk_jobs.runner.submit("update_images", uid, rows, handle)
+    return _job_accepted(st)
 
-        logging.info(f"update_images: completato per uid={uid}. Aggiornati {len(updated_items)} elementi, falliti {len(failed_items)}.")
-        return JSONResponse(content={"updated_items": updated_items, "failed_items": failed_items})
-
-    except HTTPException as he:
-        logging.error(f"update_images: HTTPException {he.status_code} per uid={uid}: {he.detail}")
-        raise he
-    except Exception as e:
-        logging.error(f"update_images: errore imprevisto per uid={uid}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Errore interno durante l'aggiornamento immagini.")
-    
 @app.post("/api/r2/test-upload")
 async def r2_test_upload(request: Request):
     # ✅ richiede sessione valida (altrimenti 401)
@@ -3449,54 +3409,40 @@ class BackfillBody(BaseModel):
 
 @app.post("/api/feed/backfill-images")
 async def backfill_images(body: BackfillBody, request: Request):
+    """Cerca su Pixabay (→R2) un'immagine per le email, in un job in background (vedi bulk_jobs)."""
     uid = _current_user_id(request)
-    try:
-        q = Newsletter.select().where(Newsletter.user_id == uid)
-
-        if body.email_ids:
-            q = q.where(Newsletter.email_id.in_(body.email_ids))
-        elif body.only_empty:
-            q = q.where(Newsletter.image_url.is_null(True) | (Newsletter.image_url == ""))
-
-        q = q.limit(max(1, min(200, body.limit)))
-
-        updated = []
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            for n in q:
-                html = n.full_content_html or ""
-                kw = await get_ai_keyword(html, client)
-                url = await get_pixabay_image_by_query(client, kw)
-                
-                # Logga subito dopo aver ottenuto l'URL da Pixabay
-                logging.info("[BF] uid=%s email_id=%s kw=%r url=%s", uid, n.email_id, kw, url)
-
-                final_url = url
-                try:
-                    # Questo blocco per l'upload su R2 è opzionale ma lo manteniamo
-                    r2_client = _get_r2()
-                    if r2_client and url:
-                        r = await client.get(url, timeout=20.0, follow_redirects=True)
-                        r.raise_for_status()
-                        body_bytes = r.content
-                        ct = r.headers.get("content-type", "image/jpeg").split(";", 1)[0].lower()
-                        ext = "jpg"
-                        if ct.endswith("png"): ext = "png"
-                        elif ct.endswith("webp"): ext = "webp"
-                        
-                        key = make_r2_key_from_kw(kw, ext=ext)
-                        final_url = upload_bytes_to_r2(body_bytes, key, content_type=ct)
-                except Exception as e:
-                    logging.warning(f"[BF] R2 upload failed for {n.email_id}, keeping original URL: {e}")
+    q = (Newsletter.select(Newsletter.email_id, Newsletter.full_content_html)
+         .where(Newsletter.user_id == uid))
+
+    if body.email_ids:
+        q = q.where(Newsletter.email_id.in_(body.email_ids))
+    elif body.only_empty:
+        q = q.where(Newsletter.image_url.is_null(True) | (Newsletter.image_url == ""))
+
+    rows = list(q.limit(max(1, min(200, body.limit))))
+    client = SHARED_HTTP_CLIENT
+
+    async def handle(n):
+        kw = await get_ai_keyword(n.full_content_html or "", client)
+        url = await get_pixabay_image_by_query(client, kw)
+        logging.info("[BF] uid=%s email_id=%s kw=%r url=%s", uid, n.email_id, kw, url)
+        if not url:
+            raise RuntimeError("no_image_found")
+
+        final_url = url
+        if _get_r2():
+            # Upload su R2 opzionale: se il download fallisce resta l'URL di Pixabay
+            try:
+                r = await client.get(url, timeout=20.0, follow_redirects=True)
+                r.raise_for_status()
+                final_url = await _upload_image_to_r2(r.content, r.headers.get("content-type", "image/jpeg"), kw) or url
+            except Exception as e:
+                logging.warning(f"[BF] R2 upload failed for {n.email_id}, keeping original URL: {e}")
+        return {"image_url": final_url}, {"image_url": final_url, "image_query": kw}
 
-                n.image_url = final_url
-                n.save()
-                updated.append({"email_id": n.email_id, "image_url": final_url, "image_query": kw})
+    st = bulk_jobs.runner.submit("backfill_images", uid, rows, handle)
+    return _job_accepted(st)
 
-        return {"ok": True, "updated_items": updated}
-    except Exception as e:
-        logging.error(f"Backfill error: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Backfill failed")
-    
 @app.get("/api/feed/{email_id}/image-query")
 async def get_image_query(email_id: str, request: Request):
     uid = _current_user_id(request)
@@ -3518,11 +3464,17 @@ class RecomputeBody(BaseModel):
     limit: int = 100
     only_missing: bool = True
     reclassify: bool = False
+    fresh: bool = False  # ignora la cache LLM e rigenera davvero
+    batch: bool = False  # accoda al Batch API (backend.batch_enrich) invece di rigenerare subito
 
 @app.post("/api/feed/recompute-summaries")
 async def recompute_summaries(body: RecomputeBody, request: Request):
     """Rigenera title/summary per le email selezionate, usando i prompt adattivi per tipologia.
     Se reclassify=True ricalcola anche i tag (type/topic) prima del riassunto.
+    Se fresh=True salta la cache LLM (il nuovo risultato la sovrascrive).
+    Se batch=True accoda le email al Batch API (più economico, risultati in differita);
+    in quel caso i tag vengono sempre ricalcolati insieme al riassunto.
+    Altrimenti rigenera in un job in background (vedi bulk_jobs) e risponde subito 202 con il job_id.
     """
     uid = _current_user_id(request)
     try:
@@ -3537,40 +3489,46 @@ async def recompute_summaries(body: RecomputeBody, request: Request):
 
         q = q.order_by(Newsletter.received_date.desc()).limit(max(1, min(300, body.limit)))
 
-        updated = []
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            for n in q:
-                html = n.full_content_html or ""
-
-                # 1) (opzionale) ricalcola i tag
-                type_tag = n.type_tag or None
-                topic_tag = n.topic_tag or None
-                if body.reclassify or not type_tag:
-                    meta = f"FROM: {n.sender_email}\nSUBJECT: {n.original_subject}\n\n"
-                    tags = await classify_type_and_topic(meta + html, SHARED_HTTP_CLIENT)
-                    type_tag = tags.get("type_tag") or type_tag
-                    topic_tag = tags.get("topic_tag") or topic_tag
-
-                # 2) rigenera riassunto con adattatore per tipo
-                s = await get_ai_summary(html, SHARED_HTTP_CLIENT, type_tag)
-                title = (s.get('title') or '').strip()
-                summ  = (s.get('summary_markdown') or '').strip()
-
-                if title:
-                    n.ai_title = title
-                if summ:
-                    n.ai_summary_markdown = summ
-                if type_tag:
-                    n.type_tag = type_tag
-                if topic_tag:
-                    n.topic_tag = topic_tag
-
-                # is_complete se abbiamo tutto e un'immagine
-                n.is_complete = bool(n.ai_title and n.ai_summary_markdown and (n.image_url or ''))
-                n.save()
-                updated.append(n.email_id)
-
-        return {"ok": True, "updated": updated}
+        if body.batch:
+            if not redis_client:
+                raise HTTPException(status_code=503, detail="Redis non disponibile")
+            queued = [n.email_id for n in q if enqueue_for_batch(redis_client, n.email_id, uid, fresh=body.fresh)]
+            return {"ok": True, "batch": True, "queued": queued}
+
+        rows = list(q)
+        fresh = body.fresh
+
+        async def handle(n):
+            html = n.full_content_html or ""
+
+            # 1) (opzionale) ricalcola i tag
+            type_tag = n.type_tag or None
+            topic_tag = n.topic_tag or None
+            if body.reclassify or not type_tag:
+                meta = f"FROM: {n.sender_email}\nSUBJECT: {n.original_subject}\n\n"
+                tags = await classify_type_and_topic(meta + html, SHARED_HTTP_CLIENT, use_cache=not fresh, allow_local=not fresh)
+                type_tag = tags.get("type_tag") or type_tag
+                topic_tag = tags.get("topic_tag") or topic_tag
+
+            # 2) rigenera riassunto con adattatore per tipo
+            s = await get_ai_summary(html, SHARED_HTTP_CLIENT, type_tag, use_cache=not fresh)
+            title = (s.get('title') or '').strip() or n.ai_title
+            summ = (s.get('summary_markdown') or '').strip() or n.ai_summary_markdown
+
+            # is_complete se abbiamo tutto e un'immagine
+            fields = {
+                "ai_title": title,
+                "ai_summary_markdown": summ,
+                "type_tag": type_tag or n.type_tag,
+                "topic_tag": topic_tag or n.topic_tag,
+                "is_complete": bool(title and summ and (n.image_url or '')),
+            }
+            return fields, {"ai_title": title, "type_tag": fields["type_tag"], "topic_tag": fields["topic_tag"]}
+
+        st = bulk_jobs.runner.submit("recompute_summaries", uid, rows, handle)
+        return _job_accepted(st)
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"recompute_summaries error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Recompute failed")
@@ -3596,6 +3554,7 @@ async def rehost_one_image(email_id: str, request: Request):
     if accent:
         n.accent_hex = accent
     n.save()
+    bump_feed_version(redis_client, uid)
     return {"ok": True, "image_url": n.image_url, "accent_hex": n.accent_hex}
 
 class RehostBody(BaseModel):
@@ -3604,12 +3563,13 @@ class RehostBody(BaseModel):
 
 @app.post("/api/feed/rehost-external-images")
 async def rehost_external_images(body: RehostBody, request: Request):
+    """Copia su R2 le immagini esterne delle email, in un job in background (vedi bulk_jobs)."""
     uid = _current_user_id(request)
     r2c = _get_r2()
     if not r2c:
         raise HTTPException(status_code=409, detail="R2 non configurato")
     q = (Newsletter
-        .select()
+        .select(Newsletter.email_id, Newsletter.image_url, Newsletter.ai_title, Newsletter.original_subject)
         .where(
             (Newsletter.user_id == uid) &
             (Newsletter.image_url.is_null(False)) & (Newsletter.image_url != '')
@@ -3617,25 +3577,27 @@ async def rehost_external_images(body: RehostBody, request: Request):
         .order_by(Newsletter.received_date.desc())
         .limit(max(1, min(500, body.limit)))
     )
-    updated, skipped, failed = [], 0, []
-    async with httpx.AsyncClient(timeout=20.0) as client:
-        for n in q:
-            u = (n.image_url or '').strip()
-            if not u:
-                continue
-            if body.only_not_r2 and _is_internal_image_url(u, request):
-                skipped += 1
-                continue
-            url, accent = await _rehost_to_r2(u, (n.ai_title or n.original_subject), client)
-            if not url:
-                failed.append(n.email_id)
-                continue
-            n.image_url = url
-            if accent:
-                n.accent_hex = accent
-            n.save()
-            updated.append(n.email_id)
-    return {"ok": True, "updated": updated, "skipped": skipped, "failed": failed}
+    rows, skipped = [], 0
+    for n in q:
+        u = (n.image_url or '').strip()
+        if not u:
+            continue
+        if body.only_not_r2 and _is_internal_image_url(u, request):
+            skipped += 1
+            continue
+        rows.append(n)
+
+    async def handle(n):
+        url, accent = await _rehost_to_r2(n.image_url.strip(), (n.ai_title or n.original_subject), SHARED_HTTP_CLIENT)
+        if not url:
+            raise RuntimeError("rehost_failed")
+        fields = {"image_url": url}
+        if accent:
+            fields["accent_hex"] = accent
+        return fields, dict(fields)
+
+    st = bulk_jobs.runner.submit("rehost_external_images", uid, rows, handle)
+    return _job_accepted(st, skipped=skipped)
 
 @app.post("/api/feed/{email_id}/favorite")
 async def toggle_favorite(email_id: str, request: Request):
@@ -3648,7 +3610,8 @@ async def toggle_favorite(email_id: str, request: Request):
         raise HTTPException(status_code=404, detail="Newsletter non trovata.")
 
     newsletter.is_favorite = not newsletter.is_favorite
-    newsletter.save()
+    newsletter.save(only=[Newsletter.is_favorite])  # solo la colonna cambiata: i trigger di ricerca non scattano
+    bump_feed_version(redis_client, uid)
     return {"email_id": email_id, "is_favorite": newsletter.is_favorite}
     
 class TagIn(BaseModel):
@@ -3668,7 +3631,8 @@ async def set_tag(email_id: str, payload: TagIn, request: Request):
         raise HTTPException(status_code=400, detail="Il tag non può superare i 32 caratteri.")
     
     n.tag = t or None
-    n.save()
+    n.save(only=[Newsletter.tag])
+    bump_feed_version(redis_client, uid)
     
     return {"email_id": email_id, "tag": n.tag}
 
@@ -3684,7 +3648,7 @@ async def logout(request: Request):
     save_credentials_store()
 
     # Pulisci pool e bearer per-utente
-    PHOTOS_POOLS.pop(user_id, [])
+    photo_pool.clear(user_id)
     PHOTOS_BEARERS.pop(user_id, None)
 
     for sid, uid in list(SESSION_EMAIL.items()):
@@ -0,0 +1,94 @@
+# backend/metrics.py
+"""
+Metriche di processo leggere (contatori e gauge) senza dipendenze esterne.
+
+Ogni processo (API, worker, ingestor) tiene i valori in memoria e, se è stato
+collegato un client Redis con bind_redis(), ne pubblica periodicamente uno
+snapshot su `metrics:<processo>` così che /api/_diag/metrics possa mostrarli tutti.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any
+
+METRICS_PUBLISH_EVERY = float(os.getenv("METRICS_PUBLISH_EVERY", "10"))
+METRICS_TTL = int(os.getenv("METRICS_TTL", "300"))
+
+_LOCK = threading.Lock()
+_COUNTERS: dict[str, float] = {}
+_GAUGES: dict[str, float] = {}
+_REDIS: Any = None
+_PROCESS = "unknown"
+_last_publish = 0.0
+
+
+def bind_redis(client: Any, process_name: str) -> None:
+    """Collega un client Redis (sync) su cui pubblicare gli snapshot del processo."""
+    global _REDIS, _PROCESS
+    _REDIS = client
+    _PROCESS = (process_name or "unknown").lower()
+
+
+def incr(name: str, value: float = 1) -> None:
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+    _maybe_publish()
+
+
+def set_gauge(name: str, value: float) -> None:
+    with _LOCK:
+        _GAUGES[name] = value
+    _maybe_publish()
+
+
+def ratio(hits: str, misses: str) -> float | None:
+    """Rapporto hits/(hits+misses) calcolato sui contatori locali."""
+    with _LOCK:
+        h = _COUNTERS.get(hits, 0)
+        m = _COUNTERS.get(misses, 0)
+    return (h / (h + m)) if (h + m) else None
+
+
+def snapshot() -> dict:
+    with _LOCK:
+        return {
+            "process": _PROCESS,
+            "ts": time.time(),
+            "counters": dict(_COUNTERS),
+            "gauges": dict(_GAUGES),
+        }
+
+
+def publish() -> None:
+    """Scrive lo snapshot locale su Redis (best-effort)."""
+    global _last_publish
+    _last_publish = time.time()
+    if _REDIS is None:
+        return
+    try:
+        _REDIS.set(f"metrics:{_PROCESS}", json.dumps(snapshot()), ex=METRICS_TTL)
+    except Exception as e:
+        logging.debug(f"[METRICS] publish fallito: {e}")
+
+
+def read_all(client: Any) -> dict[str, dict]:
+    """Legge gli snapshot pubblicati da tutti i processi."""
+    out: dict[str, dict] = {}
+    if client is None:
+        return out
+    try:
+        for key in client.scan_iter("metrics:*"):
+            raw = client.get(key)
+            if raw:
+                name = key if isinstance(key, str) else key.decode("utf-8")
+                out[name.split(":", 1)[1]] = json.loads(raw)
+    except Exception as e:
+        logging.debug(f"[METRICS] lettura snapshot fallita: {e}")
+    return out
+
+
+def _maybe_publish() -> None:
+    if _REDIS is not None and (time.time() - _last_publish) >= METRICS_PUBLISH_EVERY:
+        publish()
@@ -0,0 +1,337 @@
+# backend/mock_llm.py
+"""
+Server LLM finto, compatibile con gli endpoint OpenAI usati dal backend, per i test locali.
+
+Risponde in modo deterministico (euristiche su parole chiave) a:
+  - POST /v1/chat/completions  (classificazione, keyword, arricchimento combinato con json_schema)
+  - POST /v1/responses         (riassunto)
+  - POST /v1/files, GET /v1/files/{id}/content, POST /v1/batches, GET /v1/batches/{id}
+                               (Batch API: il batch risulta "in_progress" al primo controllo
+                                e "completed" dal secondo, con l'output calcolato riga per riga)
+  - GET  /_stats               (numero di richieste per endpoint/tipo, utile per confrontare le modalità)
+
+Avvio:
+    python -m backend.mock_llm --port 8089
+    OPENAI_BASE_URL=http://localhost:8089/v1 OPENAI_API_KEY=test ENRICH_MODE=combined python -m backend.worker
+
+Il marcatore MOCK_INVALID nel contenuto fa restituire un output combinato non valido
+(per esercitare il fallback a tre chiamate).
+"""
+import argparse
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_TYPE_HINTS = [
+    ("promo", ("sconto", "offerta", "coupon", "saldi", "black friday", "codice", "% off", "deal")),
+    ("personali", ("ciao ", "re:", "fw:", "appuntamento", "preventivo", "ti scrivo")),
+    ("newsletter", ("newsletter", "digest", "weekly", "issue", "read in browser", "substack")),
+]
+_TOPIC_HINTS = [
+    ("ai", ("intelligenza artificiale", " ai ", "gpt", "llm")),
+    ("tecnologia", ("software", "cloud", "app", "tech")),
+    ("coding", ("python", "javascript", "codice sorgente", "github")),
+    ("finanza", ("borsa", "mercati", "crypto", "investi")),
+    ("marketing", ("marketing", "ads", "social", "brand")),
+    ("viaggi", ("viaggio", "volo", "hotel")),
+]
+_KEYWORDS = {
+    "promo": "price tag",
+    "personali": "calendar",
+    "informative": "document",
+    "newsletter": "open book",
+}
+
+_STATS: dict[str, int] = {}
+_STATS_LOCK = threading.Lock()
+
+
+def _count(key: str) -> None:
+    with _STATS_LOCK:
+        _STATS[key] = _STATS.get(key, 0) + 1
+
+
+def _guess_type(text: str) -> str:
+    low = f" {text.lower()} "
+    for tag, hints in _TYPE_HINTS:
+        if any(h in low for h in hints):
+            return tag
+    return "informative"
+
+
+def _guess_topic(text: str) -> str:
+    low = f" {text.lower()} "
+    for tag, hints in _TOPIC_HINTS:
+        if any(h in low for h in hints):
+            return tag
+    return "generico"
+
+
+def _title_from(text: str) -> str:
+    m = re.search(r"SUBJECT:\s*(.+)", text)
+    words = (m.group(1) if m else text).split()[:8]
+    return " ".join(words) or "Aggiornamento"
+
+
+def _summary_from(text: str) -> str:
+    body = " ".join(text.split())[:160]
+    return f"**Sintesi** del contenuto.\n\n{body}"
+
+
+_CONTENT_MARKERS = ("Contenuto da classificare:", "Email da elaborare:", "Testo da analizzare:")
+
+
+def _user_text(messages: list) -> str:
+    """Testo dell'utente senza le istruzioni/cornici dei prompt del backend."""
+    parts = []
+    for m in messages or []:
+        if m.get("role") != "user":
+            continue
+        c = m.get("content")
+        if isinstance(c, str):
+            parts.append(c)
+        elif isinstance(c, list):
+            parts.extend(p.get("text", "") for p in c if isinstance(p, dict))
+    text = "\n".join(parts)
+    for marker in _CONTENT_MARKERS:
+        if marker in text:
+            text = text.split(marker, 1)[1]
+            break
+    return text.strip().strip("-").strip()
+
+
+def _system_text(messages: list) -> str:
+    for m in messages or []:
+        if m.get("role") == "system":
+            c = m.get("content")
+            if isinstance(c, str):
+                return c
+            if isinstance(c, list):
+                return " ".join(p.get("text", "") for p in c if isinstance(p, dict))
+    return ""
+
+
+def _usage(prompt: str, completion: str) -> dict:
+    p, c = len(prompt) // 4, len(completion) // 4
+    return {"prompt_tokens": p, "completion_tokens": c, "total_tokens": p + c}
+
+
+def chat_completion(body: dict) -> dict:
+    """Costruisce la risposta di /chat/completions in base al tipo di richiesta."""
+    messages = body.get("messages") or []
+    user = _user_text(messages)
+    system = _system_text(messages)
+    fmt = (body.get("response_format") or {}).get("type")
+
+    if fmt == "json_schema":
+        _count("chat.combined")
+        if "MOCK_INVALID" in user:
+            content = json.dumps({"type_tag": "sconosciuto", "title": ""})
+        else:
+            ttype = _guess_type(user)
+            content = json.dumps({
+                "type_tag": ttype,
+                "topic_tag": _guess_topic(user),
+                "title": _title_from(user),
+                "summary_markdown": _summary_from(user),
+                "keyword": _KEYWORDS[ttype],
+            }, ensure_ascii=False)
+    elif "classificatore" in system.lower():
+        _count("chat.classify")
+        content = json.dumps({"type_tag": _guess_type(user), "topic_tag": _guess_topic(user)})
+    elif "keyword" in system.lower():
+        _count("chat.keyword")
+        content = json.dumps({"keyword": _KEYWORDS[_guess_type(user)]})
+    else:
+        _count("chat.other")
+        content = json.dumps({"ok": True})
+
+    return {
+        "id": f"chatcmpl-mock-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": _usage(system + user, content),
+    }
+
+
+def responses_api(body: dict) -> dict:
+    """Costruisce la risposta di /responses (usata per il riassunto)."""
+    _count("responses.summary")
+    items = body.get("input") or []
+    user = _user_text(items) if isinstance(items, list) else str(items)
+    text = json.dumps({"title": _title_from(user), "summary_markdown": _summary_from(user)}, ensure_ascii=False)
+    return {
+        "id": f"resp-mock-{uuid.uuid4().hex[:12]}",
+        "object": "response",
+        "model": body.get("model", "mock"),
+        "output": [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": text}]}],
+        "usage": {"input_tokens": len(user) // 4, "output_tokens": len(text) // 4},
+    }
+
+
+_FILES: dict[str, bytes] = {}
+_BATCHES: dict[str, dict] = {}
+
+
+def _parse_multipart(content_type: str, body: bytes) -> dict[str, bytes]:
+    msg = BytesParser(policy=policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+    )
+    out: dict[str, bytes] = {}
+    for part in msg.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name:
+            out[str(name)] = part.get_payload(decode=True) or b""
+    return out
+
+
+def create_file(data: bytes, purpose: str) -> dict:
+    file_id = f"file-mock-{uuid.uuid4().hex[:12]}"
+    _FILES[file_id] = data
+    return {"id": file_id, "object": "file", "bytes": len(data), "purpose": purpose, "created_at": int(time.time())}
+
+
+def create_batch(body: dict) -> dict:
+    batch_id = f"batch-mock-{uuid.uuid4().hex[:12]}"
+    batch = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": body.get("endpoint"),
+        "input_file_id": body.get("input_file_id"),
+        "completion_window": body.get("completion_window"),
+        "status": "validating",
+        "output_file_id": None,
+        "error_file_id": None,
+        "created_at": int(time.time()),
+        "metadata": body.get("metadata"),
+        "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        "_polls": 0,
+    }
+    _BATCHES[batch_id] = batch
+    _count("batch.created")
+    return _public_batch(batch)
+
+
+def _public_batch(batch: dict) -> dict:
+    return {k: v for k, v in batch.items() if not k.startswith("_")}
+
+
+def _run_batch(batch: dict) -> None:
+    """Esegue tutte le righe del file di input e produce il file di output."""
+    lines = (_FILES.get(batch["input_file_id"]) or b"").decode("utf-8").splitlines()
+    out = []
+    for line in lines:
+        if not line.strip():
+            continue
+        req = json.loads(line)
+        body = chat_completion(req.get("body") or {})
+        out.append(json.dumps({
+            "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+            "custom_id": req.get("custom_id"),
+            "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": body},
+            "error": None,
+        }, ensure_ascii=False))
+    batch["output_file_id"] = create_file(("\n".join(out) + "\n").encode("utf-8"), "batch_output")["id"]
+    batch["request_counts"] = {"total": len(out), "completed": len(out), "failed": 0}
+    batch["status"] = "completed"
+
+
+def get_batch(batch_id: str) -> dict | None:
+    batch = _BATCHES.get(batch_id)
+    if batch is None:
+        return None
+    batch["_polls"] += 1
+    if batch["status"] == "validating":
+        batch["status"] = "in_progress"
+    elif batch["status"] == "in_progress":
+        _run_batch(batch)
+    return _public_batch(batch)
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    latency_s = 0.0
+
+    def _send_json(self, status: int, obj: dict) -> None:
+        raw = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            return {}
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path == "/_stats":
+            with _STATS_LOCK:
+                return self._send_json(200, dict(_STATS))
+        m = re.search(r"/files/([^/]+)/content$", path)
+        if m and m.group(1) in _FILES:
+            raw = _FILES[m.group(1)]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+            return
+        m = re.search(r"/batches/([^/]+)$", path)
+        if m:
+            batch = get_batch(m.group(1))
+            if batch is not None:
+                return self._send_json(200, batch)
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path.endswith("/chat/completions"):
+            return self._send_json(200, chat_completion(self._read_json()))
+        if path.endswith("/responses"):
+            return self._send_json(200, responses_api(self._read_json()))
+        if path.endswith("/files"):
+            length = int(self.headers.get("Content-Length") or 0)
+            fields = _parse_multipart(self.headers.get("Content-Type", ""), self.rfile.read(length))
+            purpose = fields.get("purpose", b"").decode("utf-8")
+            return self._send_json(200, create_file(fields.get("file", b""), purpose))
+        if path.endswith("/batches"):
+            return self._send_json(200, create_batch(self._read_json()))
+        self._send_json(404, {"error": {"message": f"endpoint non simulato: {path}"}})
+
+    def log_message(self, fmt, *args):
+        logging.debug("[MOCK_LLM] " + fmt, *args)
+
+
+def serve(host: str = "127.0.0.1", port: int = 8089, latency_ms: int = 0) -> ThreadingHTTPServer:
+    """Crea il server (non avviato): chiamare serve_forever(), anche da un thread nei test."""
+    MockLLMHandler.latency_s = max(0, latency_ms) / 1000.0
+    return ThreadingHTTPServer((host, port), MockLLMHandler)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Server LLM finto compatibile OpenAI")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8089)
+    ap.add_argument("--latency-ms", type=int, default=0, help="latenza artificiale per richiesta")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = serve(args.host, args.port, args.latency_ms)
+    logging.info(f"[MOCK_LLM] in ascolto su http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,164 @@
+# backend/near_dup.py
+"""
+Rilevamento dei quasi-duplicati per riusare l'arricchimento.
+
+La stessa issue inviata a molti utenti, o la stessa promo con piccole personalizzazioni
+("Ciao Mario", codice ordine, link di tracciamento), produce testi quasi identici.
+Per ogni email calcoliamo una SimHash a 64 bit del testo pulito (shingle di 3 parole,
+dopo aver mascherato email, URL e numeri) e la salviamo in `content_fingerprint`
+divisa in 4 bande da 16 bit: due firme a distanza di Hamming <= 3 condividono
+per forza almeno una banda, quindi la ricerca dei candidati è una query su indice.
+
+Se un'email già arricchita e completa dello stesso utente è entro NEAR_DUP_MAX_HAMMING, il
+worker ne copia titolo, riassunto, tag e immagine invece di ricalcolarli.
+
+Tra utenti diversi (NEAR_DUP_CROSS_USER, disattivato di default) i testi non si copiano mai:
+titolo e riassunto di una promo o newsletter personalizzata possono contenere nomi, numeri
+d'ordine e altri dati del destinatario. Da un donatore di tipo "newsletter" si riusano solo
+immagine, colore e tag di tipo/topic (CROSS_USER_FIELDS); titolo e riassunto vengono
+generati dal contenuto del destinatario.
+"""
+import hashlib
+import os
+import re
+import time
+from collections import Counter
+
+from backend import metrics
+from backend.database import ContentFingerprint, Newsletter
+
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "1") == "1"
+NEAR_DUP_MAX_HAMMING = int(os.getenv("NEAR_DUP_MAX_HAMMING", "3"))   # <= 3 garantito dalle 4 bande
+NEAR_DUP_MIN_WORDS = int(os.getenv("NEAR_DUP_MIN_WORDS", "40"))      # testi corti: troppi falsi positivi
+NEAR_DUP_MAX_WORDS = int(os.getenv("NEAR_DUP_MAX_WORDS", "4000"))
+NEAR_DUP_CANDIDATES = int(os.getenv("NEAR_DUP_CANDIDATES", "50"))     # entro la distanza, da verificare
+NEAR_DUP_BAND_SCAN = int(os.getenv("NEAR_DUP_BAND_SCAN", "2000"))    # firme lette per banda
+# Riuso tra utenti diversi: solo da newsletter e solo campi non testuali (CROSS_USER_FIELDS)
+NEAR_DUP_CROSS_USER = os.getenv("NEAR_DUP_CROSS_USER", "0") == "1"
+
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+_URL_RE = re.compile(r"https?://\S+|www\.\S+")
+_NUM_RE = re.compile(r"\d+")
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+_MASK64 = (1 << 64) - 1
+
+REUSED_FIELDS = ("ai_title", "ai_summary_markdown", "image_url", "accent_hex", "type_tag", "topic_tag", "tag")
+CROSS_USER_FIELDS = ("image_url", "accent_hex", "type_tag", "topic_tag")
+CROSS_USER_DONOR_TYPES = ("newsletter",)
+
+
+def _to_signed(h: int) -> int:
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def _to_unsigned(h: int) -> int:
+    return h & _MASK64
+
+
+def bands(h: int) -> list[int]:
+    return [(h >> (16 * i)) & 0xFFFF for i in range(4)]
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(_to_unsigned(a) ^ _to_unsigned(b)).count("1")
+
+
+def fingerprint(clean_text: str) -> int | None:
+    """SimHash a 64 bit (senza segno) del testo; None se il testo è troppo corto."""
+    norm = _NUM_RE.sub("0", _URL_RE.sub(" ", _EMAIL_RE.sub(" ", (clean_text or "").lower())))
+    words = _WORD_RE.findall(norm)[:NEAR_DUP_MAX_WORDS]
+    if len(words) < NEAR_DUP_MIN_WORDS:
+        return None
+    shingles = Counter(" ".join(words[i:i + 3]) for i in range(len(words) - 2))
+    acc = [0] * 64
+    for sh, w in shingles.items():
+        h = int.from_bytes(hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            acc[bit] += w if (h >> bit) & 1 else -w
+    out = 0
+    for bit in range(64):
+        if acc[bit] > 0:
+            out |= 1 << bit
+    return out
+
+
+def index(email_id: str, user_id: str, sig: int) -> None:
+    b = bands(sig)
+    fields = {
+        ContentFingerprint.simhash: _to_signed(sig),
+        ContentFingerprint.band0: b[0],
+        ContentFingerprint.band1: b[1],
+        ContentFingerprint.band2: b[2],
+        ContentFingerprint.band3: b[3],
+        ContentFingerprint.created_at: int(time.time()),
+    }
+    (ContentFingerprint
+     .insert(email_id=email_id, user_id=user_id, **{f.name: v for f, v in fields.items()})
+     .on_conflict(conflict_target=[ContentFingerprint.email_id, ContentFingerprint.user_id], update=fields)
+     .execute())
+
+
+def find_donor(sig: int, email_id: str, user_id: str) -> dict | None:
+    """
+    Cerca un'email già arricchita e completa entro NEAR_DUP_MAX_HAMMING dalla firma.
+    Restituisce {"email_id", "user_id", "distance", "same_user", "fields": {...}} oppure None;
+    per un donatore di un altro utente "fields" contiene solo CROSS_USER_FIELDS. Bloccante.
+    """
+    # Una query per banda (ognuna sul suo indice), con il filtro della distanza applicato prima
+    # del limite NEAR_DUP_CANDIDATES: le copie più recenti di altri utenti non coprono quelle utili
+    scored: dict[tuple[str, str], int] = {}
+    for col, val in zip((ContentFingerprint.band0, ContentFingerprint.band1,
+                         ContentFingerprint.band2, ContentFingerprint.band3), bands(sig)):
+        cond = (col == val) & ~((ContentFingerprint.email_id == email_id) & (ContentFingerprint.user_id == user_id))
+        if not NEAR_DUP_CROSS_USER:
+            cond &= ContentFingerprint.user_id == user_id
+        q = (ContentFingerprint
+             .select(ContentFingerprint.email_id, ContentFingerprint.user_id, ContentFingerprint.simhash)
+             .where(cond)
+             .order_by(ContentFingerprint.created_at.desc())
+             .limit(NEAR_DUP_BAND_SCAN))
+        for cand_email, cand_user, cand_sig in q.tuples():
+            dist = hamming(sig, cand_sig)
+            if dist <= NEAR_DUP_MAX_HAMMING:
+                scored[(cand_email, cand_user)] = dist
+    # Più vicino prima; a parità, meglio un donatore dello stesso utente
+    close = sorted(scored.items(), key=lambda kv: (kv[1], kv[0][1] != user_id))[:NEAR_DUP_CANDIDATES]
+    for (cand_email, cand_user), dist in close:
+        n = Newsletter.get_or_none((Newsletter.email_id == cand_email) & (Newsletter.user_id == cand_user))
+        if not n or n.is_deleted or not n.is_complete or not n.ai_title or not n.ai_summary_markdown:
+            continue
+        same_user = cand_user == user_id
+        if not same_user and n.type_tag not in CROSS_USER_DONOR_TYPES:
+            continue
+        return {
+            "email_id": cand_email,
+            "user_id": cand_user,
+            "distance": dist,
+            "same_user": same_user,
+            "fields": {f: getattr(n, f) for f in (REUSED_FIELDS if same_user else CROSS_USER_FIELDS)},
+        }
+    return None
+
+
+def lookup_and_index(clean_text: str, email_id: str, user_id: str) -> dict | None:
+    """Calcola la firma, cerca un donatore e registra la firma della nuova email. Bloccante."""
+    if not NEAR_DUP_ENABLED:
+        return None
+    sig = fingerprint(clean_text)
+    if sig is None:
+        metrics.incr("near_dup.skipped_short")
+        return None
+    donor = find_donor(sig, email_id, user_id)
+    index(email_id, user_id, sig)
+
+    metrics.set_gauge("near_dup.max_hamming", NEAR_DUP_MAX_HAMMING)
+    metrics.incr("near_dup.hit" if donor else "near_dup.miss")
+    if donor:
+        metrics.incr(f"near_dup.distance.{donor['distance']}")
+        if not donor["same_user"]:
+            metrics.incr("near_dup.cross_user")
+    reuse_rate = metrics.ratio("near_dup.hit", "near_dup.miss")
+    if reuse_rate is not None:
+        metrics.set_gauge("near_dup.reuse_rate", round(reuse_rate, 3))
+    return donor
+
@@ -0,0 +1,182 @@
+# backend/photo_pool.py
+"""
+Pool di foto di Google Photos per utente, in SQLite (tabella photo_pool_item).
+
+Chiave (user_id, photo_id): il proxy trova la foto con una lookup sulla chiave primaria
+invece di scorrere la lista. `position` conserva l'ordine di importazione (indice unico
+(user_id, position)) e serve l'assegnazione a giro di update_images con OFFSET/LIMIT.
+Le importazioni sono insert_many a blocchi in un'unica transazione; una foto già presente
+aggiorna solo baseUrl e metadati e mantiene la sua posizione.
+
+Gli elementi restituiti hanno la forma usata dal frontend e dagli endpoint:
+{"id", "baseUrl", "authUrl", "mimeType", "filename"}, più "strategy" (il modo di download
+che ha funzionato l'ultima volta, vedi photo_prefetch) e "baseUrlAt" (epoch di baseUrl).
+"""
+import time
+from typing import Any, Iterable
+
+from peewee import fn
+
+from backend.database import db, PhotoPoolItem
+
+_INSERT_CHUNK = 100  # 8 colonne per riga: ben sotto il limite di variabili di SQLite
+
+_FIELDS = (PhotoPoolItem.photo_id, PhotoPoolItem.base_url, PhotoPoolItem.auth_url,
+           PhotoPoolItem.mime_type, PhotoPoolItem.filename, PhotoPoolItem.fetch_strategy,
+           PhotoPoolItem.added_at)
+
+
+def _item(row: tuple) -> dict[str, Any]:
+    photo_id, base_url, auth_url, mime_type, filename, strategy, added_at = row
+    return {"id": photo_id, "baseUrl": base_url, "authUrl": auth_url, "mimeType": mime_type,
+            "filename": filename, "strategy": strategy, "baseUrlAt": added_at}
+
+
+def _select(user_id: str):
+    return PhotoPoolItem.select(*_FIELDS).where(PhotoPoolItem.user_id == user_id)
+
+
+def add(user_id: str, items: Iterable[dict], replace: bool = False) -> int:
+    """
+    Aggiunge le foto in coda alla pool (o la sostituisce con replace=True).
+    Gli elementi senza id o baseUrl sono ignorati. Restituisce quante foto ha scritto.
+    """
+    now = int(time.time())
+    with db.atomic():
+        if replace:
+            PhotoPoolItem.delete().where(PhotoPoolItem.user_id == user_id).execute()
+            start = 0
+        else:
+            last = (PhotoPoolItem.select(fn.MAX(PhotoPoolItem.position))
+                    .where(PhotoPoolItem.user_id == user_id).scalar())
+            start = 0 if last is None else last + 1
+        rows: list[dict[str, Any]] = []
+        for it in items:
+            photo_id = (it.get("id") or "").strip()
+            base_url = (it.get("baseUrl") or "").strip()
+            if not photo_id or not base_url:
+                continue
+            rows.append({
+                "user_id": user_id,
+                "photo_id": photo_id,
+                "position": start + len(rows),
+                "base_url": base_url,
+                "auth_url": it.get("authUrl"),
+                "mime_type": it.get("mimeType"),
+                "filename": it.get("filename"),
+                "added_at": now,
+            })
+        for i in range(0, len(rows), _INSERT_CHUNK):
+            (PhotoPoolItem.insert_many(rows[i:i + _INSERT_CHUNK])
+             .on_conflict(
+                 conflict_target=[PhotoPoolItem.user_id, PhotoPoolItem.photo_id],
+                 preserve=[PhotoPoolItem.base_url, PhotoPoolItem.auth_url, PhotoPoolItem.mime_type,
+                           PhotoPoolItem.filename, PhotoPoolItem.added_at],
+             )
+             .execute())
+    return len(rows)
+
+
+def get(user_id: str, photo_id: str) -> dict[str, Any] | None:
+    """La foto della pool (lookup sulla chiave primaria), o None."""
+    row = _select(user_id).where(PhotoPoolItem.photo_id == photo_id).tuples().first()
+    return _item(row) if row else None
+
+
+def count(user_id: str) -> int:
+    return PhotoPoolItem.select().where(PhotoPoolItem.user_id == user_id).count()
+
+
+def clear(user_id: str) -> int:
+    """Svuota la pool dell'utente; restituisce quante foto ha tolto."""
+    return PhotoPoolItem.delete().where(PhotoPoolItem.user_id == user_id).execute()
+
+
+def head(user_id: str, limit: int) -> list[dict[str, Any]]:
+    """Le prime `limit` foto nell'ordine di importazione."""
+    rows = _select(user_id).order_by(PhotoPoolItem.position).limit(limit).tuples()
+    return [_item(r) for r in rows]
+
+
+def sample(user_id: str, limit: int) -> list[dict[str, Any]]:
+    """Fino a `limit` foto a caso."""
+    rows = _select(user_id).order_by(fn.Random()).limit(limit).tuples()
+    return [_item(r) for r in rows]
+
+
+def round_robin(user_id: str, start: int, n: int) -> list[dict[str, Any]]:
+    """
+    `n` foto a giro a partire dalla start-esima (modulo la dimensione della pool), ripetendo
+    la pool se n la supera. Una query per giro: OFFSET/LIMIT sull'indice (user_id, position).
+    """
+    total = count(user_id)
+    if not total or n <= 0:
+        return []
+    out: list[dict[str, Any]] = []
+    offset = start % total
+    while len(out) < n:
+        take = min(n - len(out), total - offset)
+        rows = (_select(user_id).order_by(PhotoPoolItem.position)
+                .offset(offset).limit(take).tuples())
+        chunk = [_item(r) for r in rows]
+        if not chunk:  # pool svuotata nel frattempo
+            break
+        out.extend(chunk)
+        offset = 0
+    return out
+
+
+def set_strategy(user_id: str, photo_id: str, strategy: str | None) -> None:
+    """Ricorda il modo di download che ha funzionato per la foto."""
+    (PhotoPoolItem.update(fetch_strategy=strategy)
+     .where((PhotoPoolItem.user_id == user_id) & (PhotoPoolItem.photo_id == photo_id))
+     .execute())
+
+
+def _stale_where(older_than: int, retry_before: int):
+    return (PhotoPoolItem.added_at < older_than) & (PhotoPoolItem.refresh_tried_at < retry_before)
+
+
+def stale_users(older_than: int, retry_before: int) -> list[str]:
+    """Utenti con foto da rinnovare (vedi stale)."""
+    rows = (PhotoPoolItem.select(PhotoPoolItem.user_id).distinct()
+            .where(_stale_where(older_than, retry_before)).tuples())
+    return [r[0] for r in rows]
+
+
+def stale(older_than: int, retry_before: int, user_ids: list[str], limit: int = 500) -> list[tuple[str, str]]:
+    """
+    (user_id, photo_id) delle foto degli utenti indicati con baseUrl ottenuto prima di
+    older_than (epoch), esclusi i rinnovi non riusciti dopo retry_before (vedi mark_refresh_tried).
+    """
+    if not user_ids:
+        return []
+    rows = (PhotoPoolItem.select(PhotoPoolItem.user_id, PhotoPoolItem.photo_id)
+            .where(_stale_where(older_than, retry_before) & PhotoPoolItem.user_id.in_(user_ids))
+            .order_by(PhotoPoolItem.added_at)
+            .limit(limit).tuples())
+    return list(rows)
+
+
+def mark_refresh_tried(user_id: str, photo_ids: list[str]) -> int:
+    """Segna le foto il cui baseUrl non si è potuto rinnovare (es. foto del Picker)."""
+    now = int(time.time())
+    n = 0
+    with db.atomic():
+        for i in range(0, len(photo_ids), 500):
+            n += (PhotoPoolItem.update(refresh_tried_at=now)
+                  .where((PhotoPoolItem.user_id == user_id) & PhotoPoolItem.photo_id.in_(photo_ids[i:i + 500]))
+                  .execute())
+    return n
+
+
+def update_base_urls(user_id: str, base_urls: dict[str, str]) -> int:
+    """Aggiorna i baseUrl rinnovati ({photo_id: baseUrl}) in una transazione."""
+    now = int(time.time())
+    n = 0
+    with db.atomic():
+        for photo_id, base_url in base_urls.items():
+            n += (PhotoPoolItem.update(base_url=base_url, added_at=now)
+                  .where((PhotoPoolItem.user_id == user_id) & (PhotoPoolItem.photo_id == photo_id))
+                  .execute())
+    return n
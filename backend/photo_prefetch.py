@@ -0,0 +1,262 @@
+# backend/photo_prefetch.py
+"""
+Download, prefetch e rinnovo dei baseUrl delle foto di Google Photos servite da /api/photos/proxy.
+
+- fetch: prova i modi di download (baseUrl con dimensioni, con o senza Bearer, baseUrl
+  nudo, alt=media, downloadUrl) partendo da quello che ha funzionato l'ultima volta per la
+  foto (photo_pool_item.fetch_strategy), così di solito basta un solo round-trip; il
+  risultato finisce nella cache delle foto (photos_cache di main).
+- prefetch: update_images chiama schedule() con le foto appena assegnate alle email; un
+  piccolo gruppo di task (PHOTOS_PREFETCH_CONCURRENCY) le scarica nelle dimensioni della
+  card prima che il feed le chieda. Richieste concorrenti per la stessa foto e dimensione
+  condividono un unico download.
+- rinnovo: i baseUrl scadono dopo circa 60 minuti; ogni PHOTOS_REFRESH_EVERY_S il task di
+  rinnovo rilegge con mediaItems:batchGet quelli più vecchi di PHOTOS_BASEURL_MAX_AGE_S per
+  gli utenti con un token valido (un solo worker per giro, lock in Redis). Lo stesso rinnovo
+  avviene al volo prima di scaricare una foto con baseUrl scaduto. Le foto del Picker che
+  la Library API non restituisce restano servite dalla cache finché è valida: un rinnovo
+  non riuscito viene ritentato solo dopo PHOTOS_REFRESH_RETRY_S, così non occupa i giri
+  successivi al posto delle altre foto.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Any, Callable
+
+import httpx
+
+from backend import metrics, photo_pool
+
+PHOTOS_PREFETCH_CONCURRENCY = int(os.getenv("PHOTOS_PREFETCH_CONCURRENCY", "4"))
+PHOTOS_PREFETCH_QUEUE_MAX = int(os.getenv("PHOTOS_PREFETCH_QUEUE_MAX", "500"))
+PHOTOS_BASEURL_MAX_AGE_S = int(os.getenv("PHOTOS_BASEURL_MAX_AGE_S", str(50 * 60)))
+PHOTOS_REFRESH_EVERY_S = int(os.getenv("PHOTOS_REFRESH_EVERY_S", str(5 * 60)))
+PHOTOS_REFRESH_RETRY_S = int(os.getenv("PHOTOS_REFRESH_RETRY_S", str(6 * 3600)))
+PHOTOS_FETCH_MAX_BYTES = int(os.getenv("IMG_PROXY_MAX_BYTES", str(5 * 1024 * 1024)))
+
+CARD_SIZE = (1600, 900, "no")  # dimensioni usate da update_images per le copertine
+BATCH_GET_URL = "https://photoslibrary.googleapis.com/v1/mediaItems:batchGet"
+BATCH_GET_MAX = 50
+REFRESH_LOCK_KEY = "photos:refresh:lock"
+
+
+class PhotoTooLarge(Exception):
+    """L'immagine supera PHOTOS_FETCH_MAX_BYTES."""
+
+
+def cache_key(user_id: str, photo_id: str, w: int, h: int, mode: str) -> str:
+    return f"{user_id}:{photo_id}:{w}:{h}:{mode}"  # cache separata per utente
+
+
+def attempts(item: dict, bearer: str | None, w: int, h: int, mode: str) -> list[tuple[str, str, dict]]:
+    """(modo, url, header) da provare, con per primo quello riuscito l'ultima volta."""
+    base = (item.get("baseUrl") or "").strip()
+    auth = (item.get("authUrl") or "").strip()
+    suffix = f"=w{w}-h{h}-{mode}"
+    out: list[tuple[str, str, dict]] = []
+    if base:
+        out.append(("sized", base + suffix, {}))
+    if base and bearer:
+        sep = "&" if "?" in base else "?"
+        out.append(("sized_auth", base + suffix, {"Authorization": bearer}))
+        out.append(("raw_auth", base, {"Authorization": bearer}))
+        out.append(("alt_media", base + f"{sep}alt=media", {"Authorization": bearer}))
+    if auth and bearer:
+        out.append(("download", auth, {"Authorization": bearer}))
+    preferred = item.get("strategy")
+    out.sort(key=lambda a: a[0] != preferred)  # ordinamento stabile: il resto resta nell'ordine
+    return out
+
+
+class PhotoPrefetcher:
+    """Download condivisi, coda di prefetch e rinnovo periodico dei baseUrl."""
+
+    def __init__(self, cache: Any, bearer_for: Callable[[str], str | None]) -> None:
+        self._cache = cache
+        self._bearer_for = bearer_for
+        self._client: httpx.AsyncClient | None = None
+        self._queue: asyncio.Queue | None = None
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    # --- ciclo di vita ---
+
+    def start(self, lock_client: Any = None) -> None:
+        """Avvia i task di prefetch e di rinnovo (dal lifespan dell'app)."""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=PHOTOS_PREFETCH_QUEUE_MAX)
+        self._tasks = [asyncio.create_task(self._prefetch_worker(), name=f"photos-prefetch-{i}")
+                       for i in range(max(1, PHOTOS_PREFETCH_CONCURRENCY))]
+        self._tasks.append(asyncio.create_task(self._refresh_loop(lock_client), name="photos-refresh"))
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        for t in self._tasks:
+            try:
+                await t
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks = []
+        self._queue = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=20.0, follow_redirects=True)
+        return self._client
+
+    # --- download ---
+
+    async def get(self, user_id: str, item: dict, w: int, h: int, mode: str) -> dict | None:
+        """
+        {"ts", "bytes", "ct"} della foto: dalla cache, dal download già in corso o da uno nuovo.
+        None se nessun modo di download funziona; PhotoTooLarge se l'immagine è troppo grande.
+        """
+        key = cache_key(user_id, item["id"], w, h, mode)
+        hit = self._cache.get(key)
+        if hit:
+            return hit
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(user_id, item, w, h, mode, key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        # shield: se la richiesta HTTP viene annullata il download continua e riempie la cache
+        return await asyncio.shield(task)
+
+    async def _fetch(self, user_id: str, item: dict, w: int, h: int, mode: str, key: str) -> dict | None:
+        bearer = self._bearer_for(user_id)
+        if bearer and (item.get("baseUrlAt") or 0) < time.time() - PHOTOS_BASEURL_MAX_AGE_S:
+            fresh = await self.refresh(user_id, bearer, [item["id"]])
+            if item["id"] in fresh:
+                item = {**item, "baseUrl": fresh[item["id"]], "baseUrlAt": int(time.time())}
+
+        tried = []
+        client = self._http()
+        for strategy, url, headers in attempts(item, bearer, w, h, mode):
+            try:
+                r = await client.get(url, headers=headers)
+            except httpx.HTTPError as e:
+                tried.append((strategy, type(e).__name__))
+                continue
+            tried.append((strategy, r.status_code))
+            if r.headers.get("Content-Length") and int(r.headers["Content-Length"]) > PHOTOS_FETCH_MAX_BYTES:
+                raise PhotoTooLarge(item["id"])
+            if r.status_code != 200:
+                continue
+            ent = {"ts": time.time(), "bytes": r.content, "ct": r.headers.get("Content-Type", "image/jpeg")}
+            self._cache.put(key, ent)
+            metrics.incr("photos.fetch.ok")
+            metrics.incr("photos.fetch.attempts", len(tried))
+            if strategy != item.get("strategy"):
+                try:
+                    await asyncio.to_thread(photo_pool.set_strategy, user_id, item["id"], strategy)
+                except Exception as e:
+                    logging.debug(f"[PHOTOS] salvataggio modo di download fallito per {item['id']}: {e}")
+            return ent
+        metrics.incr("photos.fetch.failed")
+        logging.warning("[PHOTOS] download fallito per %s. Tentativi: %s", item.get("id"), tried)
+        return None
+
+    # --- prefetch ---
+
+    def schedule(self, user_id: str, items: list[dict], sizes: tuple[tuple[int, int, str], ...] = (CARD_SIZE,)) -> int:
+        """Mette in coda il download delle foto non ancora in cache. Restituisce quante ne ha accodate."""
+        if self._queue is None:
+            return 0
+        queued = 0
+        seen: set[str] = set()
+        for item in items:
+            for w, h, mode in sizes:
+                key = cache_key(user_id, item["id"], w, h, mode)
+                if key in seen or key in self._inflight or self._cache.get(key):
+                    continue
+                seen.add(key)
+                try:
+                    self._queue.put_nowait((user_id, item, (w, h, mode)))
+                    queued += 1
+                except asyncio.QueueFull:
+                    metrics.incr("photos.prefetch.dropped")
+                    return queued
+        metrics.incr("photos.prefetch.scheduled", queued)
+        return queued
+
+    async def _prefetch_worker(self) -> None:
+        assert self._queue is not None
+        while True:
+            user_id, item, (w, h, mode) = await self._queue.get()
+            try:
+                await self.get(user_id, item, w, h, mode)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.info(f"[PHOTOS] prefetch fallito per {item.get('id')}: {e}")
+
+    # --- rinnovo dei baseUrl ---
+
+    async def refresh(self, user_id: str, bearer: str, photo_ids: list[str]) -> dict[str, str]:
+        """Rilegge i baseUrl con mediaItems:batchGet e li salva. Restituisce {photo_id: baseUrl}."""
+        fresh: dict[str, str] = {}
+        client = self._http()
+        for i in range(0, len(photo_ids), BATCH_GET_MAX):
+            chunk = photo_ids[i:i + BATCH_GET_MAX]
+            try:
+                r = await client.get(BATCH_GET_URL, params=[("mediaItemIds", pid) for pid in chunk],
+                                     headers={"Authorization": bearer})
+            except httpx.HTTPError as e:
+                logging.info(f"[PHOTOS] rinnovo baseUrl fallito per {user_id}: {e}")
+                break
+            if r.status_code != 200:
+                logging.info(f"[PHOTOS] rinnovo baseUrl per {user_id}: HTTP {r.status_code}")
+                break
+            for res in r.json().get("mediaItemResults") or []:
+                mi = res.get("mediaItem") or {}
+                if mi.get("id") and mi.get("baseUrl"):
+                    fresh[mi["id"]] = mi["baseUrl"]
+        if fresh:
+            await asyncio.to_thread(photo_pool.update_base_urls, user_id, fresh)
+            metrics.incr("photos.baseurl.refreshed", len(fresh))
+        return fresh
+
+    async def refresh_stale(self, lock_client: Any = None) -> int:
+        """Rinnova i baseUrl in scadenza degli utenti con un token Photos valido."""
+        if lock_client is not None:
+            try:
+                if not lock_client.set(REFRESH_LOCK_KEY, str(os.getpid()), nx=True, ex=max(1, PHOTOS_REFRESH_EVERY_S - 5)):
+                    return 0  # questo giro lo fa un altro worker
+            except Exception as e:
+                logging.debug(f"[PHOTOS] lock di rinnovo non disponibile: {e}")
+        now = int(time.time())
+        cutoff, retry_before = now - PHOTOS_BASEURL_MAX_AGE_S, now - PHOTOS_REFRESH_RETRY_S
+        # Solo utenti con un token: le foto degli altri non si possono rinnovare in questo giro
+        bearers = {u: b for u in await asyncio.to_thread(photo_pool.stale_users, cutoff, retry_before)
+                   if (b := self._bearer_for(u))}
+        by_user: dict[str, list[str]] = defaultdict(list)
+        for user_id, photo_id in await asyncio.to_thread(photo_pool.stale, cutoff, retry_before, list(bearers)):
+            by_user[user_id].append(photo_id)
+        total = 0
+        for user_id, ids in by_user.items():
+            fresh = await self.refresh(user_id, bearers[user_id], ids)
+            total += len(fresh)
+            missed = [p for p in ids if p not in fresh]
+            if missed:
+                await asyncio.to_thread(photo_pool.mark_refresh_tried, user_id, missed)
+        if total:
+            logging.info(f"[PHOTOS] rinnovati {total} baseUrl per {len(by_user)} utenti")
+        return total
+
+    async def _refresh_loop(self, lock_client: Any) -> None:
+        while True:
+            await asyncio.sleep(PHOTOS_REFRESH_EVERY_S)
+            try:
+                await self.refresh_stale(lock_client)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"[PHOTOS] giro di rinnovo fallito: {e}")
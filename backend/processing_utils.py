@@ -2,6 +2,8 @@
 
 import os
 import base64
+import hashlib
+import time
 import re
 import json
 import logging
@@ -16,6 +18,11 @@ from email.utils import parseaddr
 from html import escape as html_escape
 import random
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from backend.adaptive_limiter import AdaptiveLimiter
+from backend import metrics
+from backend.database import LlmCache
+from backend.content_condense import condense_for_ai
+from backend.local_classifier import classify_local
 
 SHARED_HTTP_CLIENT = httpx.AsyncClient(timeout=30.0)
 
@@ -44,7 +51,18 @@ def normalize_image_url(url: str | None) -> str | None:
 MODEL_SUMMARY = "gpt-5-nano"
 MODEL_JSON = "gpt-4o-mini"
 MODEL_CLASSIFY = "gpt-4o-mini"
+MODEL_COMBINED = os.getenv("MODEL_COMBINED", MODEL_JSON)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+# Endpoint OpenAI-compatibile (es. http://localhost:8089/v1 per backend.mock_llm)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+# "separate": classificazione, riassunto e keyword in tre chiamate (default);
+# "combined": una sola chiamata strutturata, con fallback sulle tre chiamate se l'output non è valido
+ENRICH_MODE = os.getenv("ENRICH_MODE", "separate").strip().lower()
+# Budget di token del contenuto per chiamata (condensato da content_condense, non troncato)
+AI_TOKENS_SUMMARY = int(os.getenv("AI_TOKENS_SUMMARY", "1000"))
+AI_TOKENS_CLASSIFY = int(os.getenv("AI_TOKENS_CLASSIFY", "1500"))
+AI_TOKENS_KEYWORD = int(os.getenv("AI_TOKENS_KEYWORD", "400"))
+AI_TOKENS_COMBINED = int(os.getenv("AI_TOKENS_COMBINED", "2000"))
 PIXABAY_KEY = os.getenv("PIXABAY_KEY")
 PIXABAY_TIMEOUT_SECONDS = float(os.getenv("PIXABAY_TIMEOUT_SECONDS", "25"))
 PIXABAY_MAX_RETRIES = int(os.getenv("PIXABAY_MAX_RETRIES", "3"))
@@ -53,6 +71,18 @@ PIXABAY_FALLBACK_IMAGE_URL = os.getenv(
     "FALLBACK_NEWSLETTER_IMAGE_URL",
     "https://picsum.photos/seed/newsletter/1600/900",
 )
+
+# Cache persistente dei risultati LLM (condivisa tra utenti e processi, su SQLite)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(30 * 86400)))   # 30 giorni
+LLM_CACHE_MAX_ROWS = int(os.getenv("LLM_CACHE_MAX_ROWS", "50000"))
+LLM_CACHE_PRUNE_EVERY = 200   # in media, una potatura ogni N scritture
+LLM_CACHE_VERSION = "1"       # incrementare se cambia il post-processing dei risultati
+
+# Concorrenza adattiva (AIMD) verso OpenAI e Pixabay: i limiti si regolano da soli
+# in base a latenza e 429/5xx; configurabili via <PREFIX>_CONC_* e <PREFIX>_LATENCY_TARGET_S.
+OPENAI_LIMITER = AdaptiveLimiter.from_env("openai", "OPENAI", initial=4, min_limit=1, max_limit=16, latency_target_s=20.0)
+PIXABAY_LIMITER = AdaptiveLimiter.from_env("pixabay", "PIXABAY", initial=2, min_limit=1, max_limit=8, latency_target_s=4.0)
 
 ALLOWED_TYPE_TAGS = ["newsletter", "promo", "personali", "informative"]
 
@@ -84,10 +114,8 @@ TOPIC_VOCAB = [
     "istruzione", "politica", "attualita", "analisi", "approfondimento", "generico"
 ]
 
-CLASSIFY_PROMPT_TEMPLATE = (
-    "Sei un classificatore di email. Devi restituire SOLO un JSON valido con due chiavi: "
-    "'type_tag' e 'topic_tag'. Niente testo extra.\n\n"
-
+# Regole di classificazione condivise dal prompt dedicato e da quello combinato
+CLASSIFY_RULES = (
     "Definizione 'type_tag' (scegline UNA):\n"
     "- 'newsletter': invio editoriale/ricorrente (articoli, analisi, raccolte link, blog/press recap) "
     "senza call-to-action commerciale predominante. Include Substack, Morning/Marketing Brew, Techpresso, "
@@ -120,18 +148,82 @@ CLASSIFY_PROMPT_TEMPLATE = (
     "gaming/musica/cinema/fotografia → intrattenimento; "
     "politica/attualita/analisi/approfondimento → cultura; "
     "sport → sport.\n\n"
+)
 
+CLASSIFY_PROMPT_TEMPLATE = (
+    "Sei un classificatore di email. Devi restituire SOLO un JSON valido con due chiavi: "
+    "'type_tag' e 'topic_tag'. Niente testo extra.\n\n"
+    + CLASSIFY_RULES +
     "Output SOLO JSON, es.: {{\"type_tag\":\"newsletter\",\"topic_tag\":\"cultura\"}}\n\n"
     "Contenuto da classificare:\n{content}"
 )
 
+# Adattatori per la keyword dell'immagine (usati da get_ai_keyword e dal prompt combinato)
+KEYWORD_PROMPT_ADAPTERS: dict[str, str] = {
+    # Offerte: oggetti/prodotti/beneficio visivo (es. "discount tag", "checkout", "gift box")
+    "promo": "Scegli una keyword visuale legata a offerta/prodotto/beneficio (es. coupon, price tag, delivery, gift).",
+    # Personali: azione/oggetto della comunicazione (es. "meeting notes", "calendar", "reply letter")
+    "personali": "Scegli una keyword visuale che evochi l'azione richiesta (es. reply, calendar, checklist, contract).",
+    # Informative: oggetto/fatto (es. "shield", "policy document", "update bell")
+    "informative": "Scegli un simbolo neutro e chiaro del cambiamento/comunicazione (es. document, shield, update bell).",
+    # Newsletter editoriali: tema/ambito (es. "growth chart", "design sketch", "code editor")
+    "newsletter": "Scegli un oggetto che rappresenti il tema (es. growth chart, code editor, design sketch).",
+}
+
+# Arricchimento combinato: classificazione, titolo/riassunto e keyword in UNA chiamata
+# con output strutturato. L'adattatore per tipologia viene scelto dal modello stesso.
+COMBINED_PROMPT_TEMPLATE = (
+    "Sei un assistente che prepara email per un feed visuale in stile Instagram. "
+    "In un'unica risposta JSON devi: (1) classificare l'email, (2) scrivere titolo e riassunto "
+    "adattati alla tipologia scelta, (3) proporre una keyword per cercare l'immagine di copertina.\n\n"
+
+    "## 1. Classificazione\n"
+    + CLASSIFY_RULES +
+
+    "## 2. Titolo e riassunto\n"
+    "Obiettivo: dare subito un'idea chiara del tema e un beneficio pratico per il lettore. "
+    "Italiano naturale, niente gergo inutile né anglicismi evitabili; spiega i termini tecnici in 1–3 parole "
+    "oppure omettili. Includi almeno un takeaway/uso pratico. Escludi contenuti dietro paywall. "
+    "Niente link, CTA, emoji o checklist. Se citi numeri, max 2 e con contesto.\n"
+    "- 'title': massimo 10 parole, in italiano.\n"
+    "- 'summary_markdown': massimo 300 caratteri, 2–3 paragrafi separati da una riga vuota; "
+    "metti in **grassetto** parole o concetti importanti.\n"
+    "Dopo aver scelto 'type_tag', applica SOLO l'adattamento corrispondente:\n"
+    "{summary_adapters}\n\n"
+
+    "## 3. Keyword immagine\n"
+    "'keyword': frase di 1–3 parole in inglese, concreta e visivamente rappresentabile. "
+    "Evita termini generici come \"news\" o \"update\" e nomi di brand. "
+    "Anche qui applica l'indicazione del 'type_tag' scelto:\n"
+    "{keyword_adapters}\n\n"
+
+    "Rispondi SOLO con il JSON richiesto dallo schema."
+)
+
+COMBINED_SCHEMA: dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "type_tag": {"type": "string", "enum": ALLOWED_TYPE_TAGS},
+        "topic_tag": {"type": "string", "enum": TOPIC_VOCAB},
+        "title": {"type": "string"},
+        "summary_markdown": {"type": "string"},
+        "keyword": {"type": "string"},
+    },
+    "required": ["type_tag", "topic_tag", "title", "summary_markdown", "keyword"],
+    "additionalProperties": False,
+}
+
 __all__ = [
     "b64_urlsafe_decode", "_walk_parts", "extract_html_from_payload", "clean_html",
     "parse_sender", "_cheap_fallback_keyword_from_text", "_extract_json_from_string",
     "_extract_output_text", "extract_domain_from_from_header", "_decode_body",
     "root_domain_py", "get_ai_summary", "classify_type_and_topic",
     "get_ai_keyword", "get_pixabay_image_by_query", "extract_dominant_hex",
-    "normalize_image_url", "SHARED_HTTP_CLIENT", "PIXABAY_FALLBACK_IMAGE_URL"
+    "normalize_image_url", "SHARED_HTTP_CLIENT", "PIXABAY_FALLBACK_IMAGE_URL",
+    "OPENAI_LIMITER", "PIXABAY_LIMITER", "OPENAI_BASE_URL", "ENRICH_MODE",
+    "build_combined_prompt", "build_combined_request", "parse_combined_response",
+    "enrich_combined", "llm_cache_key", "llm_cache_get",
+    "llm_cache_put", "prune_llm_cache"
 ]
 
 _BANNED_KW = {
@@ -285,11 +377,83 @@ def extract_domain_from_from_header(h: Optional[str]) -> str:
     host = s.split("@", 1)[1] if "@" in s else s
     return (host or "").strip().strip(">").lower()
     
+# --- CACHE DEI RISULTATI LLM ---
+
+_CACHE_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+_CACHE_URL_RE = re.compile(r"https?://\S+")
+
+def llm_cache_key(kind: str, model: str, prompt: str, content: str) -> str:
+    """
+    Chiave di cache: hash di (versione, tipo, modello, prompt, contenuto normalizzato).
+    La normalizzazione toglie indirizzi email/URL personalizzati e differenze di spazi/maiuscole,
+    così la stessa issue ricevuta da utenti diversi produce la stessa chiave.
+    Il prompt entra nell'hash: modificarlo invalida automaticamente le voci precedenti.
+    """
+    norm = _CACHE_URL_RE.sub("<url>", _CACHE_EMAIL_RE.sub("<email>", content or ""))
+    norm = " ".join(norm.split()).lower()
+    h = hashlib.sha256()
+    for part in (LLM_CACHE_VERSION, kind, model, prompt or "", norm):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+def _llm_cache_get_sync(key: str) -> Any:
+    row = LlmCache.get_or_none(LlmCache.key == key)
+    if row is None or row.created_at < time.time() - LLM_CACHE_TTL:
+        return None
+    return json.loads(row.payload)
+
+def _llm_cache_put_sync(key: str, kind: str, model: str, value: Any) -> None:
+    (LlmCache
+     .insert(key=key, kind=kind, model=model, payload=json.dumps(value, ensure_ascii=False), created_at=int(time.time()))
+     .on_conflict(conflict_target=[LlmCache.key],
+                  preserve=[LlmCache.kind, LlmCache.model, LlmCache.payload, LlmCache.created_at])
+     .execute())
+    if random.random() < 1.0 / LLM_CACHE_PRUNE_EVERY:
+        prune_llm_cache()
+
+def prune_llm_cache() -> int:
+    """Rimuove le voci scadute e le più vecchie oltre LLM_CACHE_MAX_ROWS. Restituisce le righe eliminate."""
+    removed = LlmCache.delete().where(LlmCache.created_at < int(time.time()) - LLM_CACHE_TTL).execute()
+    excess = LlmCache.select().count() - LLM_CACHE_MAX_ROWS
+    if excess > 0:
+        oldest = LlmCache.select(LlmCache.key).order_by(LlmCache.created_at.asc()).limit(excess)
+        removed += LlmCache.delete().where(LlmCache.key.in_(oldest)).execute()
+    if removed:
+        logging.info(f"[LLM_CACHE] potatura: {removed} voci rimosse")
+    return removed
+
+async def llm_cache_get(kind: str, key: str) -> Any:
+    """Legge dalla cache (best-effort) aggiornando contatori e hit ratio per tipo."""
+    if not LLM_CACHE_ENABLED:
+        return None
+    try:
+        value = await asyncio.to_thread(_llm_cache_get_sync, key)
+    except Exception as e:
+        logging.debug(f"[LLM_CACHE] lettura fallita: {e}")
+        value = None
+    metrics.incr(f"llm_cache.{kind}.{'hit' if value is not None else 'miss'}")
+    hit_ratio = metrics.ratio(f"llm_cache.{kind}.hit", f"llm_cache.{kind}.miss")
+    if hit_ratio is not None:
+        metrics.set_gauge(f"llm_cache.{kind}.hit_ratio", round(hit_ratio, 3))
+    return value
+
+async def llm_cache_put(kind: str, key: str, model: str, value: Any) -> None:
+    """Salva un risultato valido (mai i fallback) nella cache, best-effort."""
+    if not LLM_CACHE_ENABLED:
+        return
+    # Un risultato che cita un indirizzo email è personale: non va condiviso con altri utenti
+    if _CACHE_EMAIL_RE.search(json.dumps(value, ensure_ascii=False)):
+        return
+    try:
+        await asyncio.to_thread(_llm_cache_put_sync, key, kind, model, value)
+    except Exception as e:
+        logging.debug(f"[LLM_CACHE] scrittura fallita: {e}")
+
 # --- FUNZIONI DI ARRICCHIMENTO (AI E IMMAGINI) ---
 
-async def get_ai_summary(content: str, client: httpx.AsyncClient, type_tag: str | None = None) -> dict:
-    raw = content or ""
-    clean_content = clean_html(raw)[:4000]
+async def get_ai_summary(content: str, client: httpx.AsyncClient, type_tag: str | None = None, use_cache: bool = True) -> dict:
+    clean_content = condense_for_ai(content or "", AI_TOKENS_SUMMARY)
 
     type_tag_norm = (type_tag or "").strip().lower()
     adapter = TYPE_PROMPT_ADAPTERS.get(type_tag_norm, "")
@@ -354,7 +518,13 @@ Output Format
 {("\n\nAdattamento specifico per tipologia:\n" + adapter) if adapter else ""}
 """
 
-    user_input = f"Testo da analizzare:\n---\n{clean_html(content)[:4000]}\n---"
+    user_input = f"Testo da analizzare:\n---\n{clean_content}\n---"
+
+    cache_key = llm_cache_key("summary", MODEL_SUMMARY, instructions, clean_content)
+    if use_cache:
+        cached = await llm_cache_get("summary", cache_key)
+        if isinstance(cached, dict):
+            return cached
 
     try:
         if not OPENAI_API_KEY:
@@ -371,9 +541,10 @@ Output Format
             "max_output_tokens": 600
         }
 
-        # Usa il client condiviso
-        resp = await SHARED_HTTP_CLIENT.post(
-            "https://api.openai.com/v1/responses",
+        # Usa il client condiviso, dentro il limiter adattivo
+        resp = await OPENAI_LIMITER.request(
+            SHARED_HTTP_CLIENT, "POST",
+            f"{OPENAI_BASE_URL}/responses",
             json=payload,
             headers={"Authorization": f"Bearer {OPENAI_API_KEY}"}
         )
@@ -389,8 +560,8 @@ Output Format
         if not isinstance(obj, dict) or "title" not in obj or "summary_markdown" not in obj:
             raise ValueError("JSON non valido o chiavi richieste mancanti.")
 
-        obj["title"] = str(obj["title"])[:200]
-        obj["summary_markdown"] = str(obj["summary_markdown"])[:1200]
+        obj = {"title": str(obj["title"])[:200], "summary_markdown": str(obj["summary_markdown"])[:1200]}
+        await llm_cache_put("summary", cache_key, MODEL_SUMMARY, obj)
         return obj
 
     except Exception as e:
@@ -438,10 +609,24 @@ def _coerce_tags(obj: dict) -> dict:
 
 # --- FUNZIONE PRINCIPALE DI CLASSIFICAZIONE (SOSTITUITA) ---
 
-async def classify_type_and_topic(content: str, client: httpx.AsyncClient) -> dict:
-    clean_content = clean_html(content)
+async def classify_type_and_topic(content: str, client: httpx.AsyncClient, use_cache: bool = True, allow_local: bool = True) -> dict:
+    clean_content = condense_for_ai(content, AI_TOKENS_CLASSIFY)
+
+    # Prima il classificatore locale: se è abbastanza sicuro la chiamata LLM non serve
+    if allow_local:
+        local = classify_local(clean_content)
+        metrics.incr(f"local_classifier.{'hit' if local else 'miss'}")
+        if local:
+            return local
+
     prompt = build_classify_prompt(clean_content)
-    
+
+    cache_key = llm_cache_key("classify", MODEL_CLASSIFY, "", prompt)
+    if use_cache:
+        cached = await llm_cache_get("classify", cache_key)
+        if isinstance(cached, dict):
+            return cached
+
     try:
         if not OPENAI_API_KEY:
             raise ValueError("OpenAI API Key non trovata.")
@@ -457,9 +642,10 @@ async def classify_type_and_topic(content: str, client: httpx.AsyncClient) -> di
             "max_tokens": 120
         }
         
-        # Usa il client condiviso
-        resp = await SHARED_HTTP_CLIENT.post(
-            "https://api.openai.com/v1/chat/completions",
+        # Usa il client condiviso, dentro il limiter adattivo
+        resp = await OPENAI_LIMITER.request(
+            SHARED_HTTP_CLIENT, "POST",
+            f"{OPENAI_BASE_URL}/chat/completions",
             json=payload,
             headers={"Authorization": f"Bearer {OPENAI_API_KEY}"}
         )
@@ -469,11 +655,113 @@ async def classify_type_and_topic(content: str, client: httpx.AsyncClient) -> di
         raw_content = data["choices"][0]["message"]["content"]
         
         obj = _extract_json(raw_content)
-        return _coerce_tags(obj)
+        tags = _coerce_tags(obj)
+        if obj:
+            await llm_cache_put("classify", cache_key, MODEL_CLASSIFY, tags)
+        return tags
         
     except Exception as e:
         logging.error(f"Errore in classify_type_and_topic: {e}")
         return {"type_tag": "informative", "topic_tag": "generico"}
+
+# --- ARRICCHIMENTO COMBINATO (UNA SOLA CHIAMATA) ---
+
+def build_combined_prompt() -> str:
+    """Prompt di sistema per l'arricchimento combinato (il contenuto va nel messaggio utente)."""
+    return COMBINED_PROMPT_TEMPLATE.format(
+        topic_vocab=", ".join(TOPIC_VOCAB),
+        summary_adapters="\n".join(f"- {k}: {v}" for k, v in TYPE_PROMPT_ADAPTERS.items()),
+        keyword_adapters="\n".join(f"- {k}: {v}" for k, v in KEYWORD_PROMPT_ADAPTERS.items()),
+    )
+
+def _validate_combined(obj: Any, clean_content: str) -> dict | None:
+    """Valida l'output combinato: None se manca qualcosa di essenziale (→ fallback a tre chiamate)."""
+    if not isinstance(obj, dict):
+        return None
+    ttype = _sanitize_value(obj.get("type_tag", ""))
+    topic = _sanitize_value(obj.get("topic_tag", ""))
+    title = str(obj.get("title") or "").strip()
+    summary = str(obj.get("summary_markdown") or "").strip()
+    if ttype not in ALLOWED_TYPE_TAGS or not title or not summary:
+        return None
+    if topic not in TOPIC_VOCAB:
+        topic = "generico"
+    kw = str(obj.get("keyword") or "").strip()
+    if not kw or kw.lower() in _BANNED_KW:
+        kw = _cheap_fallback_keyword_from_text(clean_content[:2000])
+    return {
+        "type_tag": ttype,
+        "topic_tag": topic,
+        "title": title[:200],
+        "summary_markdown": summary[:1200],
+        "keyword": kw,
+    }
+
+def build_combined_request(content: str) -> tuple[dict, str, str]:
+    """
+    Prepara la richiesta combinata: (payload chat/completions, chiave di cache, testo pulito).
+    Condivisa dalla chiamata sincrona e dalla modalità batch (backend.batch_enrich).
+    """
+    clean_content = condense_for_ai(content, AI_TOKENS_COMBINED)
+    system_prompt = build_combined_prompt()
+    user_input = f"Email da elaborare:\n---\n{clean_content}\n---"
+    payload = {
+        "model": MODEL_COMBINED,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_input}
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "email_enrichment", "strict": True, "schema": COMBINED_SCHEMA},
+        },
+        "temperature": 0.2,
+        "max_tokens": 700
+    }
+    return payload, llm_cache_key("combined", MODEL_COMBINED, system_prompt, user_input), clean_content
+
+def parse_combined_response(data: Mapping[str, Any] | None, clean_content: str) -> dict | None:
+    """Estrae e valida il risultato combinato da una risposta chat/completions."""
+    return _validate_combined(_extract_json(_extract_output_text(data) or ""), clean_content)
+
+async def enrich_combined(content: str, client: httpx.AsyncClient, use_cache: bool = True) -> dict | None:
+    """
+    Classificazione + titolo/riassunto + keyword in un'unica chiamata con output strutturato.
+    Restituisce un dict con type_tag, topic_tag, title, summary_markdown e keyword,
+    oppure None se la chiamata fallisce o l'output non è valido: il chiamante ripiega
+    allora su classify_type_and_topic / get_ai_summary / get_ai_keyword.
+    """
+    payload, cache_key, clean_content = build_combined_request(content)
+    if use_cache:
+        cached = await llm_cache_get("combined", cache_key)
+        if isinstance(cached, dict):
+            return cached
+
+    try:
+        if not OPENAI_API_KEY:
+            raise ValueError("OpenAI API Key non trovata.")
+
+        resp = await OPENAI_LIMITER.request(
+            SHARED_HTTP_CLIENT, "POST",
+            f"{OPENAI_BASE_URL}/chat/completions",
+            json=payload,
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"}
+        )
+        resp.raise_for_status()
+
+        result = parse_combined_response(resp.json(), clean_content)
+        if result is None:
+            metrics.incr("enrich.combined.invalid")
+            logging.warning("enrich_combined: output non valido, fallback a tre chiamate.")
+            return None
+        metrics.incr("enrich.combined.ok")
+        await llm_cache_put("combined", cache_key, MODEL_COMBINED, result)
+        return result
+
+    except Exception as e:
+        metrics.incr("enrich.combined.error")
+        logging.error(f"Errore in enrich_combined: {e}")
+        return None
     
 def _decode_body(part_or_body) -> str:
     """
@@ -557,19 +845,10 @@ def root_domain_py(url: str) -> str:
         return ".".join(parts[-2:])
     return host
 
-async def get_ai_keyword(content: str, client: httpx.AsyncClient, type_tag: str | None = None) -> str:
-    base = clean_html(content)[:2000]
+async def get_ai_keyword(content: str, client: httpx.AsyncClient, type_tag: str | None = None, use_cache: bool = True) -> str:
+    base = condense_for_ai(content, AI_TOKENS_KEYWORD)
     t = (type_tag or "").strip().lower()
-    adapter = {
-        # Offerte: oggetti/prodotti/beneficio visivo (es. "discount tag", "checkout", "gift box")
-        "promo": "Scegli una keyword visuale legata a offerta/prodotto/beneficio (es. coupon, price tag, delivery, gift).",
-        # Personali: azione/oggetto della comunicazione (es. "meeting notes", "calendar", "reply letter")
-        "personali": "Scegli una keyword visuale che evochi l'azione richiesta (es. reply, calendar, checklist, contract).",
-        # Informative: oggetto/fatto (es. "shield", "policy document", "update bell")
-        "informative": "Scegli un simbolo neutro e chiaro del cambiamento/comunicazione (es. document, shield, update bell).",
-        # Newsletter editoriali: tema/ambito (es. "growth chart", "design sketch", "code editor")
-        "newsletter": "Scegli un oggetto che rappresenti il tema (es. growth chart, code editor, design sketch).",
-    }.get(t, "")
+    adapter = KEYWORD_PROMPT_ADAPTERS.get(t, "")
 
     instructions = f"""
     Analizza il testo di una newsletter. Restituisci un oggetto JSON con una singola chiave "keyword".
@@ -577,16 +856,23 @@ async def get_ai_keyword(content: str, client: httpx.AsyncClient, type_tag: str
     Evita termini generici come "news" o "update" e nomi di brand.
     {adapter}
     """
+    cache_key = llm_cache_key("keyword", MODEL_JSON, instructions, base)
+    if use_cache:
+        cached = await llm_cache_get("keyword", cache_key)
+        if isinstance(cached, str) and cached:
+            return cached
+
     try:
         if not OPENAI_API_KEY: raise ValueError("OpenAI API Key non trovata.")
         payload = {
-            "model": "gpt-4o-mini",
+            "model": MODEL_JSON,
             "messages": [{"role": "system", "content": instructions}, {"role": "user", "content": base}],
             "response_format": {"type": "json_object"}
         }
-        # Usa il client condiviso
-        resp = await SHARED_HTTP_CLIENT.post(
-            "https://api.openai.com/v1/chat/completions",
+        # Usa il client condiviso, dentro il limiter adattivo
+        resp = await OPENAI_LIMITER.request(
+            SHARED_HTTP_CLIENT, "POST",
+            f"{OPENAI_BASE_URL}/chat/completions",
             json=payload,
             headers={"Authorization": f"Bearer {OPENAI_API_KEY}"}
         )
@@ -595,6 +881,7 @@ async def get_ai_keyword(content: str, client: httpx.AsyncClient, type_tag: str
         obj = json.loads(data["choices"][0]["message"]["content"])
         kw = (obj.get("keyword") or "").strip()
         if not kw or kw.lower() in _BANNED_KW: return _cheap_fallback_keyword_from_text(base)
+        await llm_cache_put("keyword", cache_key, MODEL_JSON, kw)
         return kw
     except Exception as e:
         logging.error(f"Errore in get_ai_keyword (OpenAI): {e}", exc_info=True)
@@ -625,7 +912,8 @@ async def get_pixabay_image_by_query(client: httpx.AsyncClient, query: str) -> s
 
     for attempt in range(1, PIXABAY_MAX_RETRIES + 1):
         try:
-            r = await client.get(
+            r = await PIXABAY_LIMITER.request(
+                client, "GET",
                 "https://pixabay.com/api/",
                 params=params,
                 timeout=PIXABAY_TIMEOUT_SECONDS,
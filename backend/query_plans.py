@@ -0,0 +1,185 @@
+# backend/query_plans.py
+"""
+Suite di regressione dei piani di query per le query calde del feed.
+
+Genera un dataset sintetico (di default 1M email su 50 utenti, con distribuzioni realistiche
+di domini, tipi, topic, tag, preferiti e thread) in un database temporaneo, esegue ANALYZE
+come in produzione (database.update_planner_stats) e verifica con EXPLAIN QUERY PLAN che
+nessuna query faccia una SCAN completa o usi un temp B-tree per ordinare.
+
+Avvio: python -m backend.query_plans                 (1M righe, database temporaneo)
+       python -m backend.query_plans --rows 100000   (più veloce)
+       python -m backend.query_plans --db /tmp/plans.db --keep   (riusa/conserva il dataset)
+
+Esce con codice 1 se un piano regredisce.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+_BAD_PLAN_RE = re.compile(r"USE TEMP B-TREE|^SCAN (?!.*VIRTUAL TABLE)")
+
+_TYPES = ["newsletter", "promo", "informative", "personali"]
+_TOPICS = [f"topic{i}" for i in range(30)]
+_TAGS = [f"tag{i}" for i in range(200)]
+
+
+def _zipf_choice(rng: random.Random, items: list[str], s: float = 1.1) -> str:
+    # Pochi domini/tag molto frequenti, coda lunga di rari
+    idx = int(len(items) * (rng.random() ** (1 + s))) % len(items)
+    return items[idx]
+
+
+def generate(rows: int, users: int, seed: int = 7) -> None:
+    """Riempie `newsletter` (e, tramite trigger, feed_item e contatori) con righe sintetiche."""
+    from backend.database import db, Newsletter
+
+    rng = random.Random(seed)
+    domains = [f"sender{i}.example" for i in range(2000)]
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    span = 3 * 365 * 24 * 3600
+    batch: list[dict] = []
+    t0 = time.perf_counter()
+    for i in range(rows):
+        user = f"user{i % users}"
+        domain = _zipf_choice(rng, domains)
+        thread = f"th{rng.randrange(rows // 5 + 1)}" if rng.random() < 0.2 else None
+        batch.append({
+            "email_id": f"e{i:08d}",
+            "user_id": user,
+            "sender_name": domain.split(".")[0],
+            "sender_email": f"news@{domain}",
+            "original_subject": f"Issue {i}",
+            "ai_title": f"Titolo {i}",
+            "ai_summary_markdown": "Riassunto sintetico della issue. " * 8,
+            "image_url": f"https://img.example/{i}.jpg",
+            "received_date": start + timedelta(seconds=rng.randrange(span)),
+            "is_favorite": rng.random() < 0.02,
+            "enriched": True,
+            "is_complete": rng.random() < 0.9,
+            "is_deleted": rng.random() < 0.02,
+            "tag": _zipf_choice(rng, _TAGS) if rng.random() < 0.3 else None,
+            "type_tag": rng.choice(_TYPES),
+            "topic_tag": _zipf_choice(rng, _TOPICS),
+            "source_domain": domain,
+            "thread_id": thread,
+        })
+        if len(batch) >= 2000:
+            with db.atomic():
+                Newsletter.insert_many(batch).execute()
+            batch.clear()
+            if (i + 1) % 100000 == 0:
+                print(f"  {i + 1} righe ({time.perf_counter() - t0:.0f}s)")
+    if batch:
+        with db.atomic():
+            Newsletter.insert_many(batch).execute()
+
+
+def _plan(sql: str, params) -> list[str]:
+    from backend.database import db
+    return [row[3] for row in db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+
+
+def checks() -> list[tuple[str, tuple]]:
+    """(nome, (sql, params)) delle query da verificare, costruite dallo stesso codice dell'API."""
+    from backend.database import db, Newsletter, FeedFacetCount, FeedChange, PhotoPoolItem
+    from backend.feed_query import build_feed_query
+
+    user = "user1"
+    # Cursore a metà del feed dell'utente, come una pagina profonda
+    mid = db.execute_sql(
+        "SELECT received_date, email_id FROM feed_item WHERE user_id = ? "
+        "ORDER BY received_date DESC, email_id DESC LIMIT 1 OFFSET "
+        "(SELECT COUNT(*) / 2 FROM feed_item WHERE user_id = ?)", [user, user]
+    ).fetchone()
+    before = (datetime.fromisoformat(mid[0]), mid[1]) if mid else (datetime.now(timezone.utc), "e")
+    hidden = ["sender0.example", "sender1.example", "sender7.example"]
+
+    out: list[tuple[str, tuple]] = [
+        ("feed_first_page", build_feed_query(user, 21).sql()),
+        ("feed_cursor", build_feed_query(user, 21, before=before).sql()),
+        ("feed_hidden", build_feed_query(user, 21, hidden_domains=hidden).sql()),
+        ("feed_hidden_cursor", build_feed_query(user, 21, hidden_domains=hidden, before=before).sql()),
+        ("feed_favorites", build_feed_query(user, 21, {"is_favorite": True}).sql()),
+    ]
+    for col, val in (("type_tag", "promo"), ("topic_tag", "topic3"), ("source_domain", "sender42.example"), ("tag", "tag5")):
+        out.append((f"feed_{col}", build_feed_query(user, 21, {col: val}).sql()))
+        out.append((f"feed_{col}_cursor", build_feed_query(user, 21, {col: val}, hidden, before).sql()))
+    out += [
+        ("feed_changes", FeedChange.select().where((FeedChange.user_id == user) & (FeedChange.seq > 1000))
+         .order_by(FeedChange.seq).limit(501).sql()),
+        ("facets", FeedFacetCount.select().where((FeedFacetCount.user_id == user) & (FeedFacetCount.n > 0)).sql()),
+        ("newsletter_by_pk", Newsletter.select().where((Newsletter.email_id == "e00000042") & (Newsletter.user_id == user)).sql()),
+        ("photo_pool_get", PhotoPoolItem.select().where(
+            (PhotoPoolItem.user_id == user) & (PhotoPoolItem.photo_id == "p42")).sql()),
+        ("photo_pool_round_robin", PhotoPoolItem.select().where(PhotoPoolItem.user_id == user)
+         .order_by(PhotoPoolItem.position).offset(40).limit(20).sql()),
+        ("worker_thread_dup", Newsletter.select().where(
+            (Newsletter.user_id == user) & (Newsletter.thread_id == "th1") & (Newsletter.email_id != "e1")).sql()),
+    ]
+    return out
+
+
+def run(db_path: Path, rows: int, users: int, keep: bool) -> int:
+    os.environ["DATA_DIR"] = str(db_path.parent)
+    # I piani attesi sono quelli di SQLite (EXPLAIN QUERY PLAN): la suite ignora DATABASE_URL
+    os.environ.pop("DATABASE_URL", None)
+    from backend import database
+    # Il modulo usa DATA_DIR/newsletter.db: punto esplicitamente al file richiesto
+    database.db.init(str(db_path), pragmas=database.db._pragmas)
+    database.initialize_db()
+
+    have = database.Newsletter.select().count()
+    if have < rows:
+        print(f"Generazione di {rows - have} righe in {db_path} ...")
+        generate(rows - have, users, seed=have)
+        database.db.execute_sql("ANALYZE;")
+    database.update_planner_stats()
+
+    failed = 0
+    for name, (sql, params) in checks():
+        plan = _plan(sql, params)
+        t0 = time.perf_counter()
+        database.db.execute_sql(sql, params).fetchall()
+        ms = (time.perf_counter() - t0) * 1000
+        bad = [p for p in plan if _BAD_PLAN_RE.search(p)]
+        failed += bool(bad)
+        print(f"{'FAIL' if bad else 'ok  '} {name:28s} {ms:7.2f} ms  | " + " ; ".join(plan))
+    print(f"\n{failed} regressioni su {len(checks())} query")
+    if not keep:
+        database.db.close()
+    return 1 if failed else 0
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Verifica dei piani di query del feed su dati sintetici")
+    ap.add_argument("--rows", type=int, default=1_000_000)
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--db", type=Path, default=None, help="file SQLite da usare (default: temporaneo)")
+    ap.add_argument("--keep", action="store_true", help="non cancellare il database temporaneo")
+    args = ap.parse_args()
+
+    if args.db:
+        sys.exit(run(args.db, args.rows, args.users, True))
+    tmp = tempfile.mkdtemp(prefix="query_plans_")
+    db_path = Path(tmp) / "plans.db"
+    try:
+        code = run(db_path, args.rows, args.users, args.keep)
+    finally:
+        if not args.keep:
+            for f in Path(tmp).glob("plans.db*"):
+                f.unlink()
+            os.rmdir(tmp)
+        else:
+            print(f"Database conservato in {db_path}")
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# backend/search.py
+"""
+Ricerca full-text nel feed tramite la tabella FTS5 `newsletter_fts` (vedi database.py).
+
+- ranking BM25 con pesi per colonna (titolo AI > oggetto > riassunto > mittente > corpo);
+- prefissi: `term*` esplicito, e l'ultima parola digitata è sempre trattata come prefisso
+  (ricerca "mentre scrivi");
+- frasi tra virgolette, parole escluse con `-parola`;
+- snippet con evidenziazione, già escapati per l'HTML (solo i tag <mark> sono markup);
+- paginazione a cursore su (punteggio, rowid): 'punteggio|rowid'.
+"""
+import html
+import re
+from typing import Any
+
+from peewee import OperationalError
+
+from backend.database import db, IS_POSTGRES
+
+# user_id, ai_title, ai_summary, subject, sender, body
+_BM25_WEIGHTS = "0.0, 10.0, 4.0, 6.0, 3.0, 1.0"
+_SNIPPET_TOKENS = 14
+_HL_OPEN, _HL_CLOSE = "\x02", "\x03"
+
+_QUERY_TOKEN_RE = re.compile(r'(-?)"([^"]+)"|(-?)([^\s"]+)')
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+class SearchQueryError(ValueError):
+    """Query vuota o senza termini ricercabili."""
+
+
+def _quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def build_match_query(q: str) -> str:
+    """
+    Converte l'input libero dell'utente in una espressione MATCH FTS5 sicura
+    (nessuna sintassi FTS5 dell'utente arriva al motore: ogni termine è quotato).
+    """
+    positive: list[str] = []
+    negative: list[str] = []
+    matches = list(_QUERY_TOKEN_RE.finditer(q or ""))
+    for i, m in enumerate(matches):
+        is_last = i == len(matches) - 1
+        if m.group(2) is not None:
+            words = _WORD_RE.findall(m.group(2))
+            if not words:
+                continue
+            expr = _quote(" ".join(words))
+            (negative if m.group(1) else positive).append(expr)
+            continue
+        raw = m.group(4)
+        prefix = raw.endswith("*") or (is_last and not m.group(3) and not (q or "").endswith(" "))
+        words = _WORD_RE.findall(raw)
+        if not words:
+            continue
+        # "e-mail" / "c'è": più parole consecutive diventano una frase
+        expr = _quote(" ".join(words))
+        if prefix and len(words[-1]) >= 2:
+            expr += "*"
+        (negative if m.group(3) else positive).append(expr)
+
+    if not positive:
+        raise SearchQueryError("La ricerca non contiene termini validi")
+    expr = " AND ".join(positive)
+    if negative:
+        expr += " NOT " + " NOT ".join(negative)
+    return expr
+
+
+def parse_cursor(cur: str | None) -> tuple[float, int] | None:
+    if not cur:
+        return None
+    try:
+        score, rowid = cur.split("|", 1)
+        return float(score), int(rowid)
+    except ValueError:
+        return None
+
+
+def _highlight(text: str | None) -> str:
+    esc = html.escape(text or "", quote=False)
+    return esc.replace(_HL_OPEN, "<mark>").replace(_HL_CLOSE, "</mark>")
+
+
+def search_feed(
+    user_id: str,
+    q: str,
+    page_size: int = 20,
+    cursor: str | None = None,
+    hidden_domains: list[str] | None = None,
+) -> dict[str, Any]:
+    """
+    Cerca tra le email complete e non eliminate dell'utente.
+    Restituisce {"items": [...], "next_cursor": str|None, "has_more": bool};
+    ogni item ha i campi del feed più "score", "title_highlight" e "snippet".
+    """
+    if IS_POSTGRES:
+        # L'indice FTS5 esiste solo su SQLite: l'endpoint risponde 503 come senza FTS5
+        raise OperationalError("ricerca full-text non disponibile su PostgreSQL")
+    match = f"user_id:{_quote(user_id)} AND ({build_match_query(q)})"
+    params: list[Any] = [match, user_id]
+    where_extra = ""
+    if hidden_domains:
+        where_extra += f" AND coalesce(n.source_domain, '') NOT IN ({', '.join('?' for _ in hidden_domains)})"
+        params.extend(hidden_domains)
+    cur = parse_cursor(cursor)
+    if cur:
+        where_extra += " AND (s.score > ? OR (s.score = ? AND s.rowid > ?))"
+        params.extend([cur[0], cur[0], cur[1]])
+    params.append(page_size + 1)
+
+    # 1) Solo punteggi e rowid: gli snippet si calcolano dopo, per la sola pagina
+    ranked = db.execute_sql(f"""
+        SELECT s.rowid, s.score FROM (
+            SELECT rowid, bm25(newsletter_fts, {_BM25_WEIGHTS}) AS score
+            FROM newsletter_fts WHERE newsletter_fts MATCH ?
+        ) AS s
+        JOIN newsletter n ON n.rowid = s.rowid
+        WHERE n.user_id = ? AND n.is_complete = 1 AND n.is_deleted = 0{where_extra}
+        ORDER BY s.score, s.rowid
+        LIMIT ?
+    """, params).fetchall()
+
+    has_more = len(ranked) > page_size
+    ranked = ranked[:page_size]
+    if not ranked:
+        return {"items": [], "next_cursor": None, "has_more": False}
+
+    rowids = [r[0] for r in ranked]
+    marks = ", ".join("?" for _ in rowids)
+    rows = db.execute_sql(f"""
+        SELECT f.rowid,
+               highlight(newsletter_fts, 1, ?, ?),
+               snippet(newsletter_fts, 5, ?, ?, '…', {_SNIPPET_TOKENS}),
+               snippet(newsletter_fts, 2, ?, ?, '…', {_SNIPPET_TOKENS}),
+               n.email_id, n.user_id, n.sender_name, n.sender_email, n.original_subject,
+               n.ai_title, n.ai_summary_markdown, n.image_url, n.received_date, n.is_favorite,
+               n.accent_hex, n.tag, n.type_tag, n.topic_tag, n.source_domain, n.thread_id,
+               n.rfc822_message_id, n.is_complete
+        FROM newsletter_fts f
+        JOIN newsletter n ON n.rowid = f.rowid
+        WHERE newsletter_fts MATCH ? AND f.rowid IN ({marks}) AND n.user_id = ?
+    """, [_HL_OPEN, _HL_CLOSE] * 3 + [match, *rowids, user_id]).fetchall()
+
+    keys = (
+        "email_id", "user_id", "sender_name", "sender_email", "original_subject",
+        "ai_title", "ai_summary_markdown", "image_url", "received_date", "is_favorite",
+        "accent_hex", "tag", "type_tag", "topic_tag", "source_domain", "thread_id",
+        "rfc822_message_id", "is_complete",
+    )
+    by_rowid: dict[int, dict[str, Any]] = {}
+    for r in rows:
+        item = dict(zip(keys, r[4:]))
+        item["is_favorite"] = bool(item["is_favorite"])
+        item["is_complete"] = bool(item["is_complete"])
+        item["title_highlight"] = _highlight(r[1])
+        # Snippet dal corpo; se i termini compaiono solo nel riassunto, da lì
+        item["snippet"] = _highlight(r[2] if _HL_OPEN in (r[2] or "") or _HL_OPEN not in (r[3] or "") else r[3])
+        by_rowid[r[0]] = item
+
+    items = []
+    for rowid, score in ranked:
+        item = by_rowid.get(rowid)
+        if item:
+            item["score"] = round(-score, 4)  # bm25() è negativo: più basso = più rilevante
+            items.append(item)
+
+    last_rowid, last_score = ranked[-1]
+    return {
+        "items": items,
+        "next_cursor": f"{last_score!r}|{last_rowid}" if has_more else None,
+        "has_more": has_more,
+    }
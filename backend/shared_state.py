@@ -0,0 +1,332 @@
+# backend/shared_state.py
+"""
+Stato condiviso tra i processi dell'API (uvicorn --workers N).
+
+Le mappe che prima erano dict del processo (impostazioni, credenziali, sessioni, PKCE in
+attesa, token di Google Photos) sono SharedMap: stessa interfaccia di un dict,
+valori JSON in Redis sotto `state:<nome>:<chiave>` (TTL opzionale per mappa) e una cache
+locale in lettura di SHARED_STATE_LOCAL_TTL secondi, così le letture ripetute nella stessa
+richiesta o in richieste vicine non vanno in Redis. Una scrittura vale subito nel processo
+che la fa e al più dopo SHARED_STATE_LOCAL_TTL negli altri (local_ttl=0 per i dati che non
+ammettono ritardo, es. il PKCE del login che torna su un worker diverso).
+Nota: un valore letto e modificato sul posto va riassegnato (m[k] = v) per essere condiviso.
+
+Le cache di byte delle immagini (proxy e Google Photos) sono SharedBlobCache: LRU locale
+come prima più un secondo livello in Redis (client binario) per le immagini fino a
+SHARED_BLOB_MAX_BYTES, così un'immagine scaricata da un worker serve anche agli altri.
+
+Senza Redis tutto resta locale al processo: va bene con un solo worker, con più worker
+sessioni, login e foto si romperebbero (l'API lo segnala all'avvio).
+
+Modalità multi-worker:
+  - REDIS_URL raggiungibile e SESSION_SECRET uguale per tutti i worker (cookie di sessione);
+  - WEB_CONCURRENCY=N (letto da uvicorn come --workers) nel servizio app;
+  - le migrazioni di initialize_db() all'avvio sono serializzate da process_lock().
+Verifica: python -m backend.shared_state [--procs 4] (scrive da un processo e rilegge dagli altri).
+"""
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+try:
+    import fcntl  # type: ignore
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+SHARED_STATE_LOCAL_TTL = float(os.getenv("SHARED_STATE_LOCAL_TTL", "2"))
+SHARED_BLOB_MAX_BYTES = int(os.getenv("SHARED_BLOB_MAX_BYTES", str(512 * 1024)))
+STATE_PREFIX = "state:"
+
+_REDIS: Any = None      # client testuale (decode_responses=True)
+_REDIS_BIN: Any = None  # client binario per le cache di immagini
+
+
+def bind_redis(client: Any, binary_client: Any = None) -> None:
+    """Collega i client Redis (sync) usati da tutte le mappe e cache del processo."""
+    global _REDIS, _REDIS_BIN
+    _REDIS = client
+    _REDIS_BIN = binary_client
+
+
+def is_shared() -> bool:
+    return _REDIS is not None
+
+
+def worker_count() -> int:
+    """Numero di worker uvicorn configurati (WEB_CONCURRENCY, come fa uvicorn)."""
+    try:
+        return max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    except ValueError:
+        return 1
+
+
+class SharedMap(MutableMapping):
+    """Mappa chiave -> valore JSON in Redis con cache locale in lettura."""
+
+    def __init__(self, name: str, ttl: int | None = None, local_ttl: float = SHARED_STATE_LOCAL_TTL,
+                 prefix: str | None = None) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.prefix = prefix if prefix is not None else f"{STATE_PREFIX}{name}:"
+        # chiave -> (scadenza monotonic, valore); senza Redis è l'archivio vero e proprio
+        self._local: dict[str, tuple[float, Any]] = {}
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def _local_get(self, key: str, horizon: float) -> tuple[bool, Any]:
+        ent = self._local.get(key)
+        if ent is None:
+            return False, None
+        if ent[0] < time.monotonic() or horizon <= 0:
+            self._local.pop(key, None)
+            return False, None
+        return True, ent[1]
+
+    def _remember(self, key: str, value: Any, horizon: float) -> None:
+        if horizon > 0:
+            self._local[key] = (time.monotonic() + horizon, value)
+
+    def _standalone_horizon(self) -> float:
+        return float(self.ttl) if self.ttl else float("inf")
+
+    # --- interfaccia dict ---
+
+    def __getitem__(self, key: str) -> Any:
+        if _REDIS is None:
+            found, value = self._local_get(key, self._standalone_horizon())
+            if not found:
+                raise KeyError(key)
+            return value
+        found, value = self._local_get(key, self.local_ttl)
+        if found:
+            return value
+        try:
+            raw = _REDIS.get(self._key(key))
+        except Exception as e:
+            logging.warning(f"[STATE] lettura {self.name}:{key} fallita: {e}")
+            raise KeyError(key) from e
+        if raw is None:
+            raise KeyError(key)
+        value = json.loads(raw)
+        self._remember(key, value, self.local_ttl)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if _REDIS is not None:
+            try:
+                _REDIS.set(self._key(key), json.dumps(value, ensure_ascii=False, default=str), ex=self.ttl)
+            except Exception as e:
+                logging.warning(f"[STATE] scrittura {self.name}:{key} fallita: {e}")
+            self._remember(key, value, self.local_ttl)
+        else:
+            self._remember(key, value, self._standalone_horizon())
+
+    def __delitem__(self, key: str) -> None:
+        existed = self._local.pop(key, None) is not None
+        if _REDIS is not None:
+            try:
+                existed = bool(_REDIS.delete(self._key(key))) or existed
+            except Exception as e:
+                logging.warning(f"[STATE] cancellazione {self.name}:{key} fallita: {e}")
+        if not existed:
+            raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, str):
+            return False
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self) -> Iterator[str]:
+        if _REDIS is None:
+            now = time.monotonic()
+            return iter([k for k, (exp, _v) in list(self._local.items()) if exp >= now])
+        try:
+            n = len(self.prefix)
+            return iter([k[n:] for k in _REDIS.scan_iter(match=self.prefix + "*", count=500)])
+        except Exception as e:
+            logging.warning(f"[STATE] scansione {self.name} fallita: {e}")
+            return iter([])
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def snapshot(self) -> dict[str, Any]:
+        """Copia completa della mappa (SCAN + MGET), per la persistenza su file."""
+        keys = list(self)
+        if _REDIS is None or not keys:
+            return {k: self[k] for k in keys if k in self}
+        out: dict[str, Any] = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            try:
+                raws = _REDIS.mget([self._key(k) for k in chunk])
+            except Exception as e:
+                logging.warning(f"[STATE] lettura completa di {self.name} fallita: {e}")
+                return {}
+            for k, raw in zip(chunk, raws):
+                if raw is not None:
+                    out[k] = json.loads(raw)
+        return out
+
+    def seed(self, data: dict[str, Any]) -> int:
+        """Carica i valori iniziali (es. dal file) senza sovrascrivere quelli già in Redis."""
+        if _REDIS is None:
+            for k, v in data.items():
+                self[k] = v
+            return len(data)
+        added = 0
+        try:
+            pipe = _REDIS.pipeline()
+            for k, v in data.items():
+                pipe.set(self._key(k), json.dumps(v, ensure_ascii=False, default=str), nx=True, ex=self.ttl)
+            added = sum(1 for ok in pipe.execute() if ok)
+        except Exception as e:
+            logging.warning(f"[STATE] seed di {self.name} fallito: {e}")
+        return added
+
+    def clear_local(self) -> None:
+        self._local.clear()
+
+
+class SharedBlobCache:
+    """
+    Cache LRU di immagini {"ts", "bytes", "ct", "etag"?}: livello locale del processo e,
+    con Redis, un secondo livello condiviso per le voci fino a SHARED_BLOB_MAX_BYTES.
+    """
+
+    def __init__(self, name: str, max_items: int, ttl: int) -> None:
+        self.name = name
+        self.max_items = max_items
+        self.ttl = ttl
+        self._lru: "OrderedDict[str, dict]" = OrderedDict()
+
+    def _key(self, key: str) -> str:
+        return f"{STATE_PREFIX}{self.name}:{key}"
+
+    def get(self, key: str) -> dict | None:
+        ent = self._lru.get(key)
+        if ent is not None:
+            if (time.time() - ent["ts"]) > self.ttl:
+                self._lru.pop(key, None)
+            else:
+                self._lru.move_to_end(key, last=True)
+                return ent
+        if _REDIS_BIN is None:
+            return None
+        try:
+            raw = _REDIS_BIN.get(self._key(key))
+        except Exception as e:
+            logging.debug(f"[STATE] lettura {self.name} fallita: {e}")
+            return None
+        if not raw:
+            return None
+        head, _, body = raw.partition(b"\n")
+        try:
+            ent = json.loads(head)
+        except ValueError:
+            return None
+        ent["bytes"] = body
+        self._put_local(key, ent)
+        return ent
+
+    def put(self, key: str, ent: dict) -> None:
+        self._put_local(key, ent)
+        body = ent.get("bytes") or b""
+        if _REDIS_BIN is None or len(body) > SHARED_BLOB_MAX_BYTES:
+            return
+        head = json.dumps({k: v for k, v in ent.items() if k != "bytes"}).encode("utf-8")
+        remaining = int(self.ttl - (time.time() - ent.get("ts", time.time())))
+        if remaining <= 0:
+            return
+        try:
+            _REDIS_BIN.set(self._key(key), head + b"\n" + body, ex=remaining)
+        except Exception as e:
+            logging.debug(f"[STATE] scrittura {self.name} fallita: {e}")
+
+    def _put_local(self, key: str, ent: dict) -> None:
+        self._lru[key] = ent
+        self._lru.move_to_end(key, last=True)
+        while len(self._lru) > self.max_items:
+            self._lru.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+
+@contextmanager
+def process_lock(path: str):
+    """Lock esclusivo tra processi dello stesso host (flock su file); no-op dove non c'è fcntl."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a+") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# ---------------------------------------------------------------------------
+# Verifica della modalità multi-worker: N processi leggono ciò che ha scritto il primo
+# ---------------------------------------------------------------------------
+
+def _check_child(url: str, name: str, expected: dict, local_ttl: float) -> bool:
+    import redis
+
+    bind_redis(redis.from_url(url, decode_responses=True), redis.from_url(url))
+    m = SharedMap(name, ttl=60, local_ttl=local_ttl)
+    blobs = SharedBlobCache(name + "-blob", max_items=4, ttl=60)
+    ent = blobs.get("img")
+    return m.get("k") == expected and m.snapshot() == {"k": expected} and bool(ent) and ent["bytes"] == b"\x00\xffimg"
+
+
+def _check(procs: int) -> int:
+    import multiprocessing
+    import uuid
+
+    import redis
+
+    url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    try:
+        text, binary = redis.from_url(url, decode_responses=True), redis.from_url(url)
+        text.ping()
+    except Exception as e:
+        print(f"Redis non raggiungibile su {url}: {e}")
+        return 1
+    bind_redis(text, binary)
+    name = f"check-{uuid.uuid4().hex[:8]}"
+    value = {"settings": {"hidden_domains": ["a.example"]}, "n": 1}
+    m = SharedMap(name, ttl=60)
+    m["k"] = value
+    SharedBlobCache(name + "-blob", max_items=4, ttl=60).put("img", {"ts": time.time(), "bytes": b"\x00\xffimg", "ct": "image/png"})
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(procs) as pool:
+        results = pool.starmap(_check_child, [(url, name, value, SHARED_STATE_LOCAL_TTL)] * procs)
+    for k in list(m):
+        del m[k]
+    binary.delete(f"{STATE_PREFIX}{name}-blob:img")
+    ok = all(results)
+    print(f"{sum(results)}/{procs} processi vedono lo stato scritto dal primo: {'OK' if ok else 'ERRORE'}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    ap = argparse.ArgumentParser(description="Verifica dello stato condiviso tra processi (richiede Redis)")
+    ap.add_argument("--procs", type=int, default=4)
+    sys.exit(_check(ap.parse_args().procs))
@@ -0,0 +1,255 @@
+# backend/sse_connections.py
+"""
+Gestione delle connessioni SSE locali del processo (stream dei job e del feed).
+
+- Limiti: al più SSE_MAX_PER_USER connessioni per utente (una nuova oltre il limite chiude
+  la più vecchia dello stesso utente, tipicamente una scheda già chiusa non ancora rilevata)
+  e SSE_MAX_CONNECTIONS in tutto il processo (oltre, ConnectionLimitError -> 429).
+- Buffer limitato per connessione (SSE_CONN_BUFFER eventi) con coalescenza: un evento
+  "progress"/"ingest" rimpiazza quello dello stesso tipo ancora in coda, una card rimpiazza
+  la versione precedente della stessa card. Se il buffer si riempie comunque la connessione
+  viene chiusa e il client riprende da Last-Event-ID.
+- Heartbeat su un'unica ruota temporale (SSE_WHEEL_SLOTS scomparti, un giro ogni SSE_PING_S):
+  a ogni scatto il task controlla solo le connessioni di uno scomparto e manda il ping a
+  quelle ferme da almeno SSE_PING_S. Nessun timeout per connessione.
+- Metriche: gauge sse.connections.open, contatori sse.events.coalesced/dropped e
+  sse.connections.rejected/evicted/overflow.
+
+Le connessioni sono servite da un solo event loop; deliver() può essere chiamato anche da
+un thread (publish senza Redis da asyncio.to_thread) e passa dal loop.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Hashable
+
+from backend import metrics
+
+SSE_MAX_PER_USER = int(os.getenv("SSE_MAX_PER_USER", "8"))
+SSE_MAX_CONNECTIONS = int(os.getenv("SSE_MAX_CONNECTIONS", "2000"))
+SSE_CONN_BUFFER = int(os.getenv("SSE_CONN_BUFFER", "256"))
+SSE_PING_S = float(os.getenv("SSE_PING_S", "15"))
+SSE_WHEEL_SLOTS = int(os.getenv("SSE_WHEEL_SLOTS", "16"))
+
+COALESCE_EVENTS = ("progress", "ingest")
+
+Event = tuple[str | None, str, dict]  # (id, evento, dati)
+PING = object()  # restituito da Connection.get() quando è ora del keep-alive
+
+_seq = itertools.count(1)
+
+
+class ConnectionLimitError(Exception):
+    """Troppe connessioni SSE aperte nel processo."""
+
+
+def _coalesce_key(event: str, data: dict) -> Hashable:
+    if event in COALESCE_EVENTS:
+        return event
+    if event == "card" and data.get("op") == "upsert" and isinstance(data.get("card"), dict):
+        return ("card", data["card"].get("email_id"))
+    return next(_seq)  # evento da consegnare sempre
+
+
+class Connection:
+    """Una connessione SSE: buffer limitato con coalescenza e segnale di risveglio."""
+
+    def __init__(self, topic: str, user_key: str) -> None:
+        self.id = next(_seq)
+        self.topic = topic
+        self.user_key = user_key
+        self.opened_at = time.monotonic()
+        self.last_write = self.opened_at
+        self.closed = False
+        self._buf: "OrderedDict[Hashable, Event]" = OrderedDict()
+        self._ping = False
+        self._wake = asyncio.Event()
+
+    def push(self, event_id: str | None, event: str, data: dict) -> bool:
+        """Accoda un evento; False se la connessione è chiusa o il buffer è pieno."""
+        if self.closed:
+            return False
+        key = _coalesce_key(event, data)
+        if key in self._buf:
+            # Lo stato più recente rimpiazza il precedente e prende il suo posto in coda
+            # (in fondo), così gli id consegnati restano crescenti
+            del self._buf[key]
+            metrics.incr("sse.events.coalesced")
+        elif len(self._buf) >= SSE_CONN_BUFFER:
+            return False
+        self._buf[key] = (event_id, event, data)
+        self._wake.set()
+        return True
+
+    def ping(self) -> None:
+        self._ping = True
+        self._wake.set()
+
+    def close(self) -> None:
+        self.closed = True
+        self._wake.set()
+
+    async def get(self) -> Event | object | None:
+        """Prossimo evento, PING per il keep-alive, None quando la connessione è stata chiusa."""
+        while True:
+            if self._buf:
+                _key, item = self._buf.popitem(last=False)
+                self.last_write = time.monotonic()
+                return item
+            if self.closed:
+                return None
+            if self._ping:
+                self._ping = False
+                self.last_write = time.monotonic()
+                return PING
+            self._wake.clear()
+            await self._wake.wait()
+
+
+class ConnectionManager:
+    """Registro delle connessioni SSE del processo, per topic e per utente."""
+
+    def __init__(self) -> None:
+        self._by_topic: dict[str, set[Connection]] = defaultdict(set)
+        self._by_user: dict[str, "OrderedDict[int, Connection]"] = defaultdict(OrderedDict)
+        self._wheel: list[set[Connection]] = [set() for _ in range(max(1, SSE_WHEEL_SLOTS))]
+        self._slot_of: dict[int, int] = {}
+        self._cursor = 0
+        self._count = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._timer: asyncio.Task | None = None
+
+    # --- apertura/chiusura ---
+
+    def open(self, topic: str, user_key: str) -> Connection:
+        """Registra una connessione. Solleva ConnectionLimitError oltre il limite del processo."""
+        self._ensure_timer()
+        user_conns = self._by_user[user_key]
+        while len(user_conns) >= SSE_MAX_PER_USER:
+            _cid, oldest = next(iter(user_conns.items()))
+            logging.info(f"[SSE] limite per utente ({SSE_MAX_PER_USER}) raggiunto da {user_key}: chiudo la connessione più vecchia ({oldest.topic})")
+            metrics.incr("sse.connections.evicted")
+            self.close(oldest)
+        if self._count >= SSE_MAX_CONNECTIONS:
+            metrics.incr("sse.connections.rejected")
+            if not user_conns:
+                self._by_user.pop(user_key, None)
+            raise ConnectionLimitError(f"{self._count} connessioni SSE aperte (max {SSE_MAX_CONNECTIONS})")
+
+        conn = Connection(topic, user_key)
+        self._by_topic[topic].add(conn)
+        user_conns[conn.id] = conn
+        # Lo scomparto appena passato: il primo controllo arriva dopo un giro completo
+        slot = (self._cursor - 1) % len(self._wheel)
+        self._wheel[slot].add(conn)
+        self._slot_of[conn.id] = slot
+        self._count += 1
+        metrics.set_gauge("sse.connections.open", self._count)
+        return conn
+
+    def close(self, conn: Connection) -> None:
+        """Chiude e deregistra la connessione (idempotente)."""
+        conn.close()
+        slot = self._slot_of.pop(conn.id, None)
+        if slot is None:
+            return
+        self._wheel[slot].discard(conn)
+        topic_conns = self._by_topic.get(conn.topic)
+        if topic_conns is not None:
+            topic_conns.discard(conn)
+            if not topic_conns:
+                self._by_topic.pop(conn.topic, None)
+        user_conns = self._by_user.get(conn.user_key)
+        if user_conns is not None:
+            user_conns.pop(conn.id, None)
+            if not user_conns:
+                self._by_user.pop(conn.user_key, None)
+        self._count -= 1
+        metrics.set_gauge("sse.connections.open", self._count)
+
+    # --- consegna ---
+
+    def deliver(self, topic: str, event: str, event_id: str | None, data: dict) -> None:
+        """Consegna un evento alle connessioni locali del topic."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self._loop is not None and running is not self._loop:
+            if not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self.deliver, topic, event, event_id, data)
+            return
+        for conn in list(self._by_topic.get(topic, ())):
+            if not conn.push(event_id, event, data) and not conn.closed:
+                # Client troppo lento: chiudiamo, riprenderà da Last-Event-ID
+                logging.info(f"[SSE] buffer pieno ({SSE_CONN_BUFFER}) per {topic}: chiudo la connessione")
+                metrics.incr("sse.connections.overflow")
+                metrics.incr("sse.events.dropped", len(conn._buf) + 1)
+                conn._buf.clear()
+                self.close(conn)
+
+    def topics(self) -> list[str]:
+        return list(self._by_topic)
+
+    def listeners(self, topic: str) -> int:
+        return len(self._by_topic.get(topic, ()))
+
+    def count(self) -> int:
+        return self._count
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "open": self._count,
+            "topics": len(self._by_topic),
+            "users": len(self._by_user),
+            "max_per_user": SSE_MAX_PER_USER,
+            "max_connections": SSE_MAX_CONNECTIONS,
+        }
+
+    # --- heartbeat ---
+
+    def _ensure_timer(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._timer is not None and not self._timer.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._timer = loop.create_task(self._run_wheel(), name="sse-heartbeat")
+
+    async def _run_wheel(self) -> None:
+        tick = SSE_PING_S / len(self._wheel)
+        while True:
+            await asyncio.sleep(tick)
+            try:
+                self._tick()
+            except Exception as e:  # il timer non deve morire per una connessione
+                logging.warning(f"[SSE] errore nel giro di heartbeat: {e}")
+
+    def _tick(self) -> None:
+        """Ping alle connessioni dello scomparto corrente ferme da almeno SSE_PING_S."""
+        slot = self._wheel[self._cursor]
+        self._cursor = (self._cursor + 1) % len(self._wheel)
+        if not slot:
+            return
+        # Tolleranza di uno scatto: una connessione attiva poco dopo il suo turno non aspetta un giro in più
+        idle_since = time.monotonic() - SSE_PING_S + SSE_PING_S / len(self._wheel)
+        for conn in slot:
+            if conn.last_write <= idle_since:
+                conn.ping()
+
+    async def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            try:
+                await self._timer
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._timer = None
+        for conns in list(self._by_topic.values()):
+            for conn in list(conns):
+                self.close(conn)
+
+
+manager = ConnectionManager()
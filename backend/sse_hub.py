@@ -0,0 +1,189 @@
+# backend/sse_hub.py
+"""
+Fan-out degli eventi SSE tramite Redis pub/sub.
+
+Gli eventi hanno un "topic": il job_id per lo stream di un job di ingest, "user:<user_id>"
+per lo stream del feed dell'utente (vedi feed_push). Chi produce eventi (worker, batch,
+endpoint dell'API) chiama publish(): l'evento viene aggiunto allo stream Redis
+`sse:log:<topic>` (che ne assegna l'id e serve per riprendere dopo una riconnessione)
+e pubblicato su `sse:<evento>:<topic>`.
+
+Ogni processo dell'API ha un solo SSEHub: un task con una sottoscrizione PSUBSCRIBE
+condivisa che consegna i messaggi alle connessioni SSE locali di quel topic, gestite da
+sse_connections (limiti, buffer con coalescenza, heartbeat). Le connessioni aspettano sul
+proprio buffer (nessun polling). Con Last-Event-ID il client riceve dallo stream gli eventi
+persi. Senza Redis gli eventi restano nel processo che li pubblica.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Any
+
+from backend.sse_connections import Connection, manager as connections
+
+SSE_EVENTS = ("update", "progress", "card", "ingest", "item")
+SSE_LOG_PREFIX = "sse:log:"
+SSE_REPLAY_MAX = int(os.getenv("SSE_REPLAY_MAX", "1000"))        # eventi conservati per topic
+SSE_REPLAY_TTL = int(os.getenv("SSE_REPLAY_TTL", str(6 * 3600)))
+
+Event = tuple[str | None, str, dict]  # (id, evento, dati)
+
+
+def _channel(event: str, topic: str) -> str:
+    return f"sse:{event}:{topic}"
+
+
+def publish(r: Any, topic: str, event: str, data: dict) -> str | None:
+    """
+    Registra e pubblica un evento del topic (Redis sincrono, decode_responses=True).
+    Restituisce l'id dell'evento, o None se Redis non è disponibile.
+    """
+    if r is None:
+        hub.dispatch(topic, event, None, data)
+        return None
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    log_key = SSE_LOG_PREFIX + topic
+    event_id = r.xadd(log_key, {"event": event, "data": payload}, maxlen=SSE_REPLAY_MAX, approximate=True)
+    pipe = r.pipeline()
+    pipe.expire(log_key, SSE_REPLAY_TTL)
+    pipe.publish(_channel(event, topic), json.dumps({"id": event_id, "data": data}, ensure_ascii=False, default=str))
+    pipe.execute()
+    return event_id
+
+
+class SSEHub:
+    """Sottoscrizione Redis condivisa dal processo, che consegna alle connessioni SSE locali."""
+
+    def __init__(self) -> None:
+        self._last_id: dict[str, str] = {}
+        self._task: asyncio.Task | None = None
+        self._url: str | None = None
+        self._replay_client: Any = None
+
+    # --- ciclo di vita ---
+
+    def start(self, redis_url: str | None) -> None:
+        """Avvia il task di sottoscrizione (dal lifespan dell'app). Senza URL resta solo locale."""
+        if not redis_url or self._task:
+            return
+        self._url = redis_url
+        self._task = asyncio.create_task(self._run(), name="sse-hub")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        if self._replay_client is not None:
+            try:
+                await self._replay_client.aclose()
+            except Exception:
+                pass
+            self._replay_client = None
+        await connections.stop()
+
+    async def _run(self) -> None:
+        from redis import asyncio as aioredis
+
+        backoff = 1.0
+        first = True
+        while True:
+            client = aioredis.from_url(self._url, decode_responses=True)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(*(_channel(ev, "*") for ev in SSE_EVENTS))
+                logging.info("[SSE hub] sottoscrizione Redis attiva")
+                if not first:
+                    await self._catch_up()
+                first = False
+                backoff = 1.0
+                async for msg in pubsub.listen():
+                    if msg.get("type") == "pmessage":
+                        self._on_message(msg.get("channel") or "", msg.get("data"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"[SSE hub] sottoscrizione interrotta: {e}; riprovo tra {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                try:
+                    await pubsub.aclose()
+                    await client.aclose()
+                except Exception:
+                    pass
+
+    async def _catch_up(self) -> None:
+        """Dopo una riconnessione consegna ai topic con connessioni locali gli eventi persi."""
+        for topic in connections.topics():
+            last = self._last_id.get(topic)
+            if not last:
+                continue
+            for event_id, event, data in await self.replay(topic, last):
+                self.dispatch(topic, event, event_id, data)
+
+    def _on_message(self, channel: str, raw: Any) -> None:
+        try:
+            _, event, topic = channel.split(":", 2)
+            msg = json.loads(raw) if raw else {}
+        except ValueError:
+            return
+        # Formato di publish(); i messaggi "nudi" (vecchi worker) sono trattati come dati
+        if isinstance(msg, dict) and "data" in msg and "id" in msg:
+            self.dispatch(topic, event, msg["id"], msg["data"] or {})
+        else:
+            self.dispatch(topic, event, None, msg if isinstance(msg, dict) else {})
+
+    # --- consegna locale ---
+
+    def dispatch(self, topic: str, event: str, event_id: str | None, data: dict) -> None:
+        if event_id and connections.listeners(topic):
+            self._last_id[topic] = event_id  # per il recupero dopo una riconnessione a Redis
+        connections.deliver(topic, event, event_id, data)
+
+    def subscribe(self, topic: str, user_key: str) -> Connection:
+        """Apre una connessione locale sul topic (ConnectionLimitError oltre i limiti)."""
+        return connections.open(topic, user_key)
+
+    def unsubscribe(self, conn: Connection) -> None:
+        connections.close(conn)
+        if not connections.listeners(conn.topic):
+            self._last_id.pop(conn.topic, None)
+
+    def listeners(self, topic: str) -> int:
+        return connections.listeners(topic)
+
+    async def replay(self, topic: str, last_event_id: str) -> list[Event]:
+        """Eventi dello stream successivi a last_event_id (vuoto senza Redis o id non valido)."""
+        if not self._url:
+            return []
+        if self._replay_client is None:
+            from redis import asyncio as aioredis
+            self._replay_client = aioredis.from_url(self._url, decode_responses=True)
+        try:
+            entries = await self._replay_client.xrange(SSE_LOG_PREFIX + topic, min=last_event_id, count=SSE_REPLAY_MAX)
+        except Exception as e:
+            logging.warning(f"[SSE hub] replay fallito per {topic} da {last_event_id}: {e}")
+            return []
+        out: list[Event] = []
+        for event_id, fields in entries:
+            if event_id == last_event_id:
+                continue
+            try:
+                out.append((event_id, fields.get("event", "update"), json.loads(fields.get("data") or "{}")))
+            except ValueError:
+                continue
+        return out
+
+
+def format_event(event_id: str | None, event: str, data: dict) -> str:
+    """Frame SSE (con `id:` se disponibile, così il browser rimanda Last-Event-ID)."""
+    head = f"id: {event_id}\n" if event_id else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+hub = SSEHub()
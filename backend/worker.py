@@ -30,18 +30,25 @@ from botocore.config import Config as BotoConfig
 import shutil
 import uuid
 
-from backend.database import db, Newsletter, initialize_db, DomainTypeOverride
+from backend.database import db, Newsletter, initialize_db
+from backend import metrics, domain_profiles, near_dup
+from backend.batch_enrich import enqueue_for_batch
+from backend.feed_cache import bump_feed_version
+from backend.fastjson import dumps_str
+from backend import sse_hub, ingest_jobs, feed_push
+from backend.db_writes import WriteBehind
 from backend.processing_utils import (
             extract_html_from_payload, parse_sender, clean_html,
             get_ai_summary, get_ai_keyword, get_pixabay_image_by_query, extract_dominant_hex, classify_type_and_topic,
-            root_domain_py, extract_domain_from_from_header,
-            SHARED_HTTP_CLIENT
+            root_domain_py, extract_domain_from_from_header, enrich_combined,
+            SHARED_HTTP_CLIENT, ENRICH_MODE
         )
 
 # --- CONFIGURAZIONE ---
 setup_logging("WORKER")
 REQUEUE_ON_STARTUP = os.getenv("REQUEUE_ON_STARTUP", "1") == "1"
 REQUEUE_BOOT_MAX   = int(os.getenv("REQUEUE_BOOT_MAX", "1000"))
+REQUEUE_BOOT_BATCH = os.getenv("REQUEUE_BOOT_BATCH", "0") == "1"   # arricchimento via Batch API
 THREAD_DEDUP_MODE = os.getenv("THREAD_DEDUP_MODE", "skip").lower()
 logging.info(f"Modalità deduplicazione thread impostata: THREAD_DEDUP_MODE={THREAD_DEDUP_MODE}")
 
@@ -157,10 +164,11 @@ try:
 except RedisConnectionError as e:
     logging.error(f"Impossibile connettersi a Redis: {e}.")
     exit()
+metrics.bind_redis(redis_client, "worker")
 
-# Limita il numero di elaborazioni pesanti in parallelo per non sovraccaricare il sistema
-# MODIFICA: Ridotta concorrenza come richiesto
-ENRICH_SEM = asyncio.Semaphore(1)
+# Limita il numero di elaborazioni pesanti in parallelo per non sovraccaricare il sistema.
+# Le chiamate verso OpenAI/Pixabay sono poi regolate dai limiter adattivi in processing_utils.
+ENRICH_SEM = asyncio.Semaphore(int(os.getenv("ENRICH_MAX_CONC", "1")))
 
 # Aggiungi configurazione e semaforo dedicato a Pixabay
 PIXABAY_MAX_CONC = int(os.getenv("PIXABAY_MAX_CONC", "1"))  # 1 è prudente
@@ -169,9 +177,12 @@ PIXABAY_CACHE_TTL = int(os.getenv("PIXABAY_CACHE_TTL", "604800"))  # 7 giorni
 PIXABAY_BLOCK_SEC = int(os.getenv("PIXABAY_BLOCK_SEC", "900"))     # 15 minuti
 PIXABAY_SEM = asyncio.Semaphore(PIXABAY_MAX_CONC)
 
+# UPDATE delle email raccolti e scritti a blocchi (vedi backend.db_writes)
+DB_WRITES = WriteBehind()
+
 
 # --- FUNZIONI HELPER PER OPERAZIONI BLOCCANTI ---
-def bootstrap_requeue(max_items: int = REQUEUE_BOOT_MAX):
+def bootstrap_requeue(max_items: int = REQUEUE_BOOT_MAX, batch: bool = False):
     rows = (Newsletter
             .select(Newsletter.email_id, Newsletter.user_id)
             .where(
@@ -184,11 +195,16 @@ def bootstrap_requeue(max_items: int = REQUEUE_BOOT_MAX):
                 )
             )
             .limit(max_items))
-    n = 0
+    jobs = []
     for r in rows:
-        redis_client.rpush("email_queue", json.dumps({"email_id": r.email_id, "user_id": r.user_id}))
-        n += 1
-    logging.info(f"[BOOT] requeue pendenti: {n}")
+        job = {"email_id": r.email_id, "user_id": r.user_id}
+        if batch:
+            job["batch"] = True  # l'arricchimento AI passa da backend.batch_enrich
+        jobs.append(json.dumps(job))
+    # Un RPUSH per blocco invece di uno per email
+    for i in range(0, len(jobs), 500):
+        redis_client.rpush("email_queue", *jobs[i:i + 500])
+    logging.info(f"[BOOT] requeue pendenti: {len(jobs)}")
 
 def _save_credentials_all(creds_all: dict):
     """Salva il dizionario completo delle credenziali in modo atomico e sicuro."""
@@ -278,7 +294,7 @@ async def _gmail_get_message_with_retries(gmail, msg_id: str, max_attempts: int
 
 def logw(stage, **kv):
     try:
-        logging.info(json.dumps({"type": "worker", "stage": stage, **kv}))
+        logging.info(dumps_str({"type": "worker", "stage": stage, **kv}))
     except Exception:
         logging.info(f"[worker][{stage}] {kv}")
 
@@ -286,6 +302,114 @@ def to_utc(dt):
     if dt is None: return None
     return dt.astimezone(timezone.utc) if getattr(dt, "tzinfo", None) else dt.replace(tzinfo=timezone.utc)
 
+async def _resolve_image_for_keyword(kw: str, email_id: str) -> str | None:
+    """Trova un'immagine per la keyword: cache Redis, poi Pixabay (rate gate, 429/403) e re-host su R2."""
+    # Usa cache + semaforo + gestione 429/403 attorno alla chiamata
+    image_url = None
+    cache_key = _pixabay_cache_key(kw)
+    cached = redis_client.get(cache_key)
+    if cached:
+        image_url = cached
+    else:
+        async with PIXABAY_SEM:
+            await _pixabay_rate_gate()
+            try:
+                logw("pixabay_fetch", email_id=email_id, keyword=kw)
+                image_url = await get_pixabay_image_by_query(SHARED_HTTP_CLIENT, kw)
+            except httpx.HTTPStatusError as e:
+                sc = e.response.status_code
+                if sc == 429:
+                    ra = e.response.headers.get("Retry-After")
+                    delay = int(ra) if ra and ra.isdigit() else 5
+                    await asyncio.sleep(delay)
+                    await _pixabay_rate_gate()
+                    image_url = await get_pixabay_image_by_query(SHARED_HTTP_CLIENT, kw)
+                elif sc == 403:
+                    # blocca per un po' per evitare martellamento
+                    until = int(time.time()) + PIXABAY_BLOCK_SEC
+                    redis_client.setex("pixabay:block_until_epoch", PIXABAY_BLOCK_SEC, until)
+                    image_url = None
+            if image_url:
+                # Prova a re-hostare immediatamente su R2 per ridurre errori futuri
+                try:
+                    r2c = _get_r2()
+                    if r2c and image_url:
+                        resp = await SHARED_HTTP_CLIENT.get(image_url, timeout=15.0, follow_redirects=True)
+                        resp.raise_for_status()
+                        body_bytes = resp.content
+                        ct = (resp.headers.get('content-type') or 'image/jpeg').split(';',1)[0].lower()
+                        ext = 'jpg'
+                        if ct.endswith('png'): ext = 'png'
+                        elif ct.endswith('webp'): ext = 'webp'
+                        key = _make_r2_key(kw, ext=ext)
+                        r2c.put_object(Bucket=R2_BUCKET, Key=key, Body=body_bytes, ContentType=ct)
+                        image_url = _r2_public_url(key)
+                        logw("r2_upload_ok", email_id=email_id, key=key)
+                except Exception as e:
+                    logw("r2_upload_fail", email_id=email_id, error=str(e))
+
+                redis_client.setex(cache_key, PIXABAY_CACHE_TTL, image_url)
+                logw("pixabay_hit", email_id=email_id, image_url=image_url)
+            else:
+                logw("pixabay_miss", email_id=email_id, keyword=kw, reason="API returned no results or error occurred")
+
+    return image_url
+
+async def process_image_stage(job_payload: dict):
+    """Job `stage: "image"`: testo già arricchito (es. dal batch), manca solo l'immagine."""
+    email_id = job_payload.get("email_id")
+    user_id = job_payload.get("user_id")
+    n = await asyncio.to_thread(Newsletter.get_or_none, (Newsletter.email_id == email_id) & (Newsletter.user_id == user_id))
+    if not n or n.is_deleted:
+        logw("image_stage_skip", user_id=user_id, email_id=email_id)
+        return
+    if (n.image_url or "").strip():
+        image_url = n.image_url
+    else:
+        kw = (job_payload.get("keyword") or n.tag or "").strip()
+        if not kw:
+            kw = ' '.join((n.original_subject or '').split()[:6]) or 'newsletter'
+        async with ENRICH_SEM:
+            image_url = await _resolve_image_for_keyword(kw, email_id)
+    is_complete = bool(n.ai_title and n.ai_summary_markdown and image_url)
+    await _saved(DB_WRITES.update(email_id, user_id, image_url=image_url, is_complete=is_complete, enriched=True))
+    bump_feed_version(redis_client, user_id)
+    await asyncio.to_thread(feed_push.push_card, redis_client, user_id, email_id, n.thread_id or "")
+    logw("image_stage_saved", user_id=user_id, email_id=email_id, is_complete=is_complete)
+
+async def _saved(*writes: asyncio.Future) -> None:
+    """Attende gli UPDATE del write-behind; se uno non è stato scritto l'email conta come fallita."""
+    for w in writes:
+        if not await w:
+            raise RuntimeError("salvataggio dell'email fallito")
+
+def _notify_job(job_id: str | None, email_id: str):
+    """Avvisa i client SSE del job che l'email è stata aggiornata."""
+    if not job_id:
+        return
+    try:
+        event_id = sse_hub.publish(redis_client, job_id, "update", {"state": "update", "email_id": email_id})
+        logw("redis_notify_ok", job_id=job_id, email_id=email_id, event_id=event_id)
+    except Exception as e:
+        logw("redis_notify_err", job_id=job_id, email_id=email_id, error=str(e))
+
+
+def _record_job_progress(job_id: str | None, user_id: str, email_id: str, failed: bool) -> None:
+    """Conta l'email nel job di ingest (HINCRBY atomico in Redis) e pubblica lo stato aggiornato."""
+    if not job_id:
+        return
+    try:
+        st = ingest_jobs.record_result(redis_client, job_id, user_id, email_id, failed=failed)
+        if st is None:
+            return
+        sse_hub.publish(redis_client, job_id, "progress", st)
+        feed_push.push_ingest(redis_client, user_id, st)
+        if st.get("state") == "done":
+            logw("job_done", job_id=job_id, done=st.get("done"), errors=st.get("errors"), total=st.get("total"))
+    except Exception as e:
+        logw("job_progress_err", job_id=job_id, email_id=email_id, error=str(e))
+
+
 async def process_job(job_payload: dict):
     email_id = job_payload.get("email_id")
     user_id = job_payload.get("user_id")
@@ -298,6 +422,16 @@ async def process_job(job_payload: dict):
         logw("malformed_job", job_payload=job_payload)
         return
 
+    if job_payload.get("stage") == "image":
+        try:
+            await process_image_stage(job_payload)
+        except Exception as e:
+            logw("image_stage_error", user_id=user_id, email_id=email_id, error=str(e))
+        finally:
+            logw("end", user_id=user_id, email_id=email_id, dur_ms=int((time.perf_counter() - t0) * 1000))
+        return
+
+    failed = False
     try:
         q_len = redis_client.llen("email_queue")
         logw("job_info", user_id=user_id, email_id=email_id, job_id=job_id, queue_len=q_len)
@@ -348,18 +482,14 @@ async def process_job(job_payload: dict):
             )
             if dup:
                 logw("skip_due_to_thread_duplicate", user_id=user_id, email_id=email_id, thread_id=tid)
-                _ = (cast(Any, Newsletter)
-                    .update(enriched=True, is_complete=False)
-                    .where((Newsletter.email_id == email_id) & (Newsletter.user_id == user_id))
-                    .execute())
+                # Atteso prima del finally: chiudere il job con la riga non ancora scritta
+                # farebbe rileggere al client dati vecchi
+                await _saved(DB_WRITES.update(email_id, user_id, enriched=True, is_complete=False))
                 return
         
         label_ids = set(message.get('labelIds', []))
         if 'SPAM' in label_ids or 'TRASH' in label_ids:
-            _ = (cast(Any, Newsletter)
-               .update(is_deleted=True, enriched=True, is_complete=False)
-               .where((Newsletter.email_id == email_id) & (Newsletter.user_id == user_id))
-               .execute())
+            await _saved(DB_WRITES.update(email_id, user_id, is_deleted=True, enriched=True, is_complete=False))
             return
 
         html_content = extract_html_from_payload(message.get("payload", {}))
@@ -379,17 +509,51 @@ async def process_job(job_payload: dict):
             "thread_id": message.get("threadId"),
             "rfc822_message_id": header_map.get("message-id"),
         }
-        _ = (cast(Any, Newsletter)
-           .update(**preliminary_data)
-           .where((Newsletter.email_id == email_id) & (Newsletter.user_id == user_id))
-           .execute())
-        
+        # Scritto insieme all'aggiornamento finale dell'email se arriva entro lo stesso blocco
+        preliminary_saved = DB_WRITES.update(email_id, user_id, **preliminary_data)
+
+        # Quasi-duplicato di un'email già arricchita (stessa issue, promo personalizzata):
+        # dello stesso utente si copiano titolo, riassunto, tag e immagine senza chiamare AI e
+        # Pixabay; da un altro utente solo immagine e tag, i testi si generano comunque qui sotto
+        try:
+            donor = await asyncio.to_thread(near_dup.lookup_and_index, clean_html(html_content), email_id, user_id)
+        except Exception as e:
+            donor = None
+            logw("near_dup_error", email_id=email_id, error=str(e))
+        shared: dict[str, Any] = {}
+        if donor and not donor["same_user"]:
+            shared = {k: v for k, v in donor["fields"].items() if v}
+            logw("near_dup_shared", user_id=user_id, email_id=email_id, donor_email_id=donor["email_id"],
+                 distance=donor["distance"], fields=list(shared))
+        elif donor:
+            reused = dict(donor["fields"])
+            override = await asyncio.to_thread(
+                domain_profiles.override_for, user_id, domain_profiles.sender_host(preliminary_data["sender_email"]), redis_client)
+            if override:
+                reused["type_tag"] = override
+            if n.tag or not reused.get("tag"):
+                reused.pop("tag", None)
+            await _saved(preliminary_saved, DB_WRITES.update(email_id, user_id, **reused, enriched=True, is_complete=True))
+            bump_feed_version(redis_client, user_id)
+            await asyncio.to_thread(feed_push.push_card, redis_client, user_id, email_id, tid or "")
+            logw("near_dup_reused", user_id=user_id, email_id=email_id, donor_email_id=donor["email_id"],
+                 distance=donor["distance"])
+            _notify_job(job_id, email_id)
+            return
+
+        if job_payload.get("batch"):
+            # Lavoro non interattivo: l'AI arriverà dal batch, che poi accoderà lo stage "image"
+            await _saved(preliminary_saved)  # il batch legge l'HTML dal DB
+            queued = enqueue_for_batch(redis_client, email_id, user_id)
+            logw("deferred_to_batch", user_id=user_id, email_id=email_id, queued=queued)
+            return
+
         update_data: dict[str, Any] = {"enriched": True, "is_complete": False}
 
         try:
-            # --- INIZIO FIX: USARE L'HTML PULITO ---
-            cleaned_content = clean_html(html_content)
-            content_for_ai = cleaned_content  # Usa sempre il contenuto pulito
+            # L'HTML mantiene la struttura a paragrafi: la condensazione (content_condense)
+            # scarta il boilerplate e sceglie i blocchi più informativi per ogni prompt.
+            content_for_ai = html_content if clean_html(html_content) else ""
 
             if not content_for_ai:
                 subj = header_map.get('subject', '')
@@ -397,14 +561,44 @@ async def process_job(job_payload: dict):
                 content_for_ai = f"Oggetto: {subj}\n\nAnteprima: {snip}"
                 logw("content_fallback_used", email_id=email_id, reason="Empty HTML body")
 
+            sender_domain = domain_profiles.sender_host(preliminary_data["sender_email"])
+            source_domain = preliminary_data["source_domain"]
+            # Override utente ed etichette stabili del mittente, dalla cache in-process
+            profile = await asyncio.to_thread(domain_profiles.lookup, user_id, sender_domain, source_domain, redis_client)
+            learned_tags = False
+
             async with ENRICH_SEM:
                 # 1) Classifica velocemente per scegliere il prompt adatto
                 meta_head = f"FROM: {header_map.get('from','')}\nSUBJECT: {header_map.get('subject','')}\n\n"
-                tags = await classify_type_and_topic(meta_head + content_for_ai, SHARED_HTTP_CLIENT)
-
-                # 2) Riassunto e keyword, usando il tipo per adattare il prompt
-                ai_summary = await get_ai_summary(content_for_ai, SHARED_HTTP_CLIENT, type_tag=tags.get('type_tag'))
-                ai_keyword = await get_ai_keyword(content_for_ai, SHARED_HTTP_CLIENT, type_tag=tags.get('type_tag'))
+                combined = None
+                if ENRICH_MODE == "combined":
+                    # Tutto in una chiamata: tag, titolo/riassunto e keyword
+                    combined = await enrich_combined(meta_head + content_for_ai, SHARED_HTTP_CLIENT)
+                    if not combined:
+                        logw("combined_fallback", email_id=email_id)
+
+                if combined:
+                    tags = {"type_tag": combined["type_tag"], "topic_tag": combined["topic_tag"]}
+                    ai_summary = {"title": combined["title"], "summary_markdown": combined["summary_markdown"]}
+                    ai_keyword = combined["keyword"]
+                    learned_tags = True
+                else:
+                    if shared.get("type_tag") and shared.get("topic_tag"):
+                        # Stessa newsletter ricevuta da un altro utente: niente chiamata di classificazione
+                        tags = {"type_tag": shared["type_tag"], "topic_tag": shared["topic_tag"]}
+                    elif profile["type_tag"] and profile["topic_tag"]:
+                        # Mittente con etichette stabili: niente chiamata di classificazione
+                        tags = {"type_tag": profile["type_tag"], "topic_tag": profile["topic_tag"]}
+                        metrics.incr("domain_profile.hit")
+                        logw("domain_profile_reused", email_id=email_id, domain=sender_domain, source=profile["source"], **tags)
+                    else:
+                        metrics.incr("domain_profile.miss")
+                        tags = await classify_type_and_topic(meta_head + content_for_ai, SHARED_HTTP_CLIENT)
+                        learned_tags = True
+
+                    # 2) Riassunto e keyword, usando il tipo per adattare il prompt
+                    ai_summary = await get_ai_summary(content_for_ai, SHARED_HTTP_CLIENT, type_tag=tags.get('type_tag'))
+                    ai_keyword = await get_ai_keyword(content_for_ai, SHARED_HTTP_CLIENT, type_tag=tags.get('type_tag'))
 
                 logw("ai_results", 
                  email_id=email_id, 
@@ -412,70 +606,25 @@ async def process_job(job_payload: dict):
                  summary_chars=len(ai_summary.get('summary_markdown','')),
                  keyword=ai_keyword)
                 
-                # Usa cache + semaforo + gestione 429/403 attorno alla chiamata
-                image_url = None
                 kw = (ai_keyword or "").strip()
                 if not kw:
                     subj = header_map.get('subject') or ''
                     kw = ' '.join(subj.split()[:6]) or 'newsletter'
-                cache_key = _pixabay_cache_key(kw)
-                cached = redis_client.get(cache_key)
-                if cached:
-                    image_url = cached
-                else:
-                    async with PIXABAY_SEM:
-                        await _pixabay_rate_gate()
-                        try:
-                            logw("pixabay_fetch", email_id=email_id, keyword=kw)
-                            image_url = await get_pixabay_image_by_query(SHARED_HTTP_CLIENT, kw)
-                        except httpx.HTTPStatusError as e:
-                            sc = e.response.status_code
-                            if sc == 429:
-                                ra = e.response.headers.get("Retry-After")
-                                delay = int(ra) if ra and ra.isdigit() else 5
-                                await asyncio.sleep(delay)
-                                await _pixabay_rate_gate()
-                                image_url = await get_pixabay_image_by_query(SHARED_HTTP_CLIENT, kw)
-                            elif sc == 403:
-                                # blocca per un po' per evitare martellamento
-                                until = int(time.time()) + PIXABAY_BLOCK_SEC
-                                redis_client.setex("pixabay:block_until_epoch", PIXABAY_BLOCK_SEC, until)
-                                image_url = None
-                        if image_url:
-                            # Prova a re-hostare immediatamente su R2 per ridurre errori futuri
-                            try:
-                                r2c = _get_r2()
-                                if r2c and image_url:
-                                    resp = await SHARED_HTTP_CLIENT.get(image_url, timeout=15.0, follow_redirects=True)
-                                    resp.raise_for_status()
-                                    body_bytes = resp.content
-                                    ct = (resp.headers.get('content-type') or 'image/jpeg').split(';',1)[0].lower()
-                                    ext = 'jpg'
-                                    if ct.endswith('png'): ext = 'png'
-                                    elif ct.endswith('webp'): ext = 'webp'
-                                    key = _make_r2_key(kw, ext=ext)
-                                    r2c.put_object(Bucket=R2_BUCKET, Key=key, Body=body_bytes, ContentType=ct)
-                                    image_url = _r2_public_url(key)
-                                    logw("r2_upload_ok", email_id=email_id, key=key)
-                            except Exception as e:
-                                logw("r2_upload_fail", email_id=email_id, error=str(e))
-
-                            redis_client.setex(cache_key, PIXABAY_CACHE_TTL, image_url)
-                            logw("pixabay_hit", email_id=email_id, image_url=image_url)
-                        else:
-                            logw("pixabay_miss", email_id=email_id, keyword=kw, reason="API returned no results or error occurred")
+                image_url = shared.get("image_url") or await _resolve_image_for_keyword(kw, email_id)
 
                 # 'tags' già calcolati sopra; eventuali override applicati più sotto
 
-            sender_email = parseaddr(header_map.get('from',''))[1].lower()
-            sender_domain = (sender_email.split('@')[-1]).lower()
-            
-            if sender_domain:
-                override = await asyncio.to_thread(DomainTypeOverride.get_or_none, (DomainTypeOverride.user_id == user_id) & (DomainTypeOverride.domain == sender_domain))
-                if override:
-                    tags["type_tag"] = override.type_tag
-                    logw("type_override_applied", domain=sender_domain, new_type=override.type_tag)
-            
+            if profile["override"]:
+                tags["type_tag"] = profile["override"]
+                logw("type_override_applied", domain=sender_domain, new_type=profile["override"])
+
+            if learned_tags:
+                try:
+                    await asyncio.to_thread(domain_profiles.record, user_id, sender_domain, source_domain,
+                                            tags.get("type_tag"), tags.get("topic_tag"))
+                except Exception as e:
+                    logw("domain_profile_record_failed", email_id=email_id, error=str(e))
+
             is_complete = bool(ai_summary.get('title') and ai_summary.get('summary_markdown') and image_url)
 
             logw("completeness_check", 
@@ -494,6 +643,8 @@ async def process_job(job_payload: dict):
                 "topic_tag": tags.get("topic_tag"),
             })
 
+            if shared.get("accent_hex") and image_url == shared.get("image_url"):
+                update_data["accent_hex"] = shared["accent_hex"]
             if not n.tag and ai_keyword:
                 update_data["tag"] = ai_keyword.strip()[:32]
         
@@ -504,35 +655,33 @@ async def process_job(job_payload: dict):
             feed_visible = bool(update_data.get("is_complete"))
             logw("db_update_fields", email_id=email_id, keys=list(update_data.keys()))
             logw("about_to_save", email_id=email_id, thread_id=tid, will_be_visible=feed_visible)
-            _ = (cast(Any, Newsletter)
-               .update(**update_data)
-               .where((Newsletter.email_id == email_id) & (Newsletter.user_id == user_id))
-               .execute())
-            
+            await _saved(preliminary_saved, DB_WRITES.update(email_id, user_id, **update_data))
+            bump_feed_version(redis_client, user_id)
+            if feed_visible:
+                await asyncio.to_thread(feed_push.push_card, redis_client, user_id, email_id, tid or "")
+
             logw("saved", user_id=user_id, email_id=email_id, updated_rows=1,
                  is_complete=update_data.get("is_complete", False))
 
-        if job_id:
-            try:
-                update_channel = f"sse:update:{job_id}"
-                update_payload = json.dumps({"email_id": email_id})
-                redis_client.publish(update_channel, update_payload)
-
-                progress_channel = f"sse:progress:{job_id}"
-                redis_client.publish(progress_channel, "progress")
-                
-                logw("redis_notify_ok", job_id=job_id, email_id=email_id)
-            except Exception as e:
-                logw("redis_notify_err", job_id=job_id, email_id=email_id, error=str(e))
+        _notify_job(job_id, email_id)
 
     except Exception as e:
+        failed = True
         logw("critical_error", user_id=user_id, email_id=email_id, error=str(e), exc_info=True)
     finally:
+        # Anche le email saltate (già arricchite, spam, thread duplicato...) completano il job
+        await asyncio.to_thread(_record_job_progress, job_id, user_id, email_id, failed)
         logw("end", user_id=user_id, email_id=email_id, dur_ms=int((time.perf_counter() - t0) * 1000))
 
 
 async def main_worker_loop():
     logging.info("Worker avviato. In attesa di lavoro...")
+    try:
+        await _consume_queue()
+    finally:
+        await DB_WRITES.close()
+
+async def _consume_queue():
     while True:
         try:
             job_json_tuple: Optional[Tuple[str, str]] = cast(
@@ -555,9 +704,10 @@ if __name__ == "__main__":
     if db.is_closed():
         db.connect()
     initialize_db()
+    domain_profiles.ensure_built()
 
     if REQUEUE_ON_STARTUP:
-        bootstrap_requeue()
+        bootstrap_requeue(batch=REQUEUE_BOOT_BATCH)
 
     try:
         asyncio.run(main_worker_loop())
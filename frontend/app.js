@@ -191,6 +191,11 @@ let __lastIngestAt = 0;
 let __sseOpen = false;
 let __sseUpdateQueue = [];
 let __sseProcessTimer = null;
+let __changeToken = null; // seq di /api/feed/changes, dalla prima pagina del feed
+let __feedStream = null;   // EventSource di /api/feed/events (card spinte dal server)
+let __feedStreamOpen = false;
+let __feedStreamLastId = null;
+let __feedStreamRetry = 0;
 let __didBackfillOnce = false;
 const FIRST_PAINT_COUNT = 4;
 let __firstPaintDone = false;
@@ -288,7 +293,6 @@ let gisInited = false;
 // Stato UI e helper
 let __emailOpenSeq = 0;
 let lastFocusedEl = null;
-let backgroundUpdateInterval = null;
 
 // Costanti dell'applicazione
 // let activeTypes = new Set(TYPE_OPTIONS); 
@@ -333,9 +337,170 @@ function redact(s) {
     .replace(/\b[A-Z]{2}\d{2}[A-Z0-9]{10,30}\b/g, '[IBAN_REDACTED]');
 }
 
+function removeFeedCard(id) {
+  const k = String(id);
+  cardNodes.get(k)?.remove();
+  cardNodes.delete(k);
+  __mountedIds.delete(k);
+  removePlaceholder(k);
+  if (itemsById.delete(k)) {
+    allFeedItems = allFeedItems.filter(it => String(it.email_id) !== k);
+  }
+}
+
+/**
+ * Applica card nuove/aggiornate e rimosse (da /api/feed/changes o dallo stream del feed).
+ */
+async function applyCardChanges(upserted, removed) {
+  for (const id of removed) removeFeedCard(id);
+  const fresh = [];
+  for (const it of upserted) {
+    const old = cardNodes.get(it.email_id);
+    if (old) {
+      // Card già montata: sostituisci con la versione aggiornata
+      const card = renderFeedCard(it);
+      old.replaceWith(card);
+      observeReadCard(card);
+      cardNodes.set(it.email_id, card);
+      requestAnimationFrame(() => card.classList.remove('opacity-0'));
+    } else {
+      removePlaceholder(it.email_id);
+      fresh.push(it);
+    }
+  }
+  mergeFeedMemory(upserted);
+  if (fresh.length) await upsertFeedItems(fresh, { prepend: true });
+}
+
+/**
+ * Stream per utente delle modifiche al feed: il server spinge le card appena il worker
+ * le completa, quindi durante l'ingest non serve ricaricare la prima pagina a intervalli.
+ */
+function openFeedStream() {
+  if (__feedStream || typeof EventSource === 'undefined') return;
+  const resume = __feedStreamLastId ? `?last_event_id=${encodeURIComponent(__feedStreamLastId)}` : '';
+  const es = new EventSource(`${window.BACKEND_BASE}/api/feed/events${resume}`, { withCredentials: true });
+  __feedStream = es;
+
+  es.onopen = () => {
+    __feedStreamOpen = true;
+    __feedStreamRetry = 0;
+    stopTailPolling();
+    // Recupera in una richiesta quanto perso mentre lo stream era giù
+    if (__changeToken != null) syncFeedChanges().then(applyViewFilter).catch(() => {});
+  };
+  es.addEventListener('card', async (ev) => {
+    if (ev.lastEventId) __feedStreamLastId = ev.lastEventId;
+    let data = {};
+    try { data = JSON.parse(ev.data || '{}'); } catch { return; }
+    await applyCardChanges(data.op === 'upsert' && data.card ? [data.card] : [], data.removed || []);
+    applyViewFilter();
+    reconcileEndOfFeed();
+  });
+  es.addEventListener('ingest', (ev) => {
+    if (ev.lastEventId) __feedStreamLastId = ev.lastEventId;
+    let st = {};
+    try { st = JSON.parse(ev.data || '{}'); } catch { return; }
+    __isIngesting = st.state === 'queued' || st.state === 'running';
+    if (!__isIngesting) toggleLoadingMessage(false);
+    reconcileEndOfFeed();
+  });
+  es.onerror = () => {
+    __feedStreamOpen = false;
+    if (es.readyState !== EventSource.CLOSED) return; // il browser riconnette da solo
+    // Chiuso (es. 401 o errore di rete persistente): riapri con backoff riprendendo dall'ultimo id
+    __feedStream = null;
+    reconcileEndOfFeed();
+    const delay = Math.min(30000, 1000 * (2 ** __feedStreamRetry++)) + Math.random() * 500;
+    setTimeout(openFeedStream, delay);
+  };
+}
+
+function closeFeedStream() {
+  if (__feedStream) { try { __feedStream.close(); } catch {} }
+  __feedStream = null;
+  __feedStreamOpen = false;
+  __feedStreamLastId = null;
+}
+
+/**
+ * Segue un job in background (update-images, backfill, recompute, rehost) su
+ * /api/jobs/{id}/events fino alla fine. onItem riceve l'esito di ogni email appena scritto.
+ * Risolve con { state, updated_items, failed_items } (updated_items: esiti "ok").
+ */
+function waitBulkJob(jobId, onItem) {
+  const out = { state: 'failed', updated_items: [], failed_items: [] };
+  if (!jobId || typeof EventSource === 'undefined') return Promise.resolve(out);
+  return new Promise((resolve) => {
+    let lastId = null, retries = 0;
+    const open = () => {
+      const resume = lastId ? `?last_event_id=${encodeURIComponent(lastId)}` : '';
+      const es = new EventSource(`${window.BACKEND_BASE}/api/jobs/${jobId}/events${resume}`, { withCredentials: true });
+      es.addEventListener('item', (ev) => {
+        if (ev.lastEventId) lastId = ev.lastEventId;
+        let it = {};
+        try { it = JSON.parse(ev.data || '{}'); } catch { return; }
+        if (it.status === 'ok') out.updated_items.push(it);
+        else if (it.status === 'failed') out.failed_items.push(it);
+        try { onItem?.(it); } catch {}
+      });
+      es.addEventListener('progress', (ev) => {
+        if (ev.lastEventId) lastId = ev.lastEventId;
+        let st = {};
+        try { st = JSON.parse(ev.data || '{}'); } catch { return; }
+        if (st.state !== 'done' && st.state !== 'failed') return;
+        es.close();
+        out.state = st.state;
+        resolve(out);
+      });
+      es.onerror = () => {
+        if (es.readyState !== EventSource.CLOSED) return;
+        if (++retries > 5) { resolve(out); return; }
+        setTimeout(open, Math.min(8000, 600 * (2 ** retries)));
+      };
+    };
+    open();
+  });
+}
+window.waitBulkJob = waitBulkJob;
+
+/**
+ * Applica in una sola richiesta tutte le modifiche al feed dopo __changeToken
+ * (card nuove/aggiornate e rimosse). Con reset=true il token è troppo vecchio: ricarica.
+ */
+async function syncFeedChanges(){
+  for (let guard = 0; guard < 20 && __changeToken != null; guard++) {
+    const r = await fetch(`${API_URL}/feed/changes?since=${encodeURIComponent(__changeToken)}`, { credentials:'include', cache:'no-store' });
+    if (!r.ok) throw new Error(`changes_failed_${r.status}`);
+    const data = await r.json();
+    if (data.reset) {
+      feLog('warn', 'feed.changes.reset', { since: __changeToken });
+      __changeToken = null;
+      await window.fetchFeed({ reset: true, force: true });
+      return;
+    }
+    __changeToken = data.change_token;
+
+    await applyCardChanges(data.upserted || [], data.removed || []);
+    feLog('info', 'feed.changes', { upserted: (data.upserted || []).length, removed: (data.removed || []).length, token: __changeToken });
+    if (!data.has_more) break;
+  }
+}
+
 async function processSseUpdateQueue(){
   if (__sseUpdateQueue.length === 0) return;
   const ids = [...new Set(__sseUpdateQueue)]; __sseUpdateQueue = [];
+  if (__changeToken != null) {
+    try {
+      await syncFeedChanges();
+      for (const id of ids) if (!cardNodes.has(id)) removePlaceholder(id);
+      applyViewFilter();
+      reconcileEndOfFeed();
+      return;
+    } catch (e) {
+      feLog('warn', 'feed.changes.failed', { error: e?.message });  // ripiega sul fetch per item
+    }
+  }
   const results = await Promise.allSettled(ids.map(fetchItem));
   const newItems = [];
 
@@ -1633,32 +1798,6 @@ async function getToken({ prompt } = {}) {
 async function getAccessToken(){ return getToken({ prompt:'consent' }); }
 async function getAccessTokenSilently(){ return getToken(); }
 
-function startBackgroundUpdates() {
-  if (backgroundUpdateInterval) clearInterval(backgroundUpdateInterval);
-
-  let updateCount = 0;
-  const maxUpdates = 12; // ~1 minuto
-
-  backgroundUpdateInterval = setInterval(async () => {
-    console.log("Controllo aggiornamenti in background...");
-    // FIX: Rimuovi il cursore per caricare la prima pagina e scoprire i nuovi item.
-    await fetchFeed({ force: true, _fromWatcher: true });
-
-    updateCount++;
-    const sseGone = (__ingestSSE == null);
-    const stop = sseGone || updateCount >= maxUpdates;
-
-    if (stop) {
-      clearInterval(backgroundUpdateInterval);
-      console.log("Polling in background terminato.");
-      // FIX: Anche la chiamata finale non deve avere il cursore.
-      if (sseGone) {
-        await fetchFeed({ force: true, _fromWatcher: true });
-      }
-    }
-  }, 5000);
-}
-
 /**
  * Gestisce la risposta "ingesting" dal backend.
  * Mostra gli scheletri e avvia l'ascolto degli eventi SSE.
@@ -1673,7 +1812,6 @@ function handleIngestionState(jobId, { onDone, onError } = {}) {
     __isIngesting = true;
     __sseOpen = true;
     toggleLoadingMessage(true);
-    startBackgroundUpdates();
     return;
   }
 
@@ -1687,12 +1825,9 @@ function handleIngestionState(jobId, { onDone, onError } = {}) {
   const MAX_RETRIES = 5;
   let es;
   let finished = false;
+  let lastEventId = null; // per riprendere dopo una riconnessione manuale
 
   const cleanup = () => {
-    if (backgroundUpdateInterval) {
-      clearInterval(backgroundUpdateInterval);
-      backgroundUpdateInterval = null;
-    }
     if (es) es.close();
     __ingestSSE = null;
     if (updateBtn) { updateBtn.disabled = false; updateBtn.classList.remove('opacity-50','cursor-not-allowed'); }
@@ -1731,6 +1866,7 @@ function handleIngestionState(jobId, { onDone, onError } = {}) {
   const onAny = async (ev) => {
     let st = {}; 
     try { st = JSON.parse(ev.data || "{}"); } catch {}
+    if (ev.lastEventId) lastEventId = ev.lastEventId;
     feLog('info', 'sse.event', { jobId, type: ev.type, ...st });
     if (ev.type === 'update' && st.email_id) {
       scheduleSseUpdate(st.email_id);
@@ -1743,7 +1879,9 @@ function handleIngestionState(jobId, { onDone, onError } = {}) {
   };
 
   function openES() {
-    es = new EventSource(`${window.BACKEND_BASE}/api/ingest/events/${jobId}`, { withCredentials: true });
+    // Un nuovo EventSource non rimanda Last-Event-ID: lo passiamo in query
+    const resume = lastEventId ? `?last_event_id=${encodeURIComponent(lastEventId)}` : '';
+    es = new EventSource(`${window.BACKEND_BASE}/api/ingest/events/${jobId}${resume}`, { withCredentials: true });
     __ingestSSE = es; es.__jobId = jobId;
     __sseOpen = true;
     
@@ -1775,7 +1913,6 @@ function handleIngestionState(jobId, { onDone, onError } = {}) {
 
   toggleEndOfFeed(false);
   toggleLoadingMessage(true);
-  startBackgroundUpdates();
   openES();
 }
 
@@ -1805,8 +1942,9 @@ function reconcileEndOfFeed() {
 }
 
 function startTailPolling() {
-  if (tailTimer) return;
-  console.log("[Polling] Avvio tail polling ogni 4 secondi.");
+  // Solo di riserva: con lo stream del feed attivo le card arrivano dal server
+  if (tailTimer || __feedStreamOpen) return;
+  console.log("[Polling] Stream del feed non disponibile: avvio tail polling ogni 4 secondi.");
   tailTimer = setInterval(() => {
     // Chiamiamo fetchFeed senza cursore per caricare la prima pagina
     window.fetchFeed({ force: true, _fromWatcher: true });
@@ -2373,8 +2511,9 @@ document.addEventListener('DOMContentLoaded', () => {
             body: JSON.stringify({limit: 200, only_not_r2: true})
           });
           const d = await r.json().catch(()=>({}));
-          console.log('[Admin] rehost batch', i, d);
-          if (!d.updated || d.updated.length===0) break;
+          const res = await waitBulkJob(d.job_id);
+          console.log('[Admin] rehost batch', i, d, res);
+          if (res.updated_items.length===0) break;
           await new Promise(s=>setTimeout(s,250));
         }
 
@@ -2385,8 +2524,9 @@ document.addEventListener('DOMContentLoaded', () => {
             body: JSON.stringify({limit: 150, only_missing: false, reclassify: false})
           });
           const d = await r.json().catch(()=>({}));
-          console.log('[Admin] recompute batch', i, d);
-          if (!d.updated || d.updated.length===0) break;
+          const res = await waitBulkJob(d.job_id);
+          console.log('[Admin] recompute batch', i, d, res);
+          if (res.updated_items.length===0) break;
           await new Promise(s=>setTimeout(s,250));
         }
 
@@ -3220,6 +3360,7 @@ async function handleLogout() {
   }
 
   // 3. Pulisci lo stato locale del frontend
+  closeFeedStream();
   // Pulisci eventuale chiave legacy globale
   localStorage.removeItem('feedEverLoaded');
   // Pulisci anche la versione per-utente (già calcolata sopra)
@@ -4431,6 +4572,7 @@ window.fetchFeed = async ({ reset = false, cursor = null, force = false } = {})
   if (reset) {
     __cursor = null;
     __hasMore = true;
+    __changeToken = null;
     allFeedItems = [];
     itemsById.clear();
     __mountedIds.clear();
@@ -4501,6 +4643,11 @@ window.fetchFeed = async ({ reset = false, cursor = null, force = false } = {})
     // --- FINE BLOCCO LOG ---
 
     const page = Array.isArray(data?.feed) ? data.feed : [];
+    // Il token vale solo se nessuna modifica precedente è andata persa: si prende alla prima pagina
+    if (!currentCursor && __changeToken == null && data.change_token != null) {
+      __changeToken = data.change_token;
+    }
+    openFeedStream();
 
     __hasMore = Boolean(data.has_more);
     window.__pendingMore = Boolean(data.pending_more); 
@@ -4675,7 +4822,9 @@ const updateImages = async (overrideSource = null) => {
             throw new Error(`Errore aggiornamento immagini: ${response.status}`);
         }
 
-        const data = await response.json();
+        // Il server risponde subito con il job: gli esiti arrivano sullo stream del job
+        const { job_id } = await response.json();
+        const data = await waitBulkJob(job_id);
         console.log("[updateImages] Dati ricevuti:", data);
 
         (data.updated_items || []).forEach(item => {
@@ -4876,7 +5025,8 @@ async function retryUpdateImages() {
     console.error("[BulkImport] Errore nel retryUpdateImages:", response.status);
     return;
   }
-  const data = await response.json();
+  const { job_id } = await response.json();
+  const data = await waitBulkJob(job_id);
   console.log("[BulkImport] Immagini aggiornate:", data);
 
   data.updated_items.forEach(item => {
@@ -4921,8 +5071,8 @@ async function autoBackfillImages(pageItems = []) {
       body: JSON.stringify({ email_ids: batch, image_source: 'pixabay', only_empty: true })
     });
     if (!res.ok) return;
-    const data = await res.json().catch(() => ({}));
-    const list = data.updated_items || [];
+    const { job_id } = await res.json().catch(() => ({}));
+    const list = (await waitBulkJob(job_id)).updated_items;
     for (const item of list) {
       const card = document.querySelector(`.feed-card[data-email-id="${item.email_id}"]`);
       if (!card) continue;
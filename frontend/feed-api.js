@@ -7,10 +7,12 @@ let __feedAbort = null;
 let __ingestSSE = null;
 let __sseUpdateQueue = [];
 let __sseProcessTimer = null;
+let __changeToken = null;
 
 // --- GETTER ESPORTATI ---
 export const hasMore = () => __hasMore;
 export const cursor = () => __cursor;
+export const changeToken = () => __changeToken;
 
 // --- FUNZIONI ESPORTATE ---
 
@@ -58,6 +60,26 @@ export async function getItem(emailId) {
   }
 }
 
+/**
+ * Modifiche al feed dopo il change token (default: quello della prima pagina caricata).
+ * Aggiorna il token interno; con reset=true il client deve ricaricare la prima pagina.
+ * @param {number|null} since - Il change token da cui partire.
+ * @returns {Promise<{upserted: Array, removed: Array<string>, hasMore: boolean, reset: boolean}|null>}
+ */
+export async function getChanges(since = __changeToken) {
+  if (since == null) return null;
+  try {
+    const res = await fetch(`${window.API_URL}/feed/changes?since=${encodeURIComponent(since)}`, { credentials: 'include', cache: 'no-store' });
+    if (!res.ok) return null;
+    const data = await res.json();
+    __changeToken = data.reset ? null : data.change_token;
+    return { upserted: data.upserted || [], removed: data.removed || [], hasMore: Boolean(data.has_more), reset: Boolean(data.reset) };
+  } catch (e) {
+    console.error(`[API] Fallimento getChanges da ${since}:`, e);
+    return null;
+  }
+}
+
 /**
  * Avvia l'ascolto degli eventi di ingestione dal server (SSE).
  * @param {string} jobId - L'ID del job di ingestione.
@@ -132,6 +154,7 @@ export function startIngestSSE(jobId, { onUpdate = () => {}, onProgress, onEnd }
  * Invia al backend la richiesta di aggiornare le immagini per una lista di email.
  * @param {Array<string>} emailIds - Lista degli ID delle email.
  * @param {string} source - La sorgente delle immagini ('pixabay' o 'google_photos').
+ * Il server esegue l'aggiornamento in un job in background: si attende la sua fine.
  * @returns {Promise<Array>} La lista degli item aggiornati.
  */
 export async function updateImages(emailIds, source) {
@@ -149,8 +172,8 @@ export async function updateImages(emailIds, source) {
         if (res.status === 409) throw new Error('pool_empty');
         throw new Error(`API error ${res.status}`);
     }
-    const data = await res.json();
-    return data.updated_items || [];
+    const { job_id } = await res.json();
+    return (await window.waitBulkJob(job_id)).updated_items;
   } catch (e) {
     console.error(`[API] Fallimento updateImages:`, e);
     throw e;
@@ -220,6 +243,7 @@ async function fetchPage(cursor) {
 
     __cursor = data.next_cursor ?? null;
     __hasMore = Boolean(data.has_more);
+    if (!cursor && data.change_token != null) __changeToken = data.change_token;
 
     return {
       items: page,